@@ -12,24 +12,36 @@ Updated 2020-01-15
 # Wrapper for ABCD DICOM to BIDS pipeline that can be run from the command line
 #    1. Imports data, QC's it, and exports abcd_fastqc01_reformatted.csv
 #    2. Runs aws_downloader.py to download ABCD data using .csv table
-#    3. Runs unpack_and_setup.sh to unpack/setup the downloaded ABCD data
+#    3. Runs unpack_stages.py to unpack/setup the downloaded ABCD data
 #    4. Runs correct_jsons.py to conform data to official BIDS standards
 #    5. Runs BIDS validator on unpacked/setup data using Docker
 #
 ##################################
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
 from cryptography.fernet import Fernet
+import csv
 import datetime
 from getpass import getpass
 import glob
+import io
 import os
 import pandas as pd
 import shutil
 import signal
 import subprocess
 import sys
+import threading
+
+from src.pipeline_state import (fingerprint_files, fingerprint_strings,
+                                PipelineState)
+from src.qc_cache import write_qc_cache
+from src.stage_metrics import (measure, METRICS_ENV_VAR, run_and_measure,
+                               write_record)
+from src.extract_tgzs import JOBS_ENV_VAR, MODALITIES_ENV_VAR, PIGZ_ENV_VAR
+from src.stage_tgzs import STAGING_ENV_VAR, STAGING_MODES
 
 # Constant: List of function names of steps 1-5 in the list above
 STEP_NAMES = ["reformat_fastqc_spreadsheet", "download_nda_data",
@@ -54,9 +66,18 @@ DOWNLOAD_CMD_PATH = os.path.join(os.path.expanduser("~"), ".local", "bin", "down
 SERIES_TABLE_PARSER = os.path.join(PWD, "src", "aws_downloader.py")
 SPREADSHEET_DOWNLOAD = os.path.join(PWD, "temp", "abcd_fastqc01_reformatted.csv")
 SPREADSHEET_QC = os.path.join(PWD, "spreadsheets", "abcd_fastqc01.txt")
+
+# Constant: Version of the reformatted spreadsheet's format. Increment it
+# whenever reformatting changes, so that a spreadsheet which older code
+# reformatted is not reused.
+SPREADSHEET_FORMAT_VERSION = "2"
 TEMP_FILES_DIR = os.path.join(PWD, "temp")
-UNPACK_AND_SETUP = os.path.join(PWD, "src", "unpack_and_setup.sh")
+UNPACK_STAGES = os.path.join(PWD, "src", "unpack_stages.py")
 UNPACKED_FOLDER = os.path.join(PWD, "data")
+
+# Constant: Prefix of the line which aws_downloader.py --stream prints once
+# it finishes downloading a subject session
+STREAM_READY = "READY\t"
 MODALITIES = ['anat', 'func', 'dwi']
 SESSIONS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1']
 
@@ -70,30 +91,52 @@ def main():
     cli_args = get_cli_args()
     starting_timestamp = get_and_print_timestamp_when(sys.argv[0], "started")
 
+    # Names of the scratch folders in --temp of the sessions which failed or
+    # have not finished unpacking, which cleanup() keeps so that a rerun can
+    # resume their stages
+    cli_args.unfinished_scratch = set()
+
     # Set cleanup function to delete all temporary files if script crashes
     if cli_args.remove:
-        set_to_cleanup_on_crash(cli_args.temp)
+        set_to_cleanup_on_crash(cli_args.temp, cli_args.unfinished_scratch)
 
     # Before running any different scripts, validate user's NDA credentials and
     # use them to make NDA token
     #make_nda_token(cli_args)
 
+    # Sessions which failed to unpack, so that the wrapper can report them and
+    # exit with an error after running every step for the other sessions
+    cli_args.failed_sessions = []
+
     # Run all steps sequentially, starting at the one specified by the user
     started = False
     for step in STEP_NAMES:
         if step == cli_args.start_at:
             started = True
-        if started:
+        if started and cli_args.stream and step == "unpack_and_setup" \
+                and cli_args.start_at != step:
+            print("\nSkipping the {} step because every session was already "
+                  "unpacked while downloading.".format(step))
+        elif started:
             get_and_print_timestamp_when("The {} step".format(step),
                                          "started")
-            globals()[step](cli_args)
+            with measure(cli_args.metrics, step):
+                globals()[step](cli_args)
             get_and_print_timestamp_when("The {} step".format(step),
                                          "finished")
+            if cli_args.plan_only and step == "download_nda_data":
+                break
     print(starting_timestamp)
     get_and_print_timestamp_when(sys.argv[0], "finished")
+    for subject, session_name in cli_args.failed_sessions:
+        print("Failed to unpack and setup {} ses-{}. See the state database "
+              "and metrics for which stage failed.".format(subject,
+                                                           session_name))
 
-    # Finally, delete temporary files and end script with success exit code
-    cleanup(cli_args.temp, 0)
+    # Finally, delete temporary files and end script with an exit code that
+    # says whether every session was unpacked
+    cleanup(cli_args.temp, 1 if cli_args.failed_sessions else 0,
+            cli_args.unfinished_scratch)
 
 
 def get_and_print_timestamp_when(script, did_what):
@@ -185,6 +228,15 @@ def get_cli_args():
               "the NDA. By default, this script will use {} as the QC "
               "spreadsheet.".format(SPREADSHEET_QC))
     )
+    parser.add_argument(
+        "--qc-csv",
+        dest="qc_csv",
+        help=("Path to the reformatted QC spreadsheet to download the "
+              "subjects' files from. Use this with --start_at to reuse a "
+              "spreadsheet which another run reformatted. By default, the "
+              "{} file in the --temp folder is used."
+              .format(os.path.basename(SPREADSHEET_DOWNLOAD)))
+    )
     parser.add_argument(
         "-p",
         "--package_id",
@@ -215,9 +267,10 @@ def get_cli_args():
         choices=SESSIONS,
         nargs="+",
         dest="sessions",
-        default=SESSIONS,
         help=("List of sessions for each subject to download. The default is "
-             "to download all sessions for each subject. "
+             "to download all sessions for each subject. If this is given, "
+             "then only these sessions are unpacked; otherwise every "
+             "downloaded session is. "
              "The possible selections are {}".format(SESSIONS))
 )    
 
@@ -234,13 +287,112 @@ def get_cli_args():
              "The possible selections are {}".format(MODALITIES))
 )    
 
+    # Optional: Number of sessions to unpack and setup at the same time
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=("Number of subject sessions to unpack and setup in parallel. "
+              "Each session gets its own scratch directory inside --temp, "
+              "and if this is more than 1, each session's output is written "
+              "to its own log file in --temp instead of the terminal. "
+              "By default, sessions are processed one at a time.")
+    )
+
+    # Optional: Number of each session's .tgz files to unpack at once
+    parser.add_argument(
+        "--untar-jobs",
+        type=int,
+        dest="untar_jobs",
+        help=("Number of each subject session's .tgz files to unpack at "
+              "once. By default, this is the number of CPUs divided by "
+              "--jobs.")
+    )
+    parser.add_argument(
+        "--pigz-min-mb",
+        type=float,
+        dest="pigz_min_mb",
+        help=("Unpack .tgz files bigger than this many MB with pigz, which "
+              "decompresses with more than one thread, if it is installed. "
+              "By default, pigz is not used.")
+    )
+
+    # Optional: How to stage each session's .tgz files before unpacking them
+    parser.add_argument(
+        "--staging",
+        choices=STAGING_MODES,
+        default="auto",
+        help=("stream to unpack each session's .tgz files straight from the "
+              "--download folder, or copy to copy them into its scratch "
+              "directory first. By default (auto), each session measures "
+              "whether the --download folder's filesystem is slow enough at "
+              "small reads that copying is faster, and streams otherwise.")
+    )
+
+    # Optional: Number of sessions to download at the same time
+    parser.add_argument(
+        "--parallel-downloads",
+        type=int,
+        default=1,
+        dest="parallel_downloads",
+        help=("Number of subject sessions to download in parallel, each with "
+              "its own downloadcmd process. If this is more than 1, each "
+              "session's downloadcmd output is written to a download.log file "
+              "in its download folder. By default, sessions are downloaded "
+              "one at a time.")
+    )
+
+    # Optional: Number of sessions to download with each downloadcmd call
+    parser.add_argument(
+        "--download-batch-size",
+        type=int,
+        default=1,
+        dest="download_batch_size",
+        help=("Number of subject sessions to download with each downloadcmd "
+              "call, so that downloadcmd starts and authenticates once per "
+              "batch instead of once per session. By default, each session "
+              "is downloaded by its own downloadcmd call.")
+    )
+
+    # Optional: Unpack each session as soon as it finishes downloading
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=("Unpack and setup each subject session as soon as it finishes "
+              "downloading, instead of waiting for every session to finish "
+              "downloading first. --jobs sessions are unpacked at a time.")
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        dest="queue_depth",
+        help=("With --stream, the most downloaded sessions which can be "
+              "waiting to be unpacked or being unpacked at once. Downloading "
+              "pauses until there is room, so this caps how much raw data is "
+              "on disk. By default, this is the same as --jobs.")
+    )
+
+    # Optional: Only report what would be downloaded
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        dest="plan_only",
+        help=("Stop after planning the download instead of downloading. The "
+              "QC spreadsheet is still reformatted, then the number of files "
+              "per modality and session, their estimated size and download "
+              "time, and the subjects with no usable series are printed. "
+              "The --download and --output folders are not made and "
+              "downloadcmd is never run.")
+    )
+
     # Optional: During unpack_and_setup, remove unprocessed data
     parser.add_argument(
         "-r",
         "--remove",
         action="store_true",
-        help=("After each subject's data has finished conversion, "
-              "removed that subject's unprocessed data.")
+        help=("After each subject session's data has finished conversion, "
+              "remove that session's unprocessed data.")
     )
 
     # Optional: Pick a step to start at, ignore previous ones, and then run
@@ -268,6 +420,35 @@ def get_cli_args():
               "doesn't already exist.".format(TEMP_FILES_DIR))
     )
 
+    # Optional: Get path to database recording which subject sessions are done
+    parser.add_argument(
+        "--state-db",
+        dest="state_db",
+        help=("Path to SQLite database recording the status of every subject "
+              "session in every step, so that a rerun skips the sessions "
+              "which already finished with the same inputs. By default, the "
+              "database will be created next to the --temp folder, at "
+              "<--temp>.state.db")
+    )
+    # Optional: Get path to file to log timing and resource use metrics into
+    parser.add_argument(
+        "--metrics",
+        help=("Path to a JSON Lines file to append one record to for every "
+              "step, every subject session's download and unpack_and_setup, "
+              "and every stage of unpack_stages.py. Each record has "
+              "the wall time, CPU time, peak RSS, bytes read and written, "
+              "and exit code. By default, the records are appended to "
+              "<--temp>.metrics.jsonl. Summarize them with "
+              "'python3 src/stage_metrics.py summary <file>'.")
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help=("Rerun every subject session, even if the --state-db says that "
+              "it already finished with the same inputs.")
+    )
+
     # Optional: Get NDA username and password
     parser.add_argument(
         "-u",
@@ -314,6 +495,24 @@ def validate_cli_args(args, parser):
     validate_dir_path(args.fsl_dir, parser)
     validate_dir_path(args.mre_dir, parser)
 
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer.")
+    if args.parallel_downloads < 1:
+        parser.error("--parallel-downloads must be a positive integer.")
+    if args.download_batch_size < 1:
+        parser.error("--download-batch-size must be a positive integer.")
+    if args.untar_jobs is None:
+        args.untar_jobs = max(1, (os.cpu_count() or 1) // args.jobs)
+    elif args.untar_jobs < 1:
+        parser.error("--untar-jobs must be a positive integer.")
+    if args.queue_depth is None:
+        args.queue_depth = args.jobs
+    elif args.queue_depth < 1:
+        parser.error("--queue-depth must be a positive integer.")
+    if args.plan_only and STEP_NAMES.index(args.start_at) \
+            > STEP_NAMES.index("download_nda_data"):
+        parser.error("--plan-only cannot start after download_nda_data.")
+
     # Validate and create config file's parent directory
     try:
         os.makedirs(os.path.dirname(args.config), exist_ok=True)
@@ -327,14 +526,34 @@ def validate_cli_args(args, parser):
             setattr(args, cli_arg, os.path.abspath(getattr(args, cli_arg)))
     except OSError:
         parser.error("Failed to convert {} to absolute path.".format(cli_arg))
-    try_to_create_and_prep_directory_at(args.download, DOWNLOAD_FOLDER, parser)
-    try_to_create_and_prep_directory_at(args.output, UNPACKED_FOLDER, parser)
+    if not args.plan_only:
+        try_to_create_and_prep_directory_at(args.download, DOWNLOAD_FOLDER,
+                                            parser)
+        try_to_create_and_prep_directory_at(args.output, UNPACKED_FOLDER,
+                                            parser)
     try_to_create_and_prep_directory_at(args.temp, TEMP_FILES_DIR, parser)
 
     # Ensure that the output folder path is formatted correctly:
     if args.output[-1] != "/":
         args.output += "/"
 
+    if not args.qc_csv:
+        args.qc_csv = os.path.join(args.temp,
+                                   os.path.basename(SPREADSHEET_DOWNLOAD))
+    args.qc_csv = os.path.abspath(args.qc_csv)
+
+    if not args.metrics:
+        args.metrics = os.path.normpath(args.temp) + ".metrics.jsonl"
+    args.metrics = os.path.abspath(args.metrics)
+
+    # Open (or create) the database of which subject sessions are done
+    if not args.state_db:
+        args.state_db = os.path.normpath(args.temp) + ".state.db"
+    try:
+        args.state = PipelineState(os.path.abspath(args.state_db))
+    except Exception:
+        parser.error("Could not open state database at " + args.state_db)
+
     return args
 
 
@@ -405,11 +624,14 @@ def try_to_create_and_prep_directory_at(folder_path, default_path, parser):
                     print("Error occurred while copying file.")
 
 
-def set_to_cleanup_on_crash(temp_dir):
+def set_to_cleanup_on_crash(temp_dir, keep):
     """
     Make it so that if the script crashes, all of the temporary files that it
     generated are deleted. signal.signal() checks if the script has crashed,
     and cleanup() deletes all of the temporary files.
+    :param temp_dir: Path to folder containing temporary files to delete.
+    :param keep: Set of the names of subfolders of temp_dir not to delete,
+    which can change until the script crashes
     :return: N/A
     """
     # Use local function as an intermediate because the signal module does
@@ -417,14 +639,14 @@ def set_to_cleanup_on_crash(temp_dir):
     # take the parameter (temp_dir) needed by the cleanup function. Run cleanup
     # function and exit with exit code 1 (failure)
     def call_cleanup_function(_signum, _frame):
-        cleanup(temp_dir, 1)
+        cleanup(temp_dir, 1, keep)
 
     # If this wrapper crashes, delete all temporary files
     signal.signal(signal.SIGINT, call_cleanup_function)
     signal.signal(signal.SIGTERM, call_cleanup_function)
 
 
-def cleanup(temp_dir, exit_code):
+def cleanup(temp_dir, exit_code, keep=()):
     """
     Function to delete all temp files created while running this script. This
     function will always run right before the wrapper terminates, whether or
@@ -432,11 +654,17 @@ def cleanup(temp_dir, exit_code):
     :param temp_dir: Path to folder containing temporary files to delete.
     :param exit_code: Code for this wrapper to return on exit. If cleanup() is
     called when wrapper finishes successfully, then 0; otherwise 1.
+    :param keep: Names of subfolders of temp_dir not to delete, like the
+    scratch folders of sessions which did not finish unpacking
     :return: N/A
     """
     # Delete all temp folder subdirectories, but not the README in temp folder
+    # or the scratch folders which a rerun can resume from
     for temp_dir_subdir in os.scandir(temp_dir):
-        if temp_dir_subdir.is_dir():
+        if temp_dir_subdir.name in keep:
+            print("Keeping {} so that a rerun can resume it."
+                  .format(temp_dir_subdir.path))
+        elif temp_dir_subdir.is_dir():
             shutil.rmtree(temp_dir_subdir.path)
 
     # Inform user that temporary files were deleted, then terminate wrapper
@@ -552,57 +780,54 @@ def reformat_fastqc_spreadsheet(cli_args):
     :param cli_args: argparse namespace containing all CLI arguments.
     :return: N/A
     """   
-    # Import QC data from .csv file
-    with open(cli_args.qc) as qc_file:
-        all_qc_data = pd.read_csv(
-            qc_file, encoding="utf-8-sig", sep=",|\t", engine="python",
-            index_col=False, header=0, skiprows=[1] # Skip row 2 (description)
-        )
-    
-    # Remove quotes from values and convert int-strings to ints
-    all_qc_data = all_qc_data.applymap(lambda x: x.strip('"')).apply(
-        lambda x: x.apply(lambda y: int(y) if y.isnumeric() else y)
-    )
-    
-    # Remove quotes from headers
-    new_headers = []
-    for header in all_qc_data.columns: # data.columns is your list of headers
-        header = header.strip('"') # Remove the quotes off each header
-        new_headers.append(header) # Save the new strings without the quotes
-    all_qc_data.columns = new_headers # Replace the old headers with the new list
+    # Skip this step if the QC spreadsheet hasn't changed since it was last
+    # reformatted by this version of the code
+    step = "reformat_fastqc_spreadsheet"
+    fingerprint = fingerprint_strings((SPREADSHEET_FORMAT_VERSION,
+                                       fingerprint_files([cli_args.qc])))
+    if (not cli_args.force and os.path.exists(SPREADSHEET_DOWNLOAD) and
+            cli_args.state.is_done("", "", step, fingerprint)):
+        print("{} is unchanged since it was reformatted; skipping."
+              .format(cli_args.qc))
+        return
+    cli_args.state.start("", "", step, fingerprint)
+
+    qc_data = write_reformatted_spreadsheet(cli_args.qc, SPREADSHEET_DOWNLOAD)
+
+    # Cache the reformatted spreadsheet so later steps can load parts of it
+    write_qc_cache(SPREADSHEET_DOWNLOAD, qc_data)
+    cli_args.state.finish("", "", step, 0)
+
+
+def write_reformatted_spreadsheet(qc_path, csv_path):
+    """
+    Reformat the QC spreadsheet into the CSV that the download step reads.
+    :param qc_path: Path to the abcd_fastqc01.txt QC spreadsheet
+    :param csv_path: Path to the reformatted .csv file to write
+    :return: pandas.DataFrame of the strings written to csv_path
+    """
+    # Import QC data from .csv file, keeping every value as a string
+    all_qc_data = read_fastqc_spreadsheet(qc_path)
     print(all_qc_data.columns)
 
     # Select QC data that is usable (ftq_usable==1) and complete (ftq_complete==1)
-    qc_data = fix_split_col(all_qc_data.loc[(all_qc_data['ftq_usable'] == 1) & (all_qc_data['ftq_complete'] == 1)])
-
-    def get_img_desc(row):
-        """
-        :param row: pandas.Series with a column called "ftq_series_id"
-        :return: String with the image_description of that row
-        """
-        return row.ftq_series_id.split("_")[2]
-
-    # Add extra column by splitting data from other column
-    image_desc_col = qc_data.apply(get_img_desc, axis=1)
-    qc_data = qc_data.assign(**{'image_description': image_desc_col.values})
-
-    def get_img_timestamp(row):
-        """
-        :param row: pandas.Series with a column called "ftq_series_id"
-        :return: String with the image_description of that row
-        """
-        return row.ftq_series_id.split("_")[3]
-
-    # Add extra column by splitting data from other column
-    image_timestamp_col = qc_data.apply(get_img_timestamp, axis=1)
-    qc_data = qc_data.assign(**{'image_timestamp': image_timestamp_col.values})
+    usable = normalize_int_strings(all_qc_data['ftq_usable']) == "1"
+    complete = normalize_int_strings(all_qc_data['ftq_complete']) == "1"
+    qc_data = all_qc_data.loc[usable & complete]
+    qc_data = qc_data.assign(**{col: normalize_int_strings(qc_data[col])
+                                for col in qc_data.columns})
+
+    # Add extra columns by splitting data from ftq_series_id column
+    series_id_parts = qc_data["ftq_series_id"].str.split("_")
+    qc_data = qc_data.assign(image_description=series_id_parts.str[2],
+                             image_timestamp=series_id_parts.str[3])
 
     # remove "Replaced" rows from download list
     qc_data = qc_data[qc_data['ftq_recall_reason'] != 'Replaced']
 
 
     # Change column names for good_bad_series_parser to use; then save to .csv
-    qc_data.rename({
+    qc_data = qc_data.rename({
         "ftq_usable": "QC", "subjectkey": "pGUID", "visit": "EventName",
         "abcd_compliant": "ABCD_Compliant", "interview_age": "SeriesTime",
         "comments_misc": "SeriesDescription", "file_source": "image_file"
@@ -611,39 +836,79 @@ def reformat_fastqc_spreadsheet(cli_args):
         'EventName',
         'image_description',
         'image_timestamp'
-    ]).to_csv(SPREADSHEET_DOWNLOAD, index=False)
-
-
-def fix_split_col(qc_df):
-    """
-    Because qc_df's ftq_notes column contains values with commas, it is split
-    into multiple columns on import. This function puts them back together.
-    :param qc_df: pandas.DataFrame with all QC data
-    :return: pandas.DataFrame which is qc_df, but with the last column(s) fixed
-    """
-    def trim_end_columns(row):
-        """
-        Local function to check for extra columns in a row, and fix them
-        :param row: pandas.Series which is one row in the QC DataFrame
-        :param columns: List of strings where each is the name of a column in
-        the QC DataFrame, in order
-        :return: N/A
-        """
-        ix = int(row.name)
-        if not pd.isna(qc_df.at[ix, columns[-1]]):
-            qc_df.at[ix, columns[-3]] += " " + qc_df.at[ix, columns[-2]]
-            qc_df.at[ix, columns[-2]] = qc_df.at[ix, columns[-1]]
-
-    # Keep checking and dropping the last column of qc_df until it's valid
-    columns = qc_df.columns.values.tolist()
-    last_col = columns[-1]
-    while any(qc_df[last_col].isna()):
-        qc_df.apply(trim_end_columns, axis="columns")
-        print("Dropping '{}' column because it has NaNs".format(last_col))
-        qc_df = qc_df.drop(last_col, axis="columns")
-        columns = qc_df.columns.values.tolist()
-        last_col = columns[-1]
-    return qc_df
+    ])
+    qc_data.to_csv(csv_path, index=False)
+    return qc_data
+
+
+def read_fastqc_spreadsheet(qc_path):
+    """
+    Read the QC spreadsheet into a DataFrame of strings without quotes. Rows
+    whose values are all simply quoted are parsed by pandas' C parser. Every
+    other row is parsed on its own by the csv module, so that one stray quote
+    cannot swallow the rows after it, and then repaired by fix_split_col.
+    :param qc_path: Path to the abcd_fastqc01.txt QC spreadsheet
+    :return: pandas.DataFrame with all QC data as strings
+    """
+    with open(qc_path, encoding="utf-8-sig") as qc_file:
+        lines = qc_file.read().splitlines()
+    headers = next(csv.reader([lines[0]], delimiter="\t"))
+    rows = [row for row in lines[2:] if row]  # Skip row 2 (description)
+
+    # A row is simple if every value in it is wrapped in one pair of quotes
+    is_simple = [row[:1] == '"' and row[-1:] == '"' and
+                 row.count('"') == 2 * row.count('"\t"') + 2 for row in rows]
+    simple_ixs = [ix for ix, simple in enumerate(is_simple) if simple]
+    all_qc_data = pd.read_csv(
+        io.BytesIO("\n".join(rows[ix] for ix in simple_ixs).encode("utf-8")),
+        sep="\t", names=headers, header=None, dtype=str, na_filter=False,
+        index_col=False
+    ).set_axis(simple_ixs)
+
+    other_ixs = [ix for ix, simple in enumerate(is_simple) if not simple]
+    if other_ixs:
+        notes_ix = (headers.index("ftq_notes") if "ftq_notes" in headers
+                    else len(headers) - 1)
+        other_rows = pd.DataFrame([fix_split_col(
+            next(csv.reader([rows[ix]], delimiter="\t")), len(headers),
+            notes_ix
+        ) for ix in other_ixs], index=other_ixs, columns=headers)
+        all_qc_data = pd.concat([all_qc_data, other_rows]).sort_index()
+    return all_qc_data
+
+
+def normalize_int_strings(values):
+    """
+    Write every int-string the way int() would, e.g. "007" as "7"
+    :param values: pandas.Series of strings
+    :return: pandas.Series of strings, with int-strings normalized
+    """
+    # Only int-strings with leading zeros change, and most columns have none
+    leading_zeros = values.str.fullmatch(r"0[0-9]+")
+    if not leading_zeros.any():
+        return values
+    stripped = values[leading_zeros].str.lstrip("0")
+    values = values.copy()
+    values[leading_zeros] = stripped.where(stripped != "", "0")
+    return values
+
+
+def fix_split_col(values, num_cols, notes_ix):
+    """
+    Because ftq_notes values are free text, a row can have more values than
+    there are columns if its notes were split apart. This function puts them
+    back together in one pass, so a row costs the same however split it is.
+    :param values: List of strings, the values in one row of the QC data
+    :param num_cols: Integer, how many columns the QC data has
+    :param notes_ix: Integer, index of the ftq_notes column
+    :return: List of num_cols strings which is values, but with notes fixed
+    """
+    extra = len(values) - num_cols
+    if extra > 0:
+        values[notes_ix:notes_ix + extra + 1] = [
+            "\t".join(values[notes_ix:notes_ix + extra + 1])
+        ]
+    return values + [""] * (num_cols - len(values))
 
 
 def download_nda_data(cli_args):
@@ -657,27 +922,128 @@ def download_nda_data(cli_args):
     """
     subprocess.check_call(("python3", "--version"))
     print(cli_args.modalities)
-    subprocess.check_call(("python3", 
-                            SERIES_TABLE_PARSER,
-                            "--qc-csv", os.path.join(cli_args.temp, os.path.basename(SPREADSHEET_DOWNLOAD)),
-                            "--download-dir", cli_args.download, 
-                            "--subject-list", cli_args.subject_list,
-                            "--sessions", ','.join(cli_args.sessions),
-                            "--modalities", ','.join(cli_args.modalities),
-                            "--downloadcmd", cli_args.downloadcmd,
-                            "--package-id", cli_args.package_id))
+    download_cmd = ["python3", 
+                    SERIES_TABLE_PARSER,
+                    "--qc-csv", cli_args.qc_csv,
+                    "--download-dir", cli_args.download, 
+                    "--subject-list", cli_args.subject_list,
+                    "--sessions", ','.join(cli_args.sessions or SESSIONS),
+                    "--modalities", ','.join(cli_args.modalities),
+                    "--downloadcmd", cli_args.downloadcmd,
+                    "--package-id", cli_args.package_id,
+                    "--state-db", cli_args.state.db_path,
+                    "--parallel-downloads", str(cli_args.parallel_downloads),
+                    "--batch-size", str(cli_args.download_batch_size)]
+    if cli_args.force:
+        download_cmd.append("--force")
+    download_cmd += ["--metrics", cli_args.metrics]
+    if cli_args.plan_only:
+        subprocess.check_call(download_cmd + ["--plan-only"])
+    elif cli_args.stream:
+        download_and_unpack_nda_data(cli_args, download_cmd + ["--stream"])
+    else:
+        subprocess.check_call(download_cmd)
+
+
+def download_and_unpack_nda_data(args, download_cmd):
+    """
+    Run aws_downloader.py and unpack and setup each subject session as soon as
+    it finishes downloading. aws_downloader.py prints a STREAM_READY line for
+    each finished session, then waits for a reply on stdin before downloading
+    the next one; the reply is only sent once fewer than --queue-depth
+    downloaded sessions are waiting to be unpacked or being unpacked.
+    :param args: argparse namespace containing all CLI arguments.
+    :param download_cmd: List of strings, the aws_downloader.py command to run
+    :return: N/A
+    """
+    slots = threading.BoundedSemaphore(args.queue_depth)
+
+    def unpack_downloaded_session(subject, session_name, session_dir):
+        try:
+            # If user said to, delete this session's raw downloaded files now
+            # that they have been converted and copied. Keep them if it
+            # failed, so that it can be unpacked again.
+            if unpack_and_setup_session(args, subject, session_name,
+                                        session_dir) == 0 and args.remove:
+                shutil.rmtree(session_dir)
+        finally:
+            slots.release()
+
+    downloader = subprocess.Popen(download_cmd, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  universal_newlines=True, bufsize=1)
+    unpacking = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for line in downloader.stdout:
+            if not line.startswith(STREAM_READY):
+                print(line, end="")
+                continue
+            subject, _, session_dir = line.rstrip("\n").split("\t")[1:]
+            session_name = get_session_name(session_dir)
+            if session_name and not is_already_unpacked(
+                    args, subject, session_name, session_dir
+                ):
+                slots.acquire()  # Wait until there is room in the queue
+                unpacking.append(pool.submit(unpack_downloaded_session,
+                                             subject, session_name,
+                                             session_dir))
+
+            # Tell aws_downloader.py to download the next session
+            downloader.stdin.write("\n")
+            downloader.stdin.flush()
+        downloader.stdin.close()
+        downloader.wait()
+    for finished in unpacking:
+        finished.result()  # Raise any error from the workers
+    if downloader.returncode != 0:
+        raise subprocess.CalledProcessError(downloader.returncode,
+                                            download_cmd)
 
 
 def unpack_and_setup(args):
     """
-    Run unpack_and_setup.sh script repeatedly to unpack and setup the newly
-    downloaded NDA data files (every .tgz file descendant of the NDA data dir)
+    Run unpack_stages.py repeatedly to unpack and setup the newly
+    downloaded NDA data files (every .tgz file descendant of the NDA data dir).
+    Up to --jobs sessions are unpacked at the same time.
     :param args: All arguments entered by the user from the command line. The
     specific arguments used by this function are fsl_dir, mre_dir, --output,
-    --download, --temp, and --remove.
+    --download, --temp, --sessions, --jobs, --force, and --remove.
     :return: N/A
     """
+    # Skip every session which was already unpacked from the same .tgz files
+    sessions = [session for session in get_sessions_to_unpack(args)
+                if not is_already_unpacked(args, *session)]
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        running = {pool.submit(unpack_and_setup_session, args, *session):
+                   session for session in sessions}
+        for finished in as_completed(running):
+            subject, _, session_dir = running[finished]
+
+            # If user said to, delete each session's raw downloaded files
+            # after its data has been converted and copied, then the subject's
+            # folder once it is empty. Keep them if the session failed, so
+            # that it can be unpacked again. Only this run's sessions are
+            # deleted, because other runs may be unpacking other sessions of
+            # the same subject.
+            if args.remove and finished.result() == 0:
+                shutil.rmtree(session_dir)
+                try:
+                    os.rmdir(os.path.join(args.download, subject))
+                except OSError:
+                    pass
+
 
+def get_sessions_to_unpack(args):
+    """
+    Find every downloaded subject session which has .tgz files to unpack,
+    only in --sessions if it was given, like array_job_planner.py does for
+    each shard.
+    :param args: argparse namespace containing all CLI arguments. This
+    function only uses --download, --subject-list, and --sessions.
+    :return: List of (subject, session_name, session_dir_path) tuples, in the
+             same order that they would be unpacked serially
+    """
     # Create list of all subject directories for setup
     subject_dir_paths = {}
     if args.subject_list:
@@ -697,38 +1063,127 @@ def unpack_and_setup(args):
             if subject.is_dir():
                 subject_dir_paths[subject.name] = subject.path
 
-    # Loop through each subject and setup all sessions for that subject
+    sessions = []
     for subject, subject_dir in subject_dir_paths.items():
         for session_dir in os.scandir(subject_dir):
-            if session_dir.is_dir():
-                tgz_dir = os.path.join(session_dir.path, 'image03')
-                for tgz in os.scandir(tgz_dir):
-                    if tgz:
-                        # Get session ID from some (arbitrary) .tgz file in
-                        # session folder
-                        session_name = tgz.name.split("_")[1]
-                        print('Unpacking and setting up tgzs for {} {} located here: {}'.format(subject, session_name, tgz_dir))
-                        print("Running: ", UNPACK_AND_SETUP, subject, "ses-" + session_name, session_dir.path, args.output, args.temp, args.fsl_dir, args.mre_dir)
-
-                        # Unpack/setup the data for this subject/session
-                        subprocess.check_call((
-                            UNPACK_AND_SETUP,
-                            subject,
-                            "ses-" + session_name,
-                            session_dir.path,
-                            args.output,
-                            args.temp,
-                            args.fsl_dir,
-                            args.mre_dir
-                        ))
-
-                        # If user said to, delete all the raw downloaded
-                        # files for each subject after that subject's data
-                        # has been converted and copied
-                        if args.remove:
-                            shutil.rmtree(os.path.join(args.download,
-                                                       subject))
-                        break
+            if session_dir.is_dir() and (args.sessions is None or
+                                         session_dir.name in args.sessions):
+                session_name = get_session_name(session_dir.path)
+                if session_name:
+                    sessions.append((subject, session_name, session_dir.path))
+    return sessions
+
+
+def get_session_name(session_dir):
+    """
+    Get session ID from some (arbitrary) .tgz file in session folder
+    :param session_dir: Path to the downloaded session folder
+    :return: String, the session ID without the "ses-" prefix, or None if the
+             session folder has no .tgz files
+    """
+    tgz_dir = os.path.join(session_dir, 'image03')
+    if os.path.isdir(tgz_dir):
+        for tgz in os.scandir(tgz_dir):
+            if tgz:
+                return tgz.name.split("_")[1]
+    return None
+
+
+def is_already_unpacked(args, subject, session_name, session_dir):
+    """
+    :param args: argparse namespace containing all CLI arguments.
+    :param subject: String, the full BIDS subject ID (sub-SUBJECTID)
+    :param session_name: String, the session ID without the "ses-" prefix
+    :param session_dir: Path to the downloaded session folder to unpack
+    :return: True if the --state-db says that this session was already
+             unpacked from the same .tgz files and --force was not given
+    """
+    done = not args.force and args.state.is_done(
+        subject, session_name, "unpack_and_setup",
+        get_unpack_fingerprint(args, session_dir)
+    )
+    if done:
+        print("{} ses-{} was already unpacked and setup; skipping."
+              .format(subject, session_name))
+    return done
+
+
+def get_unpack_fingerprint(args, session_dir):
+    """
+    :param args: argparse namespace containing all CLI arguments. This
+    function only uses --output and --modalities.
+    :param session_dir: Path to the downloaded session folder to unpack
+    :return: String fingerprinting the .tgz files to unpack, the output dir,
+             and the modalities to unpack if they are not all of them
+    """
+    tgz_dir = os.path.join(session_dir, 'image03')
+    inputs = (args.output, fingerprint_files(
+        tgz.path for tgz in os.scandir(tgz_dir)
+    ))
+    if sorted(args.modalities) != sorted(MODALITIES):
+        inputs += (",".join(sorted(args.modalities)), )
+    return fingerprint_strings(inputs)
+
+
+def unpack_and_setup_session(args, subject, session_name, session_dir):
+    """
+    Unpack and setup the data for one subject session by running
+    unpack_stages.py with its own scratch directory inside --temp. Each of its
+    stages is recorded in the state database, so a rerun with the same inputs
+    resumes after the last stage which finished. If more than one job is
+    running, then that session's output goes to its own log.
+    :param args: argparse namespace containing all CLI arguments.
+    :param subject: String, the full BIDS subject ID (sub-SUBJECTID)
+    :param session_name: String, the session ID without the "ses-" prefix
+    :param session_dir: Path to the downloaded session folder to unpack
+    :return: Integer, the exit code of unpack_stages.py; 0 means success
+    """
+    session = "ses-" + session_name
+    fingerprint = get_unpack_fingerprint(args, session_dir)
+    print('Unpacking and setting up tgzs for {} {} located here: {}'.format(
+        subject, session_name, os.path.join(session_dir, 'image03')
+    ))
+    unpack_cmd = (sys.executable, UNPACK_STAGES, subject, session,
+                  session_dir, args.output, args.temp, args.fsl_dir,
+                  args.mre_dir, "--state-db", args.state.db_path,
+                  "--fingerprint", fingerprint)
+    print("Running: ", *unpack_cmd)
+    args.state.start(subject, session_name, "unpack_and_setup", fingerprint)
+
+    # unpack_stages.py uses <--temp>/<subject>_<session> as scratch, which
+    # is kept unless it finishes, so a rerun can skip its finished stages
+    scratch_name = "_".join((subject, session))
+    args.unfinished_scratch.add(scratch_name)
+    unpack_env = dict(os.environ, **{METRICS_ENV_VAR: args.metrics,
+                                     STAGING_ENV_VAR: args.staging,
+                                     JOBS_ENV_VAR: str(args.untar_jobs),
+                                     MODALITIES_ENV_VAR:
+                                         ",".join(args.modalities)})
+    if args.pigz_min_mb is not None:
+        unpack_env[PIGZ_ENV_VAR] = str(args.pigz_min_mb)
+    if args.jobs == 1:
+        exit_code, metrics = run_and_measure(unpack_cmd, "unpack_and_setup",
+                                             subject, session, env=unpack_env)
+    else:
+        log_path = os.path.join(args.temp, "{}_{}_unpack_and_setup.log"
+                                           .format(subject, session))
+        with open(log_path, "w") as log_file:
+            exit_code, metrics = run_and_measure(
+                unpack_cmd, "unpack_and_setup", subject, session,
+                env=unpack_env, stdout=log_file, stderr=subprocess.STDOUT
+            )
+        print("Finished {} {} with exit code {}. Log: {}".format(
+            subject, session, exit_code, log_path
+        ))
+    write_record(args.metrics, metrics)
+    args.state.finish(subject, session_name, "unpack_and_setup", exit_code)
+    if exit_code == 0:
+        args.unfinished_scratch.discard(scratch_name)
+    else:
+        print("Failed to unpack and setup {} {} (exit code {}). Going on "
+              "with the other sessions.".format(subject, session, exit_code))
+        args.failed_sessions.append((subject, session_name))
+    return exit_code
 
 
 def correct_jsons(cli_args):
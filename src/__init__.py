@@ -1,2 +1 @@
-from src.nda_aws_token_maker import *
 from src.nda_aws_token_generator import *
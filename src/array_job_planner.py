@@ -0,0 +1,363 @@
+#! /usr/bin/env python3
+
+"""
+ABCD to BIDS cluster array-job planner
+Splits one abcd2bids.py run into balanced shards that can be submitted as a
+SLURM array job, run locally for testing, and merged back together.
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from qc_cache import load_qc_data
+except ImportError:
+    from src.qc_cache import load_qc_data
+
+#######################################
+# Three modes, run in this order:
+#   plan:  Weigh every subject session by its number of QC-passing series,
+#          split the sessions into balanced shards, and write a manifest, one
+#          launch script and one subject list per session per shard, and a
+#          SLURM array job script
+#   local: Run every shard's launch script from a manifest on this machine
+#   merge: Combine each shard's *_download_log.csv into one log and report
+#
+#######################################
+
+prog_descrip = 'Plan, run, and merge sharded abcd2bids.py array jobs'
+
+ABCD2BIDS = os.path.join(os.path.dirname(os.path.dirname(
+                         os.path.abspath(__file__))), "abcd2bids.py")
+YEARS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1']
+MANIFEST_NAME = 'manifest.json'
+ARRAY_SCRIPT_NAME = 'array_job.sh'
+
+# Columns of the *_download_log.csv files written by aws_downloader.py
+DOWNLOAD_LOG_COLS = ['subject', 'session', 'has_t1', 'has_t2', 'has_sefm',
+                     'has_rsfmri', 'has_mid', 'has_sst', 'has_nback',
+                     'has_dti']
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description=prog_descrip)
+    modes = parser.add_subparsers(dest='mode')
+    modes.required = True
+
+    plan = modes.add_parser(
+        'plan',
+        help='Split the sessions of a subject list into balanced shards and '
+             'write an array job manifest. Any arguments after "--" are '
+             'passed to abcd2bids.py in every shard.'
+    )
+    plan.add_argument(
+        '-q',
+        '--qc-csv',
+        dest='qc_csv',
+        required=True,
+        help='Path to abcd_fastqc01_reformatted.csv, made by the '
+             'reformat_fastqc_spreadsheet step of abcd2bids.py. Every shard '
+             'downloads from it.'
+    )
+    plan.add_argument(
+        '-l',
+        '--subject-list',
+        dest='subject_list',
+        required=True,
+        help='Path to a text file containing a list of subject IDs'
+    )
+    plan.add_argument(
+        '-y',
+        '--sessions',
+        dest='year_list',
+        default=YEARS,
+        help='Comma-separated list of sessions to split into shards. '
+             'Default: {}'.format(','.join(YEARS))
+    )
+    plan.add_argument(
+        '-n',
+        '--shards',
+        type=int,
+        required=True,
+        help='Number of shards (array job tasks) to split the subjects into'
+    )
+    plan.add_argument(
+        '-o',
+        '--output-dir',
+        dest='output_dir',
+        required=True,
+        help='Directory to write the manifest, array job script, and one '
+             'shard_### subdirectory per shard into'
+    )
+    plan.add_argument(
+        'abcd2bids_args',
+        nargs=argparse.REMAINDER,
+        help='Arguments for abcd2bids.py, except --subject-list, '
+             '--sessions, --temp, and --qc-csv, which are set per shard'
+    )
+
+    local = modes.add_parser(
+        'local', help='Run every shard in a manifest on this machine'
+    )
+    local.add_argument('manifest', help='Path to manifest.json')
+    local.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of shards to run at the same time. Default: 1'
+    )
+
+    merge = modes.add_parser(
+        'merge',
+        help="Combine every shard's download log into one log and report"
+    )
+    merge.add_argument('manifest', help='Path to manifest.json')
+
+    return parser
+
+
+def main(argv=sys.argv):
+    parser = generate_parser()
+    args = parser.parse_args(argv[1:])
+
+    if args.mode == 'plan':
+        if args.shards < 1:
+            parser.error('--shards must be a positive integer.')
+        year_list = args.year_list
+        if isinstance(year_list, str):
+            year_list = year_list.split(',')
+        abcd2bids_args = args.abcd2bids_args
+        if abcd2bids_args and abcd2bids_args[0] == '--':
+            abcd2bids_args = abcd2bids_args[1:]
+        manifest = plan_shards(args.qc_csv, args.subject_list, year_list,
+                               args.shards, args.output_dir, abcd2bids_args)
+        print('Wrote {} shards to {}'.format(len(manifest['shards']),
+                                             args.output_dir))
+        for shard in manifest['shards']:
+            print('  shard {}: {} sessions of {} subjects, {} series'.format(
+                shard['index'], shard['num_sessions'], shard['num_subjects'],
+                shard['weight']))
+
+    elif args.mode == 'local':
+        exit_codes = run_local(args.manifest, args.jobs)
+        failed = [ix for ix, code in enumerate(exit_codes) if code != 0]
+        if failed:
+            print('Shards that failed: {}'.format(failed))
+            return 1
+
+    elif args.mode == 'merge':
+        merge_download_logs(args.manifest)
+
+    return 0
+
+
+def get_session_weights(qc_csv, subject_list, year_list):
+    """
+    Weigh each subject session by how many QC-passing series it has, since
+    that is roughly how much there is to download and unpack.
+    :param qc_csv: Path to abcd_fastqc01_reformatted.csv
+    :param subject_list: List of subject ID strings
+    :param year_list: List of session (EventName) strings
+    :return: Dictionary mapping each (subject ID, session) tuple to its number
+             of series
+    """
+    uid_start = "INV"
+    series_df = load_qc_data(qc_csv, ['NDAR_INV' + sub.split(uid_start, 1)[1]
+                                      for sub in subject_list], year_list,
+                             ['pGUID', 'EventName', 'QC'])
+    series_counts = series_df[series_df['QC'] == 1.0].groupby(
+        ['pGUID', 'EventName']).size()
+
+    return {(sub, year): int(series_counts.get(
+                ('NDAR_INV' + sub.split(uid_start, 1)[1], year), 0))
+            for sub in subject_list for year in year_list}
+
+
+def split_into_shards(weights, num_shards):
+    """
+    Greedily give each subject session, heaviest first, to the lightest shard
+    so far.
+    :param weights: Dictionary mapping each (subject ID, session) tuple to its
+                    weight
+    :param num_shards: Number of shards to split the subject sessions into
+    :return: List of num_shards lists of (subject ID, session) tuples
+    """
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0, ix) for ix in range(num_shards)]
+    for sub in sorted(weights, key=lambda s: (-weights[s], s)):
+        total, ix = heapq.heappop(heap)
+        shards[ix].append(sub)
+        heapq.heappush(heap, (total + weights[sub], ix))
+    return shards
+
+
+def plan_shards(qc_csv, subject_list_path, year_list, num_shards, output_dir,
+                abcd2bids_args):
+    """
+    Write one launch script per shard, which runs abcd2bids.py once for each
+    session in the shard with a subject list of that session's subjects, a
+    SLURM array job script to launch them, and a manifest describing all of
+    it.
+    :param qc_csv: Path to abcd_fastqc01_reformatted.csv
+    :param subject_list_path: Path to text file with one subject ID per line
+    :param year_list: List of session (EventName) strings
+    :param num_shards: Number of shards to split the subjects into
+    :param output_dir: Directory to write everything into
+    :param abcd2bids_args: List of arguments to pass to abcd2bids.py
+    :return: Dictionary with the contents of the manifest
+    """
+    with open(subject_list_path) as infile:
+        subject_list = [sub.strip() for sub in infile if sub.strip()]
+    weights = get_session_weights(qc_csv, subject_list, year_list)
+    shards = split_into_shards(weights, min(num_shards, len(weights)))
+
+    # Every shard already has the reformatted spreadsheet, so unless the user
+    # said otherwise, skip straight to the download step
+    if not any(arg in ('-s', '--start_at') or arg.startswith('--start_at=')
+               for arg in abcd2bids_args):
+        abcd2bids_args = abcd2bids_args + ['--start_at', 'download_nda_data']
+
+    qc_csv = os.path.abspath(qc_csv)
+    output_dir = os.path.abspath(output_dir)
+    manifest = {'qc_csv': qc_csv, 'sessions': year_list, 'shards': []}
+    for ix, shard_sessions in enumerate(shards):
+        shard_dir = os.path.join(output_dir, 'shard_{:03d}'.format(ix))
+        os.makedirs(shard_dir, exist_ok=True)
+
+        # One abcd2bids.py run per session in this shard, each with its own
+        # subject list, and all with the shard's temp dir and the QC csv
+        subject_lists = []
+        lines = ['status=0']
+        for year in year_list:
+            year_subjects = [sub for sub, sub_year in shard_sessions
+                             if sub_year == year]
+            if not year_subjects:
+                continue
+            shard_list = os.path.join(shard_dir,
+                                      'subjects_{}.txt'.format(year))
+            with open(shard_list, 'w') as outfile:
+                outfile.write('\n'.join(year_subjects) + '\n')
+            subject_lists.append(shard_list)
+            cmd = ['python3', ABCD2BIDS] + abcd2bids_args + [
+                '--subject-list', shard_list, '--sessions', year,
+                '--temp', os.path.join(shard_dir, 'temp'), '--qc-csv', qc_csv
+            ]
+            lines.append('{} || status=1'.format(
+                ' '.join(shell_quote(arg) for arg in cmd)))
+        lines.append('exit ${status}')
+
+        # Launch script for this shard, which runs every session even if
+        # an earlier one fails
+        script = os.path.join(shard_dir, 'run.sh')
+        with open(script, 'w') as outfile:
+            outfile.write('#! /bin/bash\n\n{}\n'.format('\n'.join(lines)))
+        os.chmod(script, 0o755)
+
+        manifest['shards'].append({
+            'index': ix, 'subject_lists': subject_lists, 'script': script,
+            'num_sessions': len(shard_sessions),
+            'num_subjects': len(set(sub for sub, _ in shard_sessions)),
+            'weight': sum(weights[session] for session in shard_sessions),
+            'download_logs': [os.path.splitext(shard_list)[0]
+                              + '_download_log.csv'
+                              for shard_list in subject_lists]
+        })
+
+    # SLURM array job which runs shard N's script as array task N
+    array_script = os.path.join(output_dir, ARRAY_SCRIPT_NAME)
+    with open(array_script, 'w') as outfile:
+        outfile.write('#! /bin/bash\n'
+                      '#SBATCH --job-name=abcd2bids\n'
+                      '#SBATCH --array=0-{}\n\n'
+                      'bash {}/shard_$(printf "%03d" '
+                      '${{SLURM_ARRAY_TASK_ID}})/run.sh\n'
+                      .format(len(shards) - 1, shell_quote(output_dir)))
+    os.chmod(array_script, 0o755)
+    manifest['array_script'] = array_script
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as outfile:
+        json.dump(manifest, outfile, indent=4)
+    return manifest
+
+
+def shell_quote(arg):
+    """
+    :param arg: String to put into a bash script as one argument
+    :return: arg, single-quoted if it has any characters bash treats specially
+    """
+    if arg and all(c.isalnum() or c in '@%+=:,./_-' for c in arg):
+        return arg
+    return "'" + arg.replace("'", "'\"'\"'") + "'"
+
+
+def run_local(manifest_path, jobs=1):
+    """
+    Run every shard's launch script from a manifest on this machine, the same
+    way that the array job would run them on a cluster.
+    :param manifest_path: Path to manifest.json written by plan_shards
+    :param jobs: Number of shards to run at the same time
+    :return: List of each shard's exit code, in shard order
+    """
+    with open(manifest_path) as infile:
+        manifest = json.load(infile)
+
+    def run_shard(shard):
+        log_path = os.path.join(os.path.dirname(shard['script']), 'run.log')
+        with open(log_path, 'w') as log_file:
+            exit_code = subprocess.call(('bash', shard['script']),
+                                        stdout=log_file,
+                                        stderr=subprocess.STDOUT)
+        print('Shard {} finished with exit code {}. Log: {}'.format(
+            shard['index'], exit_code, log_path))
+        return exit_code
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        return list(pool.map(run_shard, manifest['shards']))
+
+
+def merge_download_logs(manifest_path):
+    """
+    Combine every shard's *_download_log.csv into one merged_download_log.csv
+    next to the manifest, and print the same counts as aws_downloader.py for
+    the whole run.
+    :param manifest_path: Path to manifest.json written by plan_shards
+    :return: Dictionary mapping each count's name to its value
+    """
+    with open(manifest_path) as infile:
+        manifest = json.load(infile)
+
+    rows = []
+    for shard in manifest['shards']:
+        for download_log in shard['download_logs']:
+            if not os.path.exists(download_log):
+                print('WARNING: Shard {} has no download log at {}'.format(
+                    shard['index'], download_log))
+                continue
+            with open(download_log) as infile:
+                rows += [row for row in csv.reader(infile) if row]
+
+    output_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(os.path.join(output_dir, 'merged_download_log.csv'), 'w') as f:
+        csv.writer(f).writerows(rows)
+
+    counts = {'subject visits': len(rows)}
+    for ix, col in enumerate(DOWNLOAD_LOG_COLS[2:], start=2):
+        counts[col] = sum(1 for row in rows if int(row[ix]) != 0)
+    with open(os.path.join(output_dir, 'merged_report.json'), 'w') as f:
+        json.dump(counts, f, indent=4)
+
+    print("There are %s subject visits" % counts['subject visits'])
+    for col in DOWNLOAD_LOG_COLS[2:]:
+        print("number of subjects with %-7s: %s" % (col[4:], counts[col]))
+    return counts
+
+
+if __name__ == "__main__":
+    sys.exit(main())
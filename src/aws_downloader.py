@@ -1,12 +1,37 @@
 #! /usr/bin/env python3
 
 
-import pandas as pd
 import csv
+import datetime
 import subprocess
 import os
 import sys
 import argparse
+import gzip
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from download_throughput import (DOWNLOADED, DownloadWatcher, FAILED,
+                                     get_modality, load_history, log_files,
+                                     make_file_record, make_run_id, report,
+                                     SKIPPED)
+    from pipeline_state import fingerprint_strings, PipelineState
+    from qc_cache import load_qc_data
+    from series_selection import COUNT_NAMES, select_series
+    from stage_metrics import run_and_measure, write_record
+except ImportError:
+    from src.download_throughput import (DOWNLOADED, DownloadWatcher, FAILED,
+                                         get_modality, load_history,
+                                         log_files, make_file_record,
+                                         make_run_id, report, SKIPPED)
+    from src.pipeline_state import fingerprint_strings, PipelineState
+    from src.qc_cache import load_qc_data
+    from src.series_selection import COUNT_NAMES, select_series
+    from src.stage_metrics import run_and_measure, write_record
 
 #######################################
 # Read in ABCD_good_and_bad_series_table.csv (renamed to ABCD_operator_QC.csv) that is continually updated
@@ -23,6 +48,14 @@ QC_CSV = os.path.join(os.path.dirname(os.path.dirname(
 YEARS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1']
 MODALITIES = ['anat', 'func', 'dwi']
 
+# Lock so that parallel downloads print READY lines and read their replies
+# one at a time in --stream mode
+STREAM_LOCK = threading.Lock()
+
+# Name of the file in each session's download folder which lists the .tgz
+# files that passed a gzip integrity check, with their sizes and mtimes
+VERIFIED_TGZS_NAME = 'verified_tgzs.txt'
+
 def generate_parser(parser=None):
 
     if not parser:
@@ -79,12 +112,107 @@ def generate_parser(parser=None):
         required=True,
         help="ID of the fasttrack qc data package that is created on the NDA"
 )
+    parser.add_argument(
+        '--state-db',
+        dest='state_db',
+        default=None,
+        help="Path to SQLite database recording which subject sessions were "
+             "already downloaded. If given, sessions which already finished "
+             "downloading the same files are not downloaded again."
+)
+    parser.add_argument(
+        '--metrics',
+        dest='metrics',
+        default=None,
+        help="Path to a JSON Lines file to append the timing and resource use "
+             "of each subject session's downloadcmd call to."
+)
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help="After each subject session finishes downloading, print a "
+             "tab-separated 'READY', BIDS subject ID, session, and download "
+             "folder line, then wait for a line on stdin before downloading "
+             "the next session. Used by abcd2bids.py --stream."
+)
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Download every subject session, even ones which the --state-db "
+             "says were already downloaded."
+)
+    parser.add_argument(
+        '--parallel-downloads',
+        dest='parallel_downloads',
+        type=int,
+        default=1,
+        help="Number of downloadcmd processes to run at the same time, each "
+             "downloading one subject session. If this is more than 1, each "
+             "session's downloadcmd output is written to a download.log file "
+             "in its download folder instead of the terminal. Default: 1"
+)
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=int,
+        default=1,
+        help="Number of subject sessions to download with each downloadcmd "
+             "call. If this is more than 1, each batch's files are downloaded "
+             "into a .batch_##### folder of --download-dir by one downloadcmd "
+             "process, then moved into each session's image03 folder as "
+             "listed in the batch's manifest.tsv. With --parallel-downloads, "
+             "each batch's output is written to a .batch_#####.log file in "
+             "--download-dir. Default: 1"
+)
+    parser.add_argument(
+        '--throughput-log',
+        dest='throughput_log',
+        default=None,
+        help="Path to a JSON Lines file to append one record to for each "
+             ".tgz file, with its s3 path, size, download time, attempts, "
+             "final status, and an ID of this run. A report of MB/s per "
+             "subject, per modality, and over time for this run is printed "
+             "from it at the end. Default: "
+             "<subject list>_throughput_log.jsonl next to the subject list"
+)
+    parser.add_argument(
+        '--plan-only',
+        dest='plan_only',
+        action='store_true',
+        help="Only select which files would be downloaded, then print how "
+             "many there are per modality and session, an estimate of how "
+             "many bytes they are and how long downloading them would take, "
+             "and which subjects have no usable series. No folders or logs "
+             "are made and downloadcmd is never run."
+)
+    parser.add_argument(
+        '--history',
+        nargs='+',
+        default=None,
+        help="With --plan-only, paths to earlier runs' throughput logs to "
+             "estimate file sizes and download speed from. Default: "
+             "--throughput-log"
+)
+    parser.add_argument(
+        '--download-retries',
+        dest='download_retries',
+        type=int,
+        default=2,
+        help="Number of times to rerun downloadcmd for a subject session "
+             "after it fails. Default: 2"
+)
 
     return parser
 
 def main(argv=sys.argv):
     parser = generate_parser()
     args = parser.parse_args()
+    if args.parallel_downloads < 1:
+        parser.error('--parallel-downloads must be a positive integer.')
+    if args.batch_size < 1:
+        parser.error('--batch-size must be a positive integer.')
+    if args.download_retries < 0:
+        parser.error('--download-retries cannot be negative.')
 
     # Logging variables
     num_sub_visits = 0
@@ -104,6 +232,11 @@ def main(argv=sys.argv):
         f.close
         subject_list = [sub.strip() for sub in x]
         log = os.path.join(os.path.dirname(args.subject_list), os.path.splitext(os.path.basename(args.subject_list))[0] + "_download_log.csv")
+        if not args.throughput_log:
+            args.throughput_log = os.path.join(os.path.dirname(args.subject_list), os.path.splitext(os.path.basename(args.subject_list))[0] + "_throughput_log.jsonl")
+    if args.history is None:
+        args.history = [args.throughput_log]
+    args.run_id = make_run_id()
     year_list = args.year_list
     if isinstance(year_list, str):
         year_list = year_list.split(',')
@@ -111,6 +244,7 @@ def main(argv=sys.argv):
     if isinstance(modalities, str):
         modalities = modalities.split(',')
     download_dir = args.download_dir
+    state = PipelineState(args.state_db) if args.state_db and not args.plan_only else None
 
     print("aws_downloader.py command line arguments:")    
     print("     QC spreadsheet      : {}".format(series_csv))
@@ -118,12 +252,22 @@ def main(argv=sys.argv):
     print("     Year                : {}".format(year_list))
     print("     Modalities          : {}".format(modalities))
 
-    with open(log, 'w') as f:
+    # Run up to --parallel-downloads downloadcmd processes at once
+    pool = ThreadPoolExecutor(max_workers=args.parallel_downloads)
+    downloads = []
+    batch = []
+    plan = []
+    with open(os.devnull if args.plan_only else log, 'w') as f:
         writer = csv.writer(f)
 
-        # Read csv as pandas dataframe, drop duplicate entries, sort, and group by subject/visit
-        series_header = pd.read_csv(series_csv, nrows=0).columns.tolist()
-        series_df = pd.read_csv(series_csv, usecols=list(range(0,len(series_header))))
+        # Load only the listed subjects' and sessions' rows of the QC data
+        uid_start = "INV"
+        series_df = load_qc_data(series_csv, ['NDAR_INV' + sub.split(uid_start, 1)[1] for sub in subject_list], year_list)
+
+        # Select the series to download for every subject visit at once
+        pass_QC_df = series_df[series_df['QC'] == 1.0] #changed this line back to be able to filter based on QC from fast track
+        selected_paths, selected_counts = select_series(pass_QC_df, modalities)
+        no_series = (0,) * len(COUNT_NAMES)
 
         # If subject list is provided
         # Get list of all unique subjects if not provided
@@ -131,41 +275,19 @@ def main(argv=sys.argv):
         # year_list = ['baseline_year_1_arm_1']
         # Get list of all years if not provided
         # year_list = series_df.EventName.unique()
-        uid_start = "INV"
         for sub in subject_list:
             uid = sub.split(uid_start, 1)[1]
             pguid = 'NDAR_INV' + ''.join(uid)
             bids_id = 'sub-NDARINV' + ''.join(uid)
-            subject_df = series_df[series_df['pGUID'] == pguid]
             for year in year_list:
-                sub_ses_df = subject_df[subject_df['EventName'] == year]
-                sub_pass_QC_df = sub_ses_df[sub_ses_df['QC'] == 1.0] #changed this line back to be able to filter based on QC from fast track
-                file_paths = []
+                file_paths = selected_paths.get((pguid, year), [])
                 ### Logging information
-                # initialize logging variables
-                has_t1 = 0
-                has_t2 = 0
-                has_sefm = 0
-                has_rsfmri = 0
-                has_mid = 0
-                has_sst = 0
-                has_nback = 0
-                has_dti = 0
+                (has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti) = selected_counts.get((pguid, year), no_series)
 
                 num_sub_visits += 1
                 tgz_dir = os.path.join(download_dir, bids_id, year)
                 print("Checking QC data for valid images for {} {}.".format(bids_id, year))
-                os.makedirs(tgz_dir, exist_ok=True)
-                                
-                if 'anat' in modalities:
-                    (file_paths, has_t1, has_t2) = add_anat_paths(sub_pass_QC_df, file_paths)
-                if 'func' in modalities:
-                    (file_paths, has_sefm, has_rsfmri, has_mid, has_sst, has_nback) = add_func_paths(sub_pass_QC_df, file_paths)
-                if 'dwi' in modalities:
-                    (file_paths, has_dti) = add_dwi_paths(sub_pass_QC_df, file_paths)
-                    
-            
-        
+
                 # TODO: log subject level information
                 print(' t1=%s, t2=%s, sefm=%s, rsfmri=%s, mid=%s, sst=%s, nback=%s, has_dti=%s' % (has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti))
                 writer.writerow([bids_id, year, has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti])
@@ -185,15 +307,58 @@ def main(argv=sys.argv):
                 if has_dti != 0:
                     num_dti += 1
 
+                # Only plan the download if running with --plan-only
+                if args.plan_only:
+                    plan.append((bids_id, year, file_paths, tgz_dir))
+                    continue
+
                 # Compile all valid s3 links in a txt file to download using the downloadcmd
+                os.makedirs(tgz_dir, exist_ok=True)
                 s3_links_file = os.path.join(download_dir, bids_id, year, 's3_links.txt')
                 with open(s3_links_file, 'w') as f:
                     f.write('\n'.join(str(s3_link) for s3_link in file_paths))
 
-                # Download s3 links from txt file with downloadcmd
-                subprocess.run([os.path.expanduser(args.downloadcmd), '-dp', args.package_id, '-t', s3_links_file, '-d', tgz_dir])
+                # Still make the folder and (empty) s3_links.txt of sessions
+                # with nothing to download, but don't run downloadcmd for them
+                if not file_paths:
+                    print("{} {} has no usable series; not downloading it.".format(bids_id, year))
+                    continue
+
+                # Skip sessions which already downloaded the same files, if
+                # those files are all still there and intact
+                fingerprint = fingerprint_strings([args.package_id, tgz_dir] + [str(f) for f in file_paths])
+                if state and not args.force and state.is_done(bids_id, year, 'download_nda_data', fingerprint) \
+                        and not find_missing_tgzs(tgz_dir, file_paths):
+                    print("{} {} was already downloaded; skipping.".format(bids_id, year))
+                    if args.stream:
+                        signal_ready(bids_id, year, tgz_dir)
+                elif args.batch_size > 1:
+                    # Download sessions --batch-size at a time
+                    batch.append((bids_id, year, file_paths, tgz_dir, fingerprint))
+                    if len(batch) == args.batch_size:
+                        downloads.append(pool.submit(download_batch, args, state, len(downloads), batch))
+                        batch = []
+                else:
+                    downloads.append(pool.submit(download_session, args, state, bids_id, year, file_paths, tgz_dir, fingerprint))
+        if batch:
+            downloads.append(pool.submit(download_batch, args, state, len(downloads), batch))
+
+        if args.plan_only:
+            pool.shutdown()
+            print_download_plan(args, plan, year_list)
+            return
+
+        # Wait for every download to finish
+        failed = []
+        num_skipped = 0
+        num_fetched = 0
+        for download in downloads:
+            download_failed, download_skipped, download_fetched = download.result()
+            failed += download_failed
+            num_skipped += download_skipped
+            num_fetched += download_fetched
+        pool.shutdown()
 
-                
     print("There are %s subject visits" % num_sub_visits)
     print("number of subjects with a T1 : %s" % num_t1)
     print("number of subjects with a T2 : %s" % num_t2)
@@ -202,121 +367,388 @@ def main(argv=sys.argv):
     print("number of subjects with sst  : %s" % num_sst)
     print("number of subjects with nBack: %s" % num_nback)
     print("number of subjects with dti  : %s" % num_dti)
+    print("number of files already here : %s" % num_skipped)
+    print("number of files downloaded   : %s" % num_fetched)
+    print("number of failed downloads   : %s" % len(failed))
+    for bids_id, year in failed:
+        print("    {} {}".format(bids_id, year))
+    print("\nDownload throughput of run {}, from {}:".format(args.run_id, args.throughput_log))
+    if os.path.exists(args.throughput_log):
+        report(args.throughput_log, run_id=args.run_id)
+
+
+def print_download_plan(args, plan, year_list):
+    """
+    Print how many files would be downloaded per modality and session, how
+    many bytes they are and how long downloading them would take, estimated
+    from earlier runs' throughput logs, and which subjects have no usable
+    series at all.
+    :param args: argparse namespace containing all CLI arguments
+    :param plan: List of (bids_id, year, file_paths, tgz_dir) tuples, one per
+                 subject session
+    :param year_list: List of sessions
+    :return: N/A
+    """
+    sizes, mean_sizes, mb_per_s = load_history(args.history)
+    mean_size = (sum(sizes.values()) / len(sizes)) if sizes else None
+
+    counts = dict()
+    num_files = num_here = 0
+    num_bytes = 0
+    sized = {'earlier runs': 0, 'modality mean': 0, 'overall mean': 0, 'unknown': 0}
+    empty_sessions = []
+    subjects_with_files = set()
+    for bids_id, year, file_paths, tgz_dir in plan:
+        if not file_paths:
+            empty_sessions.append((bids_id, year))
+            continue
+        subjects_with_files.add(bids_id)
+        verified = read_verified_tgzs(tgz_dir)
+        for s3_link in file_paths:
+            modality = get_modality(s3_link)
+            counts.setdefault(modality, dict.fromkeys(year_list, 0))[year] += 1
+            num_files += 1
+
+            # Leave out files which are already downloaded
+            tgz_path = os.path.join(tgz_dir, 'image03', os.path.basename(s3_link))
+            if os.path.exists(tgz_path):
+                stat = os.stat(tgz_path)
+                if verified.get(os.path.basename(s3_link)) == [str(stat.st_size), str(stat.st_mtime_ns)]:
+                    num_here += 1
+                    continue
+            if s3_link in sizes:
+                num_bytes += sizes[s3_link]
+                sized['earlier runs'] += 1
+            elif modality in mean_sizes:
+                num_bytes += mean_sizes[modality]
+                sized['modality mean'] += 1
+            elif mean_size is not None:
+                num_bytes += mean_size
+                sized['overall mean'] += 1
+            else:
+                sized['unknown'] += 1
+
+    print("\nDownload plan for {} subjects in {} subject visits:".format(len(set(bids_id for bids_id, _, _, _ in plan)), len(plan)))
+    print("{:<24}".format("modality") + "".join("{:>26}".format(year) for year in year_list))
+    for modality in sorted(counts):
+        print("{:<24}".format(modality) + "".join("{:>26}".format(counts[modality][year]) for year in year_list))
+    print("{:<24}".format("total") + "".join("{:>26}".format(sum(counts[modality][year] for modality in counts)) for year in year_list))
+
+    print("\nFiles to download: {} ({} of {} are already downloaded)".format(num_files - num_here, num_here, num_files))
+    size_sources = ', '.join('{} {}'.format(num, source) for source, num in sized.items() if num)
+    print("Estimated size: {:.1f} GB{}".format(num_bytes / 2**30, ", with file sizes from: " + size_sources if size_sources else ""))
+    if mb_per_s:
+        seconds = num_bytes / 2**20 / (mb_per_s * args.parallel_downloads)
+        print("Estimated download time: {} at {:.2f} MB/s per download with {} parallel downloads".format(datetime.timedelta(seconds=round(seconds)), mb_per_s, args.parallel_downloads))
+    else:
+        print("Estimated download time: unknown, because no earlier throughput logs were found in {}".format(', '.join(args.history)))
+
+    print("\nSubject visits with no usable series, which will not be downloaded: {}".format(len(empty_sessions)))
+    for bids_id, year in empty_sessions:
+        print("    {} {}".format(bids_id, year))
+    no_series = sorted(set(bids_id for bids_id, _ in empty_sessions) - subjects_with_files)
+    print("Subjects with no usable series in any session: {}".format(len(no_series)))
+    for bids_id in no_series:
+        print("    {}".format(bids_id))
+
+
+def download_session(args, state, bids_id, year, file_paths, tgz_dir, fingerprint):
+    """
+    Download one subject session's missing .tgz files with downloadcmd,
+    rerunning it up to --download-retries times while any are still missing
+    or broken, then tell abcd2bids.py that the session is ready if running in
+    --stream mode.
+    :param args: argparse namespace containing all CLI arguments
+    :param state: PipelineState to record the download in, or None
+    :param bids_id: String, BIDS subject ID of the session
+    :param year: String, session (EventName) to download
+    :param file_paths: List of the session's s3 links
+    :param tgz_dir: Path to the folder to download the session into
+    :param fingerprint: String fingerprinting the session's download inputs
+    :return: Tuple of a list which is empty if the download succeeded or else
+             has the tuple (bids_id, year), the number of files which were
+             already downloaded, and the number of files downloaded now
+    """
+    if state:
+        state.start(bids_id, year, 'download_nda_data', fingerprint)
+    to_download = find_missing_tgzs(tgz_dir, file_paths)
+    num_skipped = len(file_paths) - len(to_download)
+    print("{} {}: {} files already downloaded, {} to download.".format(bids_id, year, num_skipped, len(to_download)), flush=True)
+    skipped = set(file_paths).difference(to_download)
+    attempts = dict.fromkeys(file_paths, 0)
+    durations = dict()
+
+    # With parallel downloads, give each session's output its own log file
+    log_file = None
+    if args.parallel_downloads > 1:
+        log_file = open(os.path.join(tgz_dir, 'download.log'), 'a')
+    s3_links_file = os.path.join(tgz_dir, 's3_links_to_download.txt')
+    returncode = 0
+    try:
+        for attempt in range(args.download_retries + 1):
+            if not to_download:
+                break
+            if attempt:
+                print("downloadcmd did not download {} files for {} {} (exit code {}); "
+                      "retrying ({} of {}).".format(len(to_download), bids_id, year, returncode, attempt, args.download_retries), flush=True)
+                time.sleep(2 ** attempt)
+            with open(s3_links_file, 'w') as f:
+                f.write('\n'.join(to_download))
+            with DownloadWatcher(tgz_dir, [os.path.basename(s3_link) for s3_link in to_download]) as watcher:
+                returncode, metrics = run_and_measure([os.path.expanduser(args.downloadcmd), '-dp', args.package_id, '-t', s3_links_file, '-d', tgz_dir], 'download', bids_id, year, stdout=log_file, stderr=subprocess.STDOUT if log_file else None)
+            if args.metrics:
+                write_record(args.metrics, metrics)
+            to_download = record_attempt(tgz_dir, to_download, watcher, attempts, durations)
+    finally:
+        if log_file:
+            log_file.close()
+
+    num_fetched = len(file_paths) - num_skipped - len(to_download)
+    log_throughput(args, bids_id, year, tgz_dir, file_paths, skipped, attempts, durations)
+    if state:
+        state.finish(bids_id, year, 'download_nda_data', (returncode or 1) if to_download else 0)
+    if to_download:
+        print("downloadcmd failed to download {} files for {} {}.".format(len(to_download), bids_id, year), flush=True)
+        return [(bids_id, year)], num_skipped, num_fetched
+
+    # Hand this session to abcd2bids.py to unpack, and wait until it has room
+    # for another one
+    if args.stream:
+        signal_ready(bids_id, year, tgz_dir)
+    return [], num_skipped, num_fetched
+
+
+def download_batch(args, state, batch_ix, sessions):
+    """
+    Download many subject sessions' missing .tgz files with one downloadcmd
+    call, so that its startup and authentication are only paid once per
+    batch. The files are downloaded into a batch folder, then moved into the
+    image03 folder of the session they belong to. If any files are still
+    missing or broken, the call is rerun for just those files up to
+    --download-retries times.
+    :param args: argparse namespace containing all CLI arguments
+    :param state: PipelineState to record the downloads in, or None
+    :param batch_ix: Integer which numbers this batch
+    :param sessions: List of (bids_id, year, file_paths, tgz_dir, fingerprint)
+                     tuples, one per subject session to download
+    :return: Tuple of a list of (bids_id, year) tuples of the sessions which
+             failed, the number of files which were already downloaded, and
+             the number of files downloaded now
+    """
+    batch_name = 'batch_{:05d}'.format(batch_ix)
+    batch_dir = os.path.join(args.download_dir, '.' + batch_name)
+    os.makedirs(batch_dir, exist_ok=True)
+
+    # Only download the files which each session does not already have
+    to_download = dict()
+    num_files = 0
+    attempts = dict()
+    durations = dict()
+    for ix, (bids_id, year, file_paths, tgz_dir, fingerprint) in enumerate(sessions):
+        if state:
+            state.start(bids_id, year, 'download_nda_data', fingerprint)
+        to_download[ix] = find_missing_tgzs(tgz_dir, file_paths)
+        num_files += len(file_paths)
+        attempts.update(dict.fromkeys(file_paths, 0))
+    skipped = set(attempts).difference(s3_link for links in to_download.values() for s3_link in links)
+    num_missing = sum(len(links) for links in to_download.values())
+    num_skipped = num_files - num_missing
+    print("{}: {} files already downloaded, {} to download.".format(batch_name, num_skipped, num_missing), flush=True)
+
+    # Manifest mapping each file's s3 path to the image03 folder to move it to
+    image03_dirs = dict()
+    for ix, links in to_download.items():
+        for s3_link in links:
+            image03_dirs[os.path.basename(s3_link)] = os.path.join(sessions[ix][3], 'image03')
+    with open(os.path.join(batch_dir, 'manifest.tsv'), 'w') as f:
+        csv.writer(f, delimiter='\t').writerows(
+            (s3_link, image03_dirs[os.path.basename(s3_link)])
+            for links in to_download.values() for s3_link in links
+        )
 
-
-def add_anat_paths(passed_QC_group, file_paths):
-    ##  If T1_NORM exists, only download that file instead of normal T1
-    T1_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-T1-NORM']
-    if T1_df.empty:
-        T1_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-T1']
-        if T1_df.empty:
-            has_t1 = 0 # No T1s. Invalid subject
+    s3_links_file = os.path.join(batch_dir, 's3_links.txt')
+    log_file = None
+    if args.parallel_downloads > 1:
+        log_file = open(batch_dir + '.log', 'a')
+    try:
+        for attempt in range(args.download_retries + 1):
+            to_download = {ix: links for ix, links in to_download.items() if links}
+            if not to_download:
+                break
+            if attempt:
+                print("downloadcmd did not download {} files of {}; retrying ({} of {})."
+                      .format(sum(len(links) for links in to_download.values()), batch_name, attempt, args.download_retries), flush=True)
+                time.sleep(2 ** attempt)
+            with open(s3_links_file, 'w') as f:
+                f.write('\n'.join(s3_link for links in to_download.values() for s3_link in links))
+            with DownloadWatcher(batch_dir, image03_dirs) as watcher:
+                returncode, metrics = run_and_measure([os.path.expanduser(args.downloadcmd), '-dp', args.package_id, '-t', s3_links_file, '-d', batch_dir], 'download', batch_name, '', stdout=log_file, stderr=subprocess.STDOUT if log_file else None)
+            if args.metrics:
+                write_record(args.metrics, metrics)
+
+            # Move every file which was downloaded into its session's folder
+            for root, _, file_names in os.walk(batch_dir):
+                for file_name in file_names:
+                    if file_name in image03_dirs:
+                        os.makedirs(image03_dirs[file_name], exist_ok=True)
+                        os.replace(os.path.join(root, file_name), os.path.join(image03_dirs[file_name], file_name))
+            for ix in to_download:
+                to_download[ix] = record_attempt(sessions[ix][3], to_download[ix], watcher, attempts, durations)
+    finally:
+        if log_file:
+            log_file.close()
+
+    # A session succeeded if all of its files were downloaded
+    failed = []
+    for ix, (bids_id, year, file_paths, tgz_dir, _) in enumerate(sessions):
+        log_throughput(args, bids_id, year, tgz_dir, file_paths, skipped, attempts, durations)
+        succeeded = not to_download.get(ix)
+        if state:
+            state.finish(bids_id, year, 'download_nda_data', 0 if succeeded else 1)
+        if not succeeded:
+            print("downloadcmd failed to download {} files for {} {}.".format(len(to_download[ix]), bids_id, year), flush=True)
+            failed.append((bids_id, year))
+        elif args.stream:
+            signal_ready(bids_id, year, tgz_dir)
+    num_fetched = num_missing - sum(len(links) for links in to_download.values())
+    if not failed:
+        shutil.rmtree(batch_dir)
+    return failed, num_skipped, num_fetched
+
+
+def record_attempt(tgz_dir, file_paths, watcher, attempts, durations):
+    """
+    After one downloadcmd call, count it as an attempt at each file that it
+    was asked to download, and note how long each file that it downloaded
+    took to download.
+    :param tgz_dir: Path to the session's download folder
+    :param file_paths: List of the session's s3 links which the call was
+                       asked to download
+    :param watcher: DownloadWatcher which watched the call
+    :param attempts: Dictionary mapping each s3 link to how many calls tried
+                     to download it, to update
+    :param durations: Dictionary mapping each downloaded s3 link to a tuple of
+                      how long it took to download and when it finished, to
+                      update
+    :return: List of the s3 links in file_paths which still need downloading
+    """
+    missing = find_missing_tgzs(tgz_dir, file_paths)
+    for s3_link in file_paths:
+        attempts[s3_link] += 1
+    for s3_link in set(file_paths).difference(missing):
+        file_name = os.path.basename(s3_link)
+        durations[s3_link] = (watcher.get_duration(file_name), watcher.get_finished(file_name))
+    return missing
+
+
+def log_throughput(args, bids_id, year, tgz_dir, file_paths, skipped, attempts, durations):
+    """
+    Write one record per .tgz file of a session to the throughput log
+    :param args: argparse namespace containing all CLI arguments
+    :param bids_id: String, BIDS subject ID of the session
+    :param year: String, session (EventName)
+    :param tgz_dir: Path to the session's download folder
+    :param file_paths: List of the session's s3 links
+    :param skipped: Set of s3 links which were already downloaded
+    :param attempts: Dictionary mapping each s3 link to how many downloadcmd
+                     calls tried to download it
+    :param durations: Dictionary mapping each downloaded s3 link to a tuple of
+                      how long it took to download and when it finished
+    :return: N/A
+    """
+    records = []
+    for s3_link in file_paths:
+        tgz_path = os.path.join(tgz_dir, 'image03', os.path.basename(s3_link))
+        if s3_link in skipped:
+            records.append(make_file_record(s3_link, bids_id, year, os.path.getsize(tgz_path), 0, 0, SKIPPED, args.run_id))
+        elif s3_link in durations:
+            duration, finished = durations[s3_link]
+            records.append(make_file_record(s3_link, bids_id, year, os.path.getsize(tgz_path), duration, attempts[s3_link], DOWNLOADED, args.run_id, finished))
         else:
-            for file_path in T1_df['image_file']:
-                file_paths += [file_path]
-            has_t1 = T1_df.shape[0]
-    else:
-        for file_path in T1_df["image_file"]:
-            file_paths += [file_path]
-        has_t1 = T1_df.shape[0]
-
-    ##  If T2_NORM exists, only download that file instead of normal T2
-    T2_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-T2-NORM']
-    if T2_df.empty:
-        T2_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-T2']
-        if T2_df.empty:
-            has_t2 = 0 # No T1s. Invalid subject
+            records.append(make_file_record(s3_link, bids_id, year, 0, None, attempts[s3_link], FAILED, args.run_id))
+    log_files(args.throughput_log, records)
+
+
+def find_missing_tgzs(tgz_dir, file_paths):
+    """
+    Check which of a session's .tgz files are not fully downloaded yet. A
+    file counts as downloaded if it has the same size and modification time
+    as when it last passed a gzip integrity check, or if it passes one now.
+    Files which fail the check are deleted, so that they are downloaded again
+    from the start.
+    :param tgz_dir: Path to the session's download folder
+    :param file_paths: List of the session's s3 links to check
+    :return: List of the s3 links in file_paths which still need downloading
+    """
+    verified = read_verified_tgzs(tgz_dir)
+    missing = []
+    newly_verified = []
+    for s3_link in file_paths:
+        file_name = os.path.basename(s3_link)
+        tgz_path = os.path.join(tgz_dir, 'image03', file_name)
+        try:
+            stat = os.stat(tgz_path)
+        except OSError:
+            missing.append(s3_link)
+            continue
+        size_and_mtime = [str(stat.st_size), str(stat.st_mtime_ns)]
+        if verified.get(file_name) == size_and_mtime:
+            continue
+        if is_intact_gzip(tgz_path):
+            newly_verified.append([file_name] + size_and_mtime)
         else:
-            for file_path in T2_df['image_file']:
-                file_paths += [file_path]
-            has_t2 = T2_df.shape[0]
-    else:
-        for file_path in T2_df["image_file"]:
-            file_paths += [file_path]
-        has_t2 = T2_df.shape[0]
-
-    return (file_paths, has_t1, has_t2)
-
-def add_func_paths(passed_QC_group, file_paths):
-    ## Pair SEFMs and only download if both pass QC
-    #   Check first if just the FM exists
-    FM_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-fMRI-FM']
-    if FM_df.empty:
-        FM_AP_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-fMRI-FM-AP']
-        FM_PA_df = passed_QC_group[passed_QC_group['image_description'] == 'ABCD-fMRI-FM-PA']
-        if FM_AP_df.shape[0] != FM_PA_df.shape[0] or FM_AP_df.empty:
-            has_sefm = 0 # No SEFMs. Invalid subject
-        else:
-            for i in range(0, FM_AP_df.shape[0]):
-                if FM_AP_df.iloc[i]['QC'] == 1.0 and FM_PA_df.iloc[i]['QC'] == 1.0:
-                    FM_df = FM_df.append(FM_AP_df.iloc[i])
-                    FM_df = FM_df.append(FM_PA_df.iloc[i])
-    if FM_df.empty:
-        has_sefm = 0 # No SEFMs. Invalid subject
-    else:
-        for file_path in FM_df['image_file']:
-            file_paths += [file_path]
-        has_sefm = FM_df.shape[0]
-
-
-    ## List all rsfMRI scans that pass QC
-    RS_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-rsfMRI']
-    if RS_df.empty:
-        has_rsfmri = 0
-    else:
-        for file_path in RS_df['image_file']:
-            file_paths += [file_path]
-        has_rsfmri = RS_df.shape[0]
-
-    ## List only download task if and only if there is a pair of scans for the task that passed QC
-    MID_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-MID-fMRI']
-
-    if MID_df.empty:
-        has_mid = 0
-    else:
-        for file_path in MID_df['image_file']:
-            file_paths += [file_path]
-        has_mid = MID_df.shape[0]
-    SST_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-SST-fMRI']
-    if SST_df.empty:
-        has_sst = 0
-    else:
-        for file_path in SST_df['image_file']:
-            file_paths += [file_path]
-        has_sst = SST_df.shape[0]
-    nBack_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-nBack-fMRI']
-    if nBack_df.empty:
-        has_nback = 0
-    else:
-        for file_path in nBack_df['image_file']:
-            file_paths += [file_path]
-        has_nback = nBack_df.shape[0]
-
-
-    return (file_paths, has_sefm, has_rsfmri, has_mid, has_sst, has_nback)
-
-
-def add_dwi_paths(passed_QC_group, file_paths):
-    DTI_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-DTI']
-    if DTI_df.shape[0] >= 1:
-        # If a DTI exists then download all passing DTI fieldmaps
-        DTI_FM_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-Diffusion-FM']
-        if DTI_FM_df.empty:
-            DTI_FM_AP_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-Diffusion-FM-AP']
-            if DTI_FM_AP_df.empty:
-                return (file_paths, 0)
-            DTI_FM_PA_df = passed_QC_group.loc[passed_QC_group['image_description'] == 'ABCD-Diffusion-FM-PA']
-            DTI_FM_df = pd.concat([DTI_FM_AP_df.tail(1), DTI_FM_PA_df.tail(1)], ignore_index=True)
-        if not DTI_FM_df.empty:
-            for file_path in DTI_df['image_file']:
-                file_paths += [file_path]
-            for file_path in DTI_FM_df['image_file']:
-                file_paths += [file_path]
-        has_dti = DTI_df.shape[0]
-    else:
-        has_dti = DTI_df.shape[0]
+            print("{} is incomplete or damaged; downloading it again.".format(tgz_path), flush=True)
+            os.remove(tgz_path)
+            missing.append(s3_link)
+
+    if newly_verified:
+        with open(os.path.join(tgz_dir, VERIFIED_TGZS_NAME), 'a') as f:
+            csv.writer(f, delimiter='\t').writerows(newly_verified)
+    return missing
+
+
+def read_verified_tgzs(tgz_dir):
+    """
+    :param tgz_dir: Path to a session's download folder
+    :return: Dictionary mapping the name of each .tgz file which passed a
+             gzip integrity check to a list of its size and mtime as strings
+    """
+    verified = dict()
+    verified_file = os.path.join(tgz_dir, VERIFIED_TGZS_NAME)
+    if os.path.exists(verified_file):
+        with open(verified_file) as f:
+            for row in csv.reader(f, delimiter='\t'):
+                verified[row[0]] = row[1:]
+    return verified
+
+
+def is_intact_gzip(path):
+    """
+    :param path: Path to a gzip file
+    :return: True if the whole file decompresses without errors, or False if
+             it is truncated or corrupt
+    """
+    try:
+        with gzip.open(path, 'rb') as f:
+            while f.read(2**22):
+                pass
+        return True
+    except (OSError, EOFError, zlib.error):
+        return False
+
+
+def signal_ready(bids_id, year, tgz_dir):
+    """
+    Print a READY line for abcd2bids.py --stream, then wait for its reply.
+    :param bids_id: String, BIDS subject ID of the downloaded session
+    :param year: String, downloaded session
+    :param tgz_dir: Path to the folder which the session was downloaded into
+    :return: N/A
+    """
+    with STREAM_LOCK:
+        print('READY\t{}\t{}\t{}'.format(bids_id, year, tgz_dir), flush=True)
+        sys.stdin.readline()
 
-    return (file_paths, has_dti)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark of reformatting the QC spreadsheet, old parser vs. current one
+Writes a synthetic abcd_fastqc01.txt with quoted, tab-separated values, some
+of whose ftq_notes have commas in them like the real spreadsheet's, then
+reformats it with the parser abcd2bids.py used before (pandas' python engine
+with a regex separator, stripping quotes cell by cell) and with the current
+write_reformatted_spreadsheet. Each runs in its own process so that its peak
+RSS is its own. Prints both timings and checks that the two CSVs have the
+same rows, apart from the rows with commas in ftq_notes, which the old parser
+split into the wrong columns, e.g.:
+    python3 src/benchmark_fastqc_reformat.py --rows 300000
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import pandas as pd
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Columns of the synthetic QC spreadsheet, in the same order as the NDA's
+QC_COLUMNS = ("collection_id", "abcd_fastqc01_id", "dataset_id",
+              "subjectkey", "src_subject_id", "interview_date",
+              "interview_age", "sex", "visit", "file_source", "ftq_series_id",
+              "ftq_manufacturer", "ftq_complete", "ftq_usable", "ftq_notes",
+              "ftq_recall", "ftq_recall_reason", "abcd_compliant",
+              "comments_misc", "collection_title")
+IMAGE_DESCRIPTIONS = ("ABCD-T1", "ABCD-T1-NORM", "ABCD-T2", "ABCD-T2-NORM",
+                      "ABCD-rsfMRI", "ABCD-MID-fMRI", "ABCD-SST-fMRI",
+                      "ABCD-nBack-fMRI", "ABCD-fMRI-FM-AP", "ABCD-fMRI-FM-PA",
+                      "ABCD-DTI", "ABCD-Diffusion-FM-AP",
+                      "ABCD-Diffusion-FM-PA")
+NOTES = ("", "ok", "good")
+COMMA_NOTES = ("motion, some", "artifact,slight,frontal")
+
+
+def make_spreadsheet(qc_path, num_rows, comma_fraction, seed=0):
+    """
+    Write a synthetic QC spreadsheet like abcd_fastqc01.txt.
+    :param qc_path: Path to the spreadsheet to write
+    :param num_rows: Integer, how many rows of QC data to write
+    :param comma_fraction: Float, fraction of rows with commas in ftq_notes
+    :param seed: Integer to seed the random values with
+    :return: Set of the abcd_fastqc01_id values (as reformatted) of the rows
+             with commas in ftq_notes
+    """
+    rng = random.Random(seed)
+    comma_ids = set()
+    with open(qc_path, "w") as qc_file:
+        for row in (QC_COLUMNS, ["desc of " + col for col in QC_COLUMNS]):
+            qc_file.write("\t".join('"{}"'.format(x) for x in row) + "\n")
+        for ix in range(num_rows):
+            subject = "NDAR_INV{:08d}".format(rng.randint(0, num_rows // 20))
+            visit = rng.choice(("baseline_year_1_arm_1",
+                                "2_year_follow_up_y_arm_1"))
+            series_id = "{}_{}_{}_2018{:010d}".format(
+                subject.replace("_", ""), "baselineYear1Arm1"
+                if visit.startswith("baseline") else "2YearFollowUpYArm1",
+                rng.choice(IMAGE_DESCRIPTIONS), rng.randint(0, 10**9)
+            )
+            if rng.random() < comma_fraction:
+                notes = rng.choice(COMMA_NOTES)
+                comma_ids.add(str(ix))
+            else:
+                notes = rng.choice(NOTES)
+            row = ("2573", "{:06d}".format(ix), "1234", subject, subject,
+                   "01/01/2018", str(rng.randint(100, 140)), rng.choice("MF"),
+                   visit, "s3://NDAR_Central_1/submission_1/{}.tgz"
+                   .format(series_id), series_id,
+                   rng.choice(("GE", "Philips", "SIEMENS")),
+                   rng.choice("1110"), rng.choice(("1", "1", "1", "0", "")),
+                   notes, rng.choice("01"),
+                   rng.choice(("", "", "Replaced", "Other")),
+                   rng.choice(("Yes", "No")), series_id.split("_")[2], "ABCD")
+            qc_file.write("\t".join('"{}"'.format(x) for x in row) + "\n")
+    return comma_ids
+
+
+def read_rows_without(csv_path, skip_ids):
+    """
+    :param csv_path: Path to a reformatted QC .csv file
+    :param skip_ids: Set of abcd_fastqc01_id values of rows to leave out
+    :return: List of the rows of the .csv file, each a list of strings,
+             except the rows with those IDs
+    """
+    with open(csv_path, newline="") as infile:
+        return [row for row in csv.reader(infile) if row[1] not in skip_ids]
+
+
+def old_reformat(qc_path, csv_path):
+    """
+    Reformat the QC spreadsheet the way abcd2bids.py did before it used
+    pandas' C parser, to compare against.
+    :param qc_path: Path to the QC spreadsheet
+    :param csv_path: Path to the reformatted .csv file to write
+    :return: N/A
+    """
+    with open(qc_path, encoding="utf-8-sig") as qc_file:
+        all_qc_data = pd.read_csv(
+            qc_file, encoding="utf-8-sig", sep=",|\t", engine="python",
+            index_col=False, header=0, skiprows=[1]
+        )
+    # DataFrame.applymap was renamed to DataFrame.map in pandas 2.1
+    applymap = getattr(all_qc_data, "map", None) or all_qc_data.applymap
+    all_qc_data = applymap(lambda x: x.strip('"')).apply(
+        lambda x: x.apply(lambda y: int(y) if y.isnumeric() else y)
+    )
+    all_qc_data.columns = [header.strip('"') for header in
+                           all_qc_data.columns]
+    print(all_qc_data.columns)
+    qc_data = old_fix_split_col(all_qc_data.loc[
+        (all_qc_data['ftq_usable'] == 1) & (all_qc_data['ftq_complete'] == 1)
+    ])
+    image_desc_col = qc_data.apply(
+        lambda row: row.ftq_series_id.split("_")[2], axis=1)
+    qc_data = qc_data.assign(image_description=image_desc_col.values)
+    image_timestamp_col = qc_data.apply(
+        lambda row: row.ftq_series_id.split("_")[3], axis=1)
+    qc_data = qc_data.assign(image_timestamp=image_timestamp_col.values)
+    qc_data = qc_data[qc_data['ftq_recall_reason'] != 'Replaced']
+    qc_data.rename({
+        "ftq_usable": "QC", "subjectkey": "pGUID", "visit": "EventName",
+        "abcd_compliant": "ABCD_Compliant", "interview_age": "SeriesTime",
+        "comments_misc": "SeriesDescription", "file_source": "image_file"
+    }, axis="columns").sort_values([
+        'pGUID', 'EventName', 'image_description', 'image_timestamp'
+    ]).to_csv(csv_path, index=False)
+
+
+def old_fix_split_col(qc_df):
+    """
+    The old way of putting ftq_notes values split apart by commas back
+    together, one column at a time.
+    :param qc_df: pandas.DataFrame with all QC data
+    :return: pandas.DataFrame which is qc_df, but with the last column(s) fixed
+    """
+    def trim_end_columns(row):
+        ix = int(row.name)
+        if not pd.isna(qc_df.at[ix, columns[-1]]):
+            qc_df.at[ix, columns[-3]] += " " + qc_df.at[ix, columns[-2]]
+            qc_df.at[ix, columns[-2]] = qc_df.at[ix, columns[-1]]
+
+    columns = qc_df.columns.values.tolist()
+    last_col = columns[-1]
+    while any(qc_df[last_col].isna()):
+        qc_df.apply(trim_end_columns, axis="columns")
+        print("Dropping '{}' column because it has NaNs".format(last_col))
+        qc_df = qc_df.drop(last_col, axis="columns")
+        columns = qc_df.columns.values.tolist()
+        last_col = columns[-1]
+    return qc_df
+
+
+def time_one(parser_name, qc_path, csv_path):
+    """
+    Reformat the QC spreadsheet with one parser, then print how long it took
+    and the peak RSS of this process as JSON.
+    :param parser_name: String, "old" or "new"
+    :param qc_path: Path to the QC spreadsheet
+    :param csv_path: Path to the reformatted .csv file to write
+    :return: N/A
+    """
+    if parser_name == "old":
+        reformat = old_reformat
+    else:
+        sys.path.insert(0, os.path.dirname(SRC_DIR))
+        from abcd2bids import write_reformatted_spreadsheet as reformat
+    start = time.monotonic()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        reformat(qc_path, csv_path)
+    print(json.dumps({
+        "seconds": time.monotonic() - start,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                       / 1024
+    }))
+
+
+def run_timed(parser_name, qc_path, csv_path):
+    """
+    :return: Dictionary with the seconds and peak RSS of reformatting the QC
+             spreadsheet with one parser, in its own process
+    """
+    output = subprocess.check_output(
+        (sys.executable, os.path.abspath(__file__), "--time-only",
+         parser_name, qc_path, csv_path), universal_newlines=True
+    )
+    return json.loads(output.splitlines()[-1])
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Time reformatting a synthetic QC spreadsheet with the "
+                    "old parser and with the current one, and check that they "
+                    "write the same rows apart from those with commas in "
+                    "ftq_notes."
+    )
+    parser.add_argument("--rows", type=int, default=100000,
+                        help="Number of rows of QC data. Default: 100000")
+    parser.add_argument("--comma-fraction", type=float, default=0.4,
+                        dest="comma_fraction",
+                        help="Fraction of rows with commas in ftq_notes. "
+                             "Default: 0.4")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic values. Default: 0")
+    parser.add_argument("--time-only", nargs=3, dest="time_only",
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = generate_parser().parse_args()
+    if args.time_only:
+        time_one(*args.time_only)
+        return 0
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        qc_path = os.path.join(temp_dir, "abcd_fastqc01.txt")
+        comma_ids = make_spreadsheet(qc_path, args.rows, args.comma_fraction,
+                                     args.seed)
+        print("Synthetic QC spreadsheet: {} rows, {:.0%} with commas in "
+              "ftq_notes, {:.1f} MB".format(args.rows, args.comma_fraction,
+                                            os.path.getsize(qc_path) / 2**20))
+        csv_paths = dict()
+        results = dict()
+        for parser_name in ("old", "new"):
+            csv_paths[parser_name] = os.path.join(
+                temp_dir, parser_name + "_reformatted.csv")
+            results[parser_name] = run_timed(parser_name, qc_path,
+                                             csv_paths[parser_name])
+            print("{}: {seconds:.2f} s, {peak_rss_mb:.0f} MB peak RSS"
+                  .format(parser_name, **results[parser_name]))
+        same = read_rows_without(csv_paths["old"], comma_ids) == \
+            read_rows_without(csv_paths["new"], comma_ids)
+    print("Speedup: {:.2f}x".format(results["old"]["seconds"]
+                                    / results["new"]["seconds"]))
+    print("Reformatted CSVs are {} apart from the rows with commas in "
+          "ftq_notes".format("identical" if same else "DIFFERENT"))
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+
+"""
+Minimal DICOM header reader, used instead of running dcmdump once per tag
+Parses a DICOM file's elements in order, skipping the value of every element
+that was not asked for, and stops as soon as it is past the last tag asked
+for, so it never reads pixel data. Files without the 128-byte preamble and
+"DICM" prefix are read as implicit VR little endian from their first byte. It
+reads from any binary file object, including a member of a tar archive that
+has not been extracted, e.g.:
+    python3 src/dicom_header.py first.dcm 0008,0070 0018,1020
+"""
+
+import argparse
+import os
+import struct
+import sys
+
+# Tags which the pipeline reads from the first DICOM of each series
+MEDIA_STORAGE_SOP_CLASS = (0x0002, 0x0002)
+MANUFACTURER = (0x0008, 0x0070)
+SERIES_DESCRIPTION = (0x0008, 0x103E)
+SOFTWARE_VERSIONS = (0x0018, 0x1020)
+TEMPORAL_POSITIONS = (0x2001, 0x1081)  # Philips private: number of dynamics
+SERIES_TAGS = (MEDIA_STORAGE_SOP_CLASS, MANUFACTURER, SERIES_DESCRIPTION,
+               SOFTWARE_VERSIONS, TEMPORAL_POSITIONS)
+
+# Names that dcmdump gives the SOP class UIDs which the pipeline checks for
+SOP_CLASS_NAMES = {"1.2.840.10008.5.1.4.1.1.66": "RawDataStorage",
+                   "1.2.840.10008.5.1.4.1.1.4": "MRImageStorage",
+                   "1.2.840.10008.5.1.4.1.1.4.1": "EnhancedMRImageStorage"}
+
+# Transfer syntaxes which are not explicit VR little endian
+IMPLICIT_LITTLE = "1.2.840.10008.1.2"
+EXPLICIT_BIG = "1.2.840.10008.1.2.2"
+DEFLATED = "1.2.840.10008.1.2.1.99"
+
+# Explicit VRs with a 4-byte length after 2 reserved bytes
+LONG_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC",
+            b"UN", b"UR", b"UT", b"UV"}
+NUMERIC_VRS = {b"US": "H", b"SS": "h", b"UL": "I", b"SL": "i", b"FL": "f",
+               b"FD": "d"}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+# Longest value which the first element of a DICOM file without a preamble can
+# have for the file to be read as one
+MAX_BARE_FIRST_LENGTH = 2**16
+ITEM = (0xFFFE, 0xE000)
+ITEM_END = (0xFFFE, 0xE00D)
+SEQUENCE_END = (0xFFFE, 0xE0DD)
+
+
+class DicomHeaderError(ValueError):
+    """
+    Raised when a file is not DICOM, or its header cannot be parsed
+    """
+
+
+def parse_tag(tag):
+    """
+    :param tag: String like "0008,0070" or "(0008,0070)", or a tuple of ints
+    :return: Tuple of the tag's group and element numbers
+    """
+    if isinstance(tag, tuple):
+        return tag
+    try:
+        group, element = tag.strip("()").split(",")
+        return int(group, 16), int(element, 16)
+    except ValueError:
+        raise DicomHeaderError("Not a DICOM tag: {}".format(tag))
+
+
+class _Prefixed(object):
+    """
+    Binary file object which returns bytes already read from another one,
+    then the rest of that one, so that it can be parsed again from its start
+    """
+    def __init__(self, prefix, infile):
+        self.prefix = prefix
+        self.infile = infile
+
+    def read(self, num_bytes=-1):
+        if num_bytes < 0:
+            data, self.prefix = self.prefix + self.infile.read(), b""
+            return data
+        data, self.prefix = self.prefix[:num_bytes], self.prefix[num_bytes:]
+        if len(data) < num_bytes:
+            data += self.infile.read(num_bytes - len(data))
+        return data
+
+
+class _Reader(object):
+    """
+    Reads DICOM elements from a binary file object in one encoding
+    """
+    def __init__(self, infile, implicit=False, big_endian=False):
+        self.infile = infile
+        self.implicit = implicit
+        self.endian = ">" if big_endian else "<"
+
+    def read(self, num_bytes):
+        data = self.infile.read(num_bytes)
+        if len(data) != num_bytes:
+            raise EOFError
+        return data
+
+    def skip(self, num_bytes):
+        while num_bytes > 0:
+            num_bytes -= len(self.read(min(num_bytes, 2**20)))
+
+    def read_tag(self):
+        return struct.unpack(self.endian + "HH", self.read(4))
+
+    def read_vr_and_length(self, tag):
+        """
+        :param tag: Tuple of the group and element of the element just read
+        :return: Tuple of the element's VR (None if implicit) and length
+        """
+        if self.implicit or tag[0] == 0xFFFE:
+            return None, struct.unpack(self.endian + "I", self.read(4))[0]
+        vr = self.read(2)
+        if vr in LONG_VRS:
+            self.read(2)
+            return vr, struct.unpack(self.endian + "I", self.read(4))[0]
+        return vr, struct.unpack(self.endian + "H", self.read(2))[0]
+
+    def skip_undefined(self, vr):
+        """
+        Skip the items of a sequence of undefined length, through the end of
+        the sequence. The items of an undefined-length UN element are always
+        implicit VR little endian.
+        :param vr: Explicit VR of the sequence, or None if implicit
+        :return: N/A
+        """
+        reader = _Reader(self.infile, implicit=True) if vr == b"UN" else self
+        while True:
+            tag = reader.read_tag()
+            length = struct.unpack(reader.endian + "I", reader.read(4))[0]
+            if tag == SEQUENCE_END:
+                return
+            if tag != ITEM:
+                raise DicomHeaderError("Expected a sequence item, found "
+                                       "({:04X},{:04X})".format(*tag))
+            if length != UNDEFINED_LENGTH:
+                reader.skip(length)
+                continue
+            while True:  # Elements of an item of undefined length
+                tag = reader.read_tag()
+                vr, length = reader.read_vr_and_length(tag)
+                if tag == ITEM_END:
+                    break
+                if length == UNDEFINED_LENGTH:
+                    reader.skip_undefined(vr)
+                else:
+                    reader.skip(length)
+
+    def read_elements(self, wanted, header, last_tag, stop_group=None):
+        """
+        Read elements until past last_tag, or until the end of the file or of
+        group stop_group, and save the values of the wanted ones.
+        :param wanted: Set of (group, element) tuples to save the values of
+        :param header: Dictionary to save each wanted tag's value in
+        :param last_tag: Tuple, the tag after which to stop reading
+        :param stop_group: Integer, group to stop reading at the end of
+        :return: Tuple, the first tag not read, or None at the end of the file
+        """
+        while True:
+            try:
+                tag = self.read_tag()
+            except EOFError:
+                return None
+            if tag > last_tag or (stop_group is not None and
+                                  tag[0] != stop_group):
+                return tag
+            vr, length = self.read_vr_and_length(tag)
+            if length == UNDEFINED_LENGTH:
+                self.skip_undefined(vr)
+            elif tag in wanted:
+                header[tag] = decode_value(self.read(length), vr, self.endian)
+            else:
+                self.skip(length)
+
+
+def decode_value(value, vr, endian="<"):
+    """
+    :param value: Bytes of an element's value
+    :param vr: Explicit VR of the element, or None if implicit
+    :param endian: String, struct byte order of numeric values
+    :return: Number, or tuple of numbers, for numeric VRs; else a string
+             without padding, with multiple values separated by backslashes
+             like dcmdump shows them
+    """
+    if vr in NUMERIC_VRS:
+        fmt = NUMERIC_VRS[vr]
+        numbers = struct.unpack("{}{}{}".format(
+            endian, len(value) // struct.calcsize(fmt), fmt), value)
+        return numbers[0] if len(numbers) == 1 else numbers
+    return value.decode("latin-1").strip(" \x00")
+
+
+def read_header(infile, tags=SERIES_TAGS):
+    """
+    Read some tags from the header of a DICOM file.
+    :param infile: Path to a DICOM file, or a binary file object at its start
+    :param tags: List of tags to read, as tuples or strings like "0008,0070"
+    :return: Dictionary mapping each tuple tag in the file to its value
+    """
+    if not hasattr(infile, "read"):
+        with open(infile, "rb") as dcm_file:
+            return read_header(dcm_file, tags)
+    wanted = {parse_tag(tag) for tag in tags}
+    last_tag = max(wanted) if wanted else (0, 0)
+    header = dict()
+
+    # Read the file meta information, which is always explicit VR little
+    # endian, for the transfer syntax of the rest of the file
+    preamble = infile.read(132)
+    if len(preamble) != 132 or preamble[128:] != b"DICM":
+        return read_bare_header(_Prefixed(preamble, infile), wanted, last_tag)
+    reader = _Reader(infile)
+    try:
+        meta = dict()
+        tag = reader.read_elements(wanted | {(0x0002, 0x0010)}, meta,
+                                   (0x0002, 0xFFFF), stop_group=0x0002)
+    except EOFError:
+        raise DicomHeaderError("File meta information is cut off")
+    header.update((key, value) for key, value in meta.items() if key in wanted)
+    syntax = meta.get((0x0002, 0x0010), "")
+    if syntax == DEFLATED:
+        raise DicomHeaderError("Deflated transfer syntax is not supported")
+    if tag is None or tag > last_tag:
+        return header
+
+    # Read the rest of the header, starting from the tag already read
+    reader = _Reader(infile, implicit=(syntax == IMPLICIT_LITTLE),
+                     big_endian=(syntax == EXPLICIT_BIG))
+    if reader.endian == ">":
+        tag = struct.unpack(">HH", struct.pack("<HH", *tag))
+    try:
+        vr, length = reader.read_vr_and_length(tag)
+        if length == UNDEFINED_LENGTH:
+            reader.skip_undefined(vr)
+        elif tag in wanted:
+            header[tag] = decode_value(reader.read(length), vr, reader.endian)
+        else:
+            reader.skip(length)
+        reader.read_elements(wanted, header, last_tag)
+    except EOFError:
+        pass
+    return header
+
+
+def read_bare_header(infile, wanted, last_tag):
+    """
+    Read some tags from the header of a DICOM file which has no preamble or
+    file meta information, so it is implicit VR little endian from its start.
+    :param infile: Binary file object at the start of the file
+    :param wanted: Set of (group, element) tuples to read
+    :param last_tag: Tuple, the tag after which to stop reading
+    :return: Dictionary mapping each wanted tag in the file to its value
+    """
+    reader = _Reader(infile, implicit=True)
+    try:
+        tag = reader.read_tag()
+        vr, length = reader.read_vr_and_length(tag)
+    except EOFError:
+        raise DicomHeaderError("No DICOM preamble")
+
+    # Such a file starts with the identifying elements of group 0008, so
+    # anything else is not DICOM
+    if tag[0] != 0x0008 or length > MAX_BARE_FIRST_LENGTH:
+        raise DicomHeaderError("No DICOM preamble, and not implicit VR "
+                               "little endian")
+    header = dict()
+    if tag > last_tag:
+        return header
+    try:
+        if tag in wanted:
+            header[tag] = decode_value(reader.read(length), vr)
+        else:
+            reader.skip(length)
+        reader.read_elements(wanted, header, last_tag)
+    except EOFError:
+        pass
+    return header
+
+
+def first_dicom(series_dir):
+    """
+    :param series_dir: Path to a folder of DICOM files
+    :return: Path to the folder's first file in sorted order, or None
+    """
+    names = sorted(entry.name for entry in os.scandir(series_dir)
+                   if entry.is_file())
+    return os.path.join(series_dir, names[0]) if names else None
+
+
+def sop_class_name(uid):
+    """
+    :param uid: String, a SOP class UID
+    :return: String, dcmdump's name for the SOP class, or the UID itself
+    """
+    return SOP_CLASS_NAMES.get(uid, uid)
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Print the values of some tags of a DICOM file, one per "
+                    "line, in the order given. A tag which the file does not "
+                    "have is printed as an empty line."
+    )
+    parser.add_argument("dcm", help="Path to a DICOM file, or to a folder to "
+                        "read the first DICOM file of")
+    parser.add_argument("tags", nargs="+", help="Tags to print, like "
+                        "0008,0070")
+    return parser
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    try:
+        tags = [parse_tag(tag) for tag in args.tags]
+        dcm_path = first_dicom(args.dcm) if os.path.isdir(args.dcm) \
+            else args.dcm
+        if dcm_path is None:
+            raise DicomHeaderError("No files in {}".format(args.dcm))
+        header = read_header(dcm_path, tags)
+    except (OSError, DicomHeaderError) as e:
+        print("ERROR: Could not read DICOM header: {}".format(e),
+              file=sys.stderr)
+        return 1
+    for tag in tags:
+        value = header.get(tag, "")
+        if tag == MEDIA_STORAGE_SOP_CLASS:
+            value = sop_class_name(value)
+        print(value)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#! /usr/bin/env python3
+
+"""
+Per-file download throughput log for aws_downloader.py
+Watches the files which a downloadcmd call is downloading, writes one JSON
+record per .tgz file with its s3 path, size, download time, number of attempts,
+final status, and the ID of the run which wrote it, and reports the throughput
+in MB/s per subject, per modality, and over time from those records. Each run
+appends to the log, so earlier runs' records stay in it.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    from stage_metrics import write_record
+except ImportError:
+    from src.stage_metrics import write_record
+
+# Seconds between checks of the files being downloaded. A file's download time
+# is measured from when it first appears until its size stops changing, so it
+# is only accurate to about this much. A file which is already whole when it
+# first appears, e.g. because downloadcmd renamed it from a temporary name, is
+# measured from the start of the downloadcmd call instead.
+POLL_INTERVAL = 0.5
+
+# Final status of each file in the throughput log
+DOWNLOADED = "downloaded"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class DownloadWatcher(object):
+    """
+    Background thread which polls a folder while downloadcmd downloads into
+    it, and notes when each expected file appeared and when its size last
+    changed. Use it as a context manager around the downloadcmd call.
+    """
+    def __init__(self, download_dir, file_names):
+        """
+        :param download_dir: Path to the folder which downloadcmd downloads
+                             into; files can be anywhere below it
+        :param file_names: Iterable of the names of the files to watch for
+        """
+        self.download_dir = download_dir
+        self.file_names = set(file_names)
+        self.seen = dict()  # Maps file name to [first seen, last grew, size]
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def __enter__(self):
+        self.started = time.time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+        self._poll()
+
+    def _watch(self):
+        while not self._stop.wait(POLL_INTERVAL):
+            self._poll()
+
+    def _poll(self):
+        now = time.time()
+        for root, _, file_names in os.walk(self.download_dir):
+            for file_name in self.file_names.intersection(file_names):
+                try:
+                    size = os.path.getsize(os.path.join(root, file_name))
+                except OSError:
+                    continue
+                seen = self.seen.setdefault(file_name, [now, now, size])
+                if seen[2] != size:
+                    seen[1:] = [now, size]
+
+    def get_duration(self, file_name):
+        """
+        :param file_name: Name of a watched file
+        :return: Float, seconds it took to download, at least POLL_INTERVAL,
+                 or None if it never appeared
+        """
+        if file_name not in self.seen:
+            return None
+        first_seen, last_grew, _ = self.seen[file_name]
+
+        # If the file never grew after it appeared, then it was downloaded
+        # under another name, which could have started when the call did
+        start = first_seen if last_grew > first_seen else self.started
+        return max(last_grew - start, POLL_INTERVAL)
+
+    def get_finished(self, file_name):
+        """
+        :param file_name: Name of a watched file
+        :return: Float, time (in seconds since the epoch) when its size last
+                 changed, or None if it never appeared
+        """
+        if file_name not in self.seen:
+            return None
+        return self.seen[file_name][1]
+
+
+def make_run_id():
+    """
+    :return: String which identifies this run's records in a throughput log
+    """
+    return "{}-{}".format(datetime.datetime.now().isoformat(timespec="seconds"),
+                          os.getpid())
+
+
+def make_file_record(s3_link, subject, session, num_bytes, duration,
+                     attempts, status, run_id=None, finished=None):
+    """
+    :param finished: Float, time (in seconds since the epoch) when the file
+                     finished downloading, or None to use the current time
+    :return: Dictionary with one file's throughput record, ready to be logged
+    """
+    finished = datetime.datetime.now() if finished is None \
+        else datetime.datetime.fromtimestamp(finished)
+    return {"s3_path": s3_link, "subject": subject, "session": session,
+            "modality": get_modality(s3_link), "run": run_id,
+            "finished": finished.isoformat(timespec="seconds"),
+            "bytes": num_bytes,
+            "duration": None if duration is None else round(duration, 3),
+            "attempts": attempts, "status": status}
+
+
+def get_modality(s3_link):
+    """
+    :param s3_link: s3 path of an ABCD .tgz file, whose name is like
+                    NDARINV..._baselineYear1Arm1_ABCD-T1-NORM_2018....tgz
+    :return: String, the image description (e.g. ABCD-T1-NORM) in the name
+    """
+    parts = os.path.basename(s3_link).split("_")
+    return parts[2] if len(parts) > 2 else ""
+
+
+def log_files(throughput_log, records):
+    """
+    Append file records to the throughput log
+    :param throughput_log: Path to the JSONL throughput log
+    :param records: Iterable of dictionaries made by make_file_record
+    :return: N/A
+    """
+    for record in records:
+        write_record(throughput_log, record)
+
+
+def report(throughput_log, bucket_minutes=1, run_id=None):
+    """
+    Print the number of files, total MB, and MB/s downloaded per subject, per
+    modality, and per time bucket. Per subject and per modality, MB/s is the
+    total size over the total download time of the downloaded files, so it is
+    the speed of one download; files whose download time was not measured
+    are left out of it. Per time bucket, MB/s is the size of the files
+    which finished in that bucket over its length, so it is the speed of all
+    parallel downloads together; a drop there while downloads are running
+    suggests throttling.
+    :param throughput_log: Path to the JSONL throughput log
+    :param bucket_minutes: Integer, minutes in each time bucket
+    :param run_id: String, ID of the run to report on, or None to report on
+                   every run in the log
+    :return: Dictionary mapping "subject", "modality", and "time" to
+             dictionaries of (files, MB, MB/s) for each of their values
+    """
+    with open(throughput_log) as infile:
+        records = [json.loads(line) for line in infile if line.strip()]
+    if run_id is not None:
+        records = [rec for rec in records if rec.get("run") == run_id]
+    counts = {status: sum(1 for rec in records if rec["status"] == status)
+              for status in (DOWNLOADED, SKIPPED, FAILED)}
+    print("Files downloaded: {}, already there: {}, failed: {}"
+          .format(counts[DOWNLOADED], counts[SKIPPED], counts[FAILED]))
+
+    downloaded = [rec for rec in records if rec["status"] == DOWNLOADED]
+    result = dict()
+    for group_by in ("subject", "modality"):
+        totals = dict()
+        for rec in downloaded:
+            if rec["duration"] is None:
+                continue
+            total = totals.setdefault(rec[group_by], [0, 0, 0])
+            total[0] += 1
+            total[1] += rec["bytes"]
+            total[2] += rec["duration"]
+        result[group_by] = {key: (files, num_bytes / 2**20,
+                                  num_bytes / 2**20 / duration)
+                            for key, (files, num_bytes, duration)
+                            in totals.items()}
+
+    bucket = datetime.timedelta(minutes=bucket_minutes)
+    totals = dict()
+    for rec in downloaded:
+        finished = datetime.datetime.fromisoformat(rec["finished"])
+        start = datetime.datetime.min + (finished - datetime.datetime.min) \
+            // bucket * bucket
+        total = totals.setdefault(start.isoformat(timespec="minutes"), [0, 0])
+        total[0] += 1
+        total[1] += rec["bytes"]
+    result["time"] = {key: (files, num_bytes / 2**20,
+                            num_bytes / 2**20 / bucket.total_seconds())
+                      for key, (files, num_bytes) in sorted(totals.items())}
+
+    for group_by, rows in result.items():
+        print("\n{:<36} {:>6} {:>12} {:>8}".format(group_by, "files", "MB",
+                                                  "MB/s"))
+        for key, (files, mb, mb_per_s) in rows.items():
+            print("{:<36} {:>6} {:>12.1f} {:>8.2f}".format(key, files, mb,
+                                                          mb_per_s))
+    return result
+
+
+def load_history(throughput_logs):
+    """
+    Read earlier runs' throughput logs to estimate how big files are and how
+    fast they download.
+    :param throughput_logs: List of paths to JSONL throughput logs; paths
+                            which do not exist are ignored
+    :return: Tuple of a dictionary mapping each s3 path to its size in bytes,
+             a dictionary mapping each modality to its mean file size in
+             bytes, and the MB/s of one download (or None if there is no
+             download time to go by)
+    """
+    sizes = dict()
+    durations = []
+    for throughput_log in throughput_logs:
+        if not os.path.exists(throughput_log):
+            continue
+        with open(throughput_log) as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                if rec["status"] == FAILED:
+                    continue
+                sizes[rec["s3_path"]] = rec["bytes"]
+                if rec["status"] == DOWNLOADED and rec["duration"] is not None:
+                    durations.append((rec["bytes"], rec["duration"]))
+
+    modality_sizes = dict()
+    for s3_link, num_bytes in sizes.items():
+        modality_sizes.setdefault(get_modality(s3_link), []).append(num_bytes)
+    mean_sizes = {modality: sum(all_bytes) / len(all_bytes)
+                  for modality, all_bytes in modality_sizes.items()}
+    total_duration = sum(duration for _, duration in durations)
+    mb_per_s = (sum(num_bytes for num_bytes, _ in durations) / 2**20
+                / total_duration) if total_duration else None
+    return sizes, mean_sizes, mb_per_s
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Report download throughput from a throughput log "
+                    "written by aws_downloader.py."
+    )
+    parser.add_argument("throughput_log",
+                        help="Path to a *_throughput_log.jsonl file")
+    parser.add_argument("--bucket-minutes", type=int, default=1,
+                        dest="bucket_minutes",
+                        help="Minutes in each time bucket. Default: 1")
+    parser.add_argument("--run", dest="run_id", default=None,
+                        help="Only report on the records of the run with "
+                             "this ID. Default: every run in the log")
+    return parser
+
+
+def main():
+    args = generate_parser().parse_args()
+    report(args.throughput_log, args.bucket_minutes, args.run_id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
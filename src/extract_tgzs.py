@@ -0,0 +1,371 @@
+#! /usr/bin/env python3
+
+"""
+Unpack a subject session's .tgz files in parallel for unpack_stages.py
+Each archive is extracted by its own tar process into a private folder, so
+archives are decompressed on several cores at once, and large archives can be
+decompressed with pigz. The private folders are then merged into the DCMs
+folder in the same order as the archives, so that if two archives write to the
+same series folder, the result is the same as extracting them one at a time:
+files which are in both are kept from the later archive, and are reported.
+It can then save an inventory of the unpacked series for the later stages.
+
+With --filter, each archive is read as a stream instead, and the header of
+each DICOM in it is read before the DICOM is written. RawDataStorage slices,
+and the slices of series which are not of a selected modality, are skipped,
+so they are never written to scratch. Series whose description is not one of
+the ABCD image descriptions cannot be given a modality, so they are kept, and
+reported. With --dcm2bids-config, series whose description matches no
+description in that dcm2bids config are skipped, too.
+"""
+
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from dicom_header import (DicomHeaderError, MEDIA_STORAGE_SOP_CLASS,
+                              read_header, SERIES_DESCRIPTION, sop_class_name)
+    from series_selection import SELECTION_RULES
+    from session_inventory import build_inventory, write_inventory
+except ImportError:
+    from src.dicom_header import (DicomHeaderError, MEDIA_STORAGE_SOP_CLASS,
+                                  read_header, SERIES_DESCRIPTION,
+                                  sop_class_name)
+    from src.series_selection import SELECTION_RULES
+    from src.session_inventory import build_inventory, write_inventory
+
+# Environment variables which configure extraction in unpack_stages.py
+JOBS_ENV_VAR = "ABCD2BIDS_UNTAR_JOBS"
+PIGZ_ENV_VAR = "ABCD2BIDS_PIGZ_MIN_MB"
+MODALITIES_ENV_VAR = "ABCD2BIDS_MODALITIES"
+
+# Tags read from each DICOM to decide whether to skip it
+FILTER_TAGS = (MEDIA_STORAGE_SOP_CLASS, SERIES_DESCRIPTION)
+
+# Name of the folder inside the DCMs folder to extract each archive into
+PARTS_DIR_NAME = ".extracting"
+
+
+def extract_tgz(tgz_path, dest_dir, use_pigz=False):
+    """
+    :param tgz_path: Path to a .tgz file
+    :param dest_dir: Path to the folder to extract it into
+    :param use_pigz: True to decompress it with pigz instead of gzip
+    :return: Integer, tar's exit code
+    """
+    os.makedirs(dest_dir)
+    tar_cmd = ["tar", "-xzf", tgz_path, "-C", dest_dir]
+    if use_pigz:
+        tar_cmd[1:2] = ["--use-compress-program=pigz", "-xf"]
+    return subprocess.call(tar_cmd)
+
+
+class MemberFilter(object):
+    """
+    Decides which DICOMs to skip while streaming them out of an archive
+    """
+    def __init__(self, config_path=None, modalities=None):
+        """
+        :param config_path: Path to a dcm2bids config file to skip the series
+                            whose description matches none in it, or None to
+                            keep series whatever their description
+        :param modalities: List of the selected modalities, or None for all
+        """
+        self.patterns = None
+        if config_path:
+            with open(config_path) as infile:
+                self.patterns = [
+                    description["criteria"]["SeriesDescription"]
+                    for description in json.load(infile)["descriptions"]
+                    if "SeriesDescription" in description["criteria"]
+                ]
+        self.modalities = modalities
+
+        # Map each image description to its modality, longest first so that
+        # e.g. ABCD-fMRI-FM-AP is matched before ABCD-fMRI-FM
+        self.image_modalities = sorted(
+            ((desc, rule["modality"]) for rule in SELECTION_RULES
+             for _, descs in rule["alternatives"] for desc in descs),
+            key=lambda desc_modality: -len(desc_modality[0]))
+        self.keep_series = dict()
+
+    def is_used(self, description):
+        """
+        :param description: String, a DICOM's series description
+        :return: False if the series is of a modality which was not selected,
+                 or if a dcm2bids config was given and matches none of it,
+                 else True
+        """
+        if description not in self.keep_series:
+            used = self.patterns is None or any(
+                fnmatch.fnmatchcase(description, pattern)
+                for pattern in self.patterns)
+            if used and self.modalities is not None:
+                for image_desc, modality in self.image_modalities:
+                    if description.startswith(image_desc):
+                        used = modality in self.modalities
+                        break
+                else:
+                    print("WARNING: Keeping series {!r}, which is not of a "
+                          "known modality".format(description), flush=True)
+            self.keep_series[description] = used
+        return self.keep_series[description]
+
+    def skip_reason(self, header):
+        """
+        :param header: Dictionary of a DICOM's FILTER_TAGS from read_header
+        :return: String saying why to skip the DICOM, or None to keep it
+        """
+        if sop_class_name(header.get(MEDIA_STORAGE_SOP_CLASS, "")) \
+                == "RawDataStorage":
+            return "RawDataStorage"
+        description = header.get(SERIES_DESCRIPTION)
+        if description is not None and not self.is_used(description):
+            return "unused series"
+        return None
+
+
+class _RecordingReader(object):
+    """
+    Wraps a binary file object, keeping a copy of every byte read from it
+    """
+    def __init__(self, infile):
+        self.infile = infile
+        self.data = []
+
+    def read(self, num_bytes=-1):
+        block = self.infile.read(num_bytes)
+        self.data.append(block)
+        return block
+
+
+def stream_tgz(tgz_path, dest_dir, member_filter, use_pigz=False):
+    """
+    Extract a .tgz file as a stream, reading each DICOM's header from the
+    archive and skipping the DICOMs which member_filter says to skip.
+    :param tgz_path: Path to a .tgz file
+    :param dest_dir: Path to the folder to extract it into
+    :param member_filter: MemberFilter deciding which DICOMs to skip
+    :param use_pigz: True to decompress it with pigz instead of gzip
+    :return: Tuple of the exit code (0 if the archive was extracted, else 1)
+             and a dictionary mapping each skip reason to the number of files
+             and bytes skipped for it
+    """
+    os.makedirs(dest_dir)
+    dest_dir = os.path.abspath(dest_dir)
+    skipped = dict()
+    unzip = subprocess.Popen(["pigz" if use_pigz else "gzip", "-dc", tgz_path],
+                             stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=unzip.stdout, mode="r|") as tar:
+            for member in tar:
+                target = os.path.abspath(os.path.join(dest_dir, member.name))
+                if not target.startswith(dest_dir + os.sep):
+                    print("WARNING: Not extracting {} from {}, which is "
+                          "outside the archive's folder".format(member.name,
+                                                                 tgz_path))
+                elif member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                elif not member.isfile():
+                    print("WARNING: Not extracting {} from {}, which is not "
+                          "a file or folder".format(member.name, tgz_path))
+                else:
+                    extract_member(tar, member, target, member_filter,
+                                   skipped)
+    except (tarfile.TarError, OSError) as e:
+        print("ERROR: {}: {}".format(tgz_path, e))
+        unzip.kill()
+        unzip.wait()
+        return 1, skipped
+    unzip.stdout.close()
+    return (1 if unzip.wait() else 0), skipped
+
+
+def extract_member(tar, member, target, member_filter, skipped):
+    """
+    Write one file from a tar stream, unless it is a DICOM to skip.
+    :param tar: tarfile.TarFile being streamed
+    :param member: tarfile.TarInfo of a regular file in tar
+    :param target: Path to write the file to
+    :param member_filter: MemberFilter deciding which DICOMs to skip
+    :param skipped: Dictionary mapping each skip reason to a list of the
+                    number of files and bytes skipped for it, updated here
+    :return: N/A
+    """
+    infile = _RecordingReader(tar.extractfile(member))
+    try:
+        header = read_header(infile, FILTER_TAGS)
+    except (DicomHeaderError, EOFError):
+        header = None  # Not a DICOM, like EventRelatedInformation files
+    reason = header and member_filter.skip_reason(header)
+    if reason:
+        counts = skipped.setdefault(reason, [0, 0])
+        counts[0] += 1
+        counts[1] += member.size
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as outfile:
+        outfile.writelines(infile.data)
+        shutil.copyfileobj(infile.infile, outfile)
+    os.chmod(target, member.mode & 0o777)
+    os.utime(target, (member.mtime, member.mtime))
+
+
+def merge_tree(src_dir, dest_dir, collisions):
+    """
+    Move everything in one folder into another. Folders in both are merged,
+    and files in both are replaced with the ones from src_dir.
+    :param src_dir: Path to the folder to move everything out of
+    :param dest_dir: Path to the folder to move everything into
+    :param collisions: List to append the path of each replaced file to
+    :return: N/A
+    """
+    for entry in os.scandir(src_dir):
+        target = os.path.join(dest_dir, entry.name)
+        if not os.path.lexists(target):
+            os.rename(entry.path, target)
+        elif entry.is_dir(follow_symlinks=False) and os.path.isdir(target) \
+                and not os.path.islink(target):
+            merge_tree(entry.path, target, collisions)
+        else:
+            collisions.append(target)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace(entry.path, target)
+
+
+def extract_tgzs(tgz_dir, dcm_dir, jobs=1, pigz_min_mb=None,
+                 member_filter=None):
+    """
+    Extract every .tgz file in a folder into one folder, several at a time.
+    :param tgz_dir: Path to the folder with the .tgz files
+    :param dcm_dir: Path to the folder to extract them all into
+    :param jobs: Integer, the most archives to extract at once
+    :param pigz_min_mb: Float, size in MB above which archives are
+                        decompressed with pigz, or None to never use pigz
+    :param member_filter: MemberFilter deciding which DICOMs to skip, or None
+                          to extract every file with tar
+    :return: List of the paths of the archives which failed to extract
+    """
+    tgzs = sorted(glob.glob(os.path.join(tgz_dir, "*.tgz")))
+    use_pigz = pigz_min_mb is not None and shutil.which("pigz") is not None
+    if pigz_min_mb is not None and not use_pigz:
+        print("WARNING: pigz is not installed, so using gzip instead")
+    parts_dir = os.path.join(dcm_dir, PARTS_DIR_NAME)
+    os.makedirs(parts_dir, exist_ok=True)
+
+    skipped = dict()
+
+    def extract(ix_and_tgz):
+        ix, tgz = ix_and_tgz
+        print(tgz, flush=True)
+        part_dir = os.path.join(parts_dir, str(ix))
+        pigz = use_pigz and os.path.getsize(tgz) > pigz_min_mb * 2**20
+        if member_filter is None:
+            return extract_tgz(tgz, part_dir, pigz)
+        exit_code, tgz_skipped = stream_tgz(tgz, part_dir, member_filter,
+                                            pigz)
+        for reason, (num_files, num_bytes) in tgz_skipped.items():
+            print("Skipped {} {} files ({:.1f} MB) in {}".format(
+                num_files, reason, num_bytes / 2**20, os.path.basename(tgz)))
+        return exit_code
+
+    # Merge the archives into dcm_dir in order, each as soon as it and all
+    # of the archives before it are extracted
+    failed = []
+    collisions = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for (ix, tgz), exit_code in zip(enumerate(tgzs),
+                                        pool.map(extract, enumerate(tgzs))):
+            if exit_code != 0:
+                failed.append(tgz)
+            num_before = len(collisions)
+            merge_tree(os.path.join(parts_dir, str(ix)), dcm_dir, collisions)
+            for path in collisions[num_before:]:
+                print("WARNING: {} is also in an earlier archive; keeping the "
+                      "one from {}".format(os.path.relpath(path, dcm_dir),
+                                           os.path.basename(tgz)))
+    shutil.rmtree(parts_dir)
+
+    for tgz in failed:
+        print("ERROR: Failed to extract {}".format(tgz))
+    return failed
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Unpack every .tgz file in a folder into one folder, "
+                    "several at a time."
+    )
+    parser.add_argument("tgz_dir", help="Folder with the .tgz files")
+    parser.add_argument("dcm_dir", help="Folder to unpack them into")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=int(os.environ.get(JOBS_ENV_VAR) or 1),
+        help="Number of archives to unpack at once. Default: ${} or 1"
+             .format(JOBS_ENV_VAR)
+    )
+    parser.add_argument(
+        "--pigz-min-mb",
+        type=float,
+        dest="pigz_min_mb",
+        default=float(os.environ[PIGZ_ENV_VAR]) if os.environ.get(PIGZ_ENV_VAR)
+        else None,
+        help="Decompress archives bigger than this many MB with pigz, if it "
+             "is installed. Default: ${}, or never".format(PIGZ_ENV_VAR)
+    )
+    parser.add_argument(
+        "--filter",
+        action="store_true",
+        help="Skip RawDataStorage DICOMs and the DICOMs of series which are "
+             "not of one of --modalities, instead of unpacking every file"
+    )
+    parser.add_argument(
+        "--dcm2bids-config",
+        dest="dcm2bids_config",
+        help="With --filter, also skip series whose description matches none "
+             "in this dcm2bids config file, e.g. abcd_dcm2bids.conf. By "
+             "default, series are kept whatever their description."
+    )
+    parser.add_argument(
+        "--modalities",
+        nargs="+",
+        default=os.environ[MODALITIES_ENV_VAR].split(",")
+        if os.environ.get(MODALITIES_ENV_VAR) else None,
+        help="With --filter, skip series of other modalities. Default: "
+             "${}, a comma-separated list, or all modalities"
+             .format(MODALITIES_ENV_VAR)
+    )
+    parser.add_argument(
+        "--inventory",
+        help="Path to a JSON file to save an inventory of the unpacked "
+             "series in, for session_inventory.py to read"
+    )
+    return parser
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer.")
+    member_filter = MemberFilter(args.dcm2bids_config, args.modalities) \
+        if args.filter else None
+    failed = extract_tgzs(args.tgz_dir, args.dcm_dir, args.jobs,
+                          args.pigz_min_mb, member_filter)
+    if args.inventory:
+        write_inventory(build_inventory(args.dcm_dir), args.inventory)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+
+"""
+Offline stand-in for the NDA's downloadcmd
+Takes the same -dp, -t, and -d arguments that aws_downloader.py gives
+downloadcmd, and "downloads" each s3 link in the -t file into the -d folder's
+image03 subfolder, the same place that downloadcmd puts it. Each file is copied
+from a local mirror folder if one is given, or else made up as a small .tgz
+archive, so that downloading can be tested without NDA credentials, e.g.:
+    python3 src/aws_downloader.py ... --downloadcmd src/fake_downloadcmd.py
+"""
+
+import argparse
+import gzip
+import io
+import os
+import shutil
+import sys
+import tarfile
+import time
+
+# Environment variables which configure the stand-in
+SOURCE_ENV_VAR = "FAKE_DOWNLOADCMD_SOURCE"
+STARTUP_ENV_VAR = "FAKE_DOWNLOADCMD_STARTUP"
+RATE_ENV_VAR = "FAKE_DOWNLOADCMD_RATE"
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Offline stand-in for downloadcmd which copies or makes "
+                    "up the files listed in an s3 links file."
+    )
+    parser.add_argument("-dp", dest="package_id", required=True,
+                        help="NDA package ID. Ignored.")
+    parser.add_argument("-t", dest="links_file", required=True,
+                        help="Path to a text file with one s3 link per line")
+    parser.add_argument("-d", dest="download_dir", required=True,
+                        help="Folder to download the files into")
+    parser.add_argument(
+        "--source",
+        default=os.environ.get(SOURCE_ENV_VAR),
+        help="Folder to copy each file from, by its file name. If a file is "
+             "not in it, that file fails to download. If this is not given, "
+             "every file is made up. Default: ${}".format(SOURCE_ENV_VAR)
+    )
+    parser.add_argument(
+        "--startup",
+        type=float,
+        default=float(os.environ.get(STARTUP_ENV_VAR, 0)),
+        help="Seconds to wait before downloading anything, to act like the "
+             "time downloadcmd takes to start and authenticate. "
+             "Default: ${} or 0".format(STARTUP_ENV_VAR)
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=float(os.environ.get(RATE_ENV_VAR, 0)),
+        help="MB/s to copy files from --source at, to act like a network "
+             "download; 0 means as fast as possible. Default: ${} or 0"
+             .format(RATE_ENV_VAR)
+    )
+    return parser
+
+
+def main():
+    args = generate_parser().parse_args()
+    time.sleep(args.startup)
+    with open(args.links_file) as infile:
+        s3_links = [line.strip() for line in infile if line.strip()]
+
+    image03_dir = os.path.join(args.download_dir, "image03")
+    os.makedirs(image03_dir, exist_ok=True)
+    num_failed = 0
+    for s3_link in s3_links:
+        file_name = os.path.basename(s3_link)
+        dest = os.path.join(image03_dir, file_name)
+        if args.source is None:
+            make_tgz(dest, s3_link)
+        elif os.path.isfile(os.path.join(args.source, file_name)):
+            copy_file(os.path.join(args.source, file_name), dest, args.rate)
+        else:
+            print("Could not download {}".format(s3_link))
+            num_failed += 1
+    print("Downloaded {} of {} files into {}".format(
+        len(s3_links) - num_failed, len(s3_links), image03_dir))
+    return 1 if num_failed else 0
+
+
+def copy_file(src, dest, rate):
+    """
+    :param src: Path to the file to copy
+    :param dest: Path to copy it to
+    :param rate: Float, MB/s to copy at, or 0 to copy as fast as possible
+    :return: N/A
+    """
+    if not rate:
+        shutil.copyfile(src, dest)
+        return
+    chunk_size = 2**16
+    with open(src, "rb") as infile, open(dest, "wb") as outfile:
+        for chunk in iter(lambda: infile.read(chunk_size), b""):
+            outfile.write(chunk)
+            outfile.flush()
+            time.sleep(len(chunk) / (rate * 2**20))
+
+
+def make_tgz(tgz_path, s3_link):
+    """
+    Make up a small .tgz archive with one text file in it. The archive is
+    the same every time it is made for the same s3 link.
+    :param tgz_path: Path to the archive to write
+    :param s3_link: String, the s3 link which the archive stands in for
+    :return: N/A
+    """
+    contents = (s3_link + "\n").encode("utf-8")
+    info = tarfile.TarInfo(os.path.splitext(os.path.basename(tgz_path))[0]
+                           + "/s3_link.txt")
+    info.size = len(contents)
+    with gzip.GzipFile(tgz_path, "wb", mtime=0) as gz_file:
+        with tarfile.open(fileobj=gz_file, mode="w") as tgz:
+            tgz.addfile(info, io.BytesIO(contents))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
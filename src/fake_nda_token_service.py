@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+
+"""
+Offline stand-in for the NDA web service which makes AWS tokens
+Answers the same generateToken SOAP requests that NDATokenGenerator sends
+with made-up tokens which expire after a given number of seconds, so that
+making and caching tokens can be tested without NDA credentials, e.g.:
+    python3 src/fake_nda_token_service.py --port 8765 &
+    NDA_TOKEN_URL=http://localhost:8765 python3 src/nda_token_cache.py -u me -p pw
+"""
+
+import argparse
+import binascii
+import datetime
+import hashlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import sys
+import threading
+import xml.etree.ElementTree as etree
+
+SOAP_SCHEMA = "http://schemas.xmlsoap.org/soap/envelope/"
+DATA_SCHEMA = "http://gov/nih/ndar/ws/datamanager/server/bean/jaxb"
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Offline stand-in for the NDA web service which makes "
+                    "AWS tokens."
+    )
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port to listen on at localhost. Default: 8765")
+    parser.add_argument("--lifetime", type=float, default=3600,
+                        help="Seconds until each token expires. Default: 3600")
+    parser.add_argument("--password",
+                        help="Only make tokens for requests with this "
+                             "password; by default, any password works.")
+    return parser
+
+
+def make_handler(lifetime, password=None):
+    """
+    :param lifetime: Float, seconds until each token made expires
+    :param password: String, the only password to make tokens for, or None
+    :return: BaseHTTPRequestHandler subclass which answers token requests.
+             Its tokens_made attribute counts the tokens it has made.
+    """
+    password_hash = None if password is None else binascii.hexlify(
+        hashlib.sha1(password.encode("utf-8")).digest()).decode("utf-8")
+
+    class TokenHandler(BaseHTTPRequestHandler):
+        tokens_made = 0
+        lock = threading.Lock()
+
+        def do_POST(self):
+            request = etree.fromstring(
+                self.rfile.read(int(self.headers["Content-Length"])))
+            user = request.find(".//user")
+            if password_hash is not None and \
+                    user.findtext("password") != password_hash:
+                body = ("<errorMessage>Invalid username or password"
+                        "</errorMessage>")
+            else:
+                with TokenHandler.lock:
+                    TokenHandler.tokens_made += 1
+                    token_ix = TokenHandler.tokens_made
+                expiration = datetime.datetime.now(datetime.timezone.utc) \
+                    + datetime.timedelta(seconds=lifetime)
+                body = ("<ns:TokenElement xmlns:ns=\"{}\">"
+                        "<accessKey>FAKEACCESS{}</accessKey>"
+                        "<secretKey>fakesecret{}</secretKey>"
+                        "<sessionToken>fakesession{}-{}</sessionToken>"
+                        "<expirationDate>{}</expirationDate>"
+                        "</ns:TokenElement>").format(
+                            DATA_SCHEMA, token_ix, token_ix,
+                            user.findtext("name"), token_ix,
+                            expiration.isoformat(timespec="seconds"))
+            response = ("<soap:Envelope xmlns:soap=\"{}\"><soap:Body>{}"
+                        "</soap:Body></soap:Envelope>").format(SOAP_SCHEMA,
+                                                               body)
+            response = response.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            print("{} tokens made; {}".format(TokenHandler.tokens_made,
+                                              format % args), flush=True)
+
+    return TokenHandler
+
+
+def main():
+    args = generate_parser().parse_args()
+    server = HTTPServer(("localhost", args.port),
+                        make_handler(args.lifetime, args.password))
+    print("Making fake NDA tokens at http://localhost:{}".format(args.port),
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
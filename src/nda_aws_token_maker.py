@@ -5,17 +5,13 @@ import os
 import sys
 
 try:
-    from nda_aws_token_generator import *
+    from nda_token_cache import TokenCache, write_aws_credentials
 except ImportError:
-    from src.nda_aws_token_generator import *
+    from src.nda_token_cache import TokenCache, write_aws_credentials
 
 if sys.version_info[0] < 3:
     # Python 2 specific imports
     input = raw_input
-    from ConfigParser import ConfigParser
-else:
-    # Python 3 specific imports
-    from configparser import ConfigParser
 
 
 # Try to get NDA credentials from command line args passed in; if there are no
@@ -27,28 +23,17 @@ else:
     username = input('Enter your NIMH Data Archives username: ')
     password = getpass.getpass('Enter your NIMH Data Archives password: ')
 
-web_service_url = 'https://nda.nih.gov/DataManager/dataManager'
-
-generator = NDATokenGenerator(web_service_url)
-
+# Reuse the cached token until it is about to expire, instead of making a new
+# one every time
 try:
-    token = generator.generate_token(username, password)
+    token, expires_at = TokenCache(username, password).get_token()
 except Exception as e:
     print("Failed to create NDA token.")
     sys.exit(1)
 
-# Read .aws/credentials from the user's HOME directory, add a NDA profile, and update with credentials
-parser = ConfigParser()
-parser.read(os.path.expanduser('~/.aws/credentials'))
-
-if not parser.has_section('NDA'):
-    parser.add_section('NDA')
-parser.set('NDA', 'aws_access_key_id', token.access_key)
-parser.set('NDA', 'aws_secret_access_key', token.secret_key)
-parser.set('NDA', 'aws_session_token', token.session)
-
-with open (os.path.expanduser('~/.aws/credentials'), 'w') as configfile:
-    parser.write(configfile)
+# Save the token in the NDA profile of .aws/credentials in the user's HOME
+# directory, unless that profile already has it
+write_aws_credentials(token, os.path.expanduser('~/.aws/credentials'), 'NDA')
 
 print('aws_access_key_id=%s\n'
       'aws_secret_access_key=%s\n'
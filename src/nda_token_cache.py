@@ -0,0 +1,288 @@
+#! /usr/bin/env python3
+
+"""
+Cache of NDA AWS tokens which knows when they expire
+Keeps the last token which the NDA made in a JSON file, with its expiration
+time, and reuses it until it is about to expire instead of asking the NDA for
+a new one every time. The cache is locked while a new token is being made, so
+that parallel workers on one host make one token between them. It can also
+keep an AWS credentials file up to date in the background, for downloads that
+take longer than a token lasts, e.g.:
+    python3 src/nda_token_cache.py --username me --watch &
+"""
+
+import argparse
+from configparser import ConfigParser
+import datetime
+import fcntl
+import getpass
+import json
+import os
+import sys
+import threading
+
+try:
+    from nda_aws_token_generator import NDATokenGenerator, Token
+except ImportError:
+    from src.nda_aws_token_generator import NDATokenGenerator, Token
+
+# Default paths and NDA web service to make tokens with
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".abcd2bids",
+                             "nda_token.json")
+DEFAULT_CREDENTIALS = os.path.join(os.path.expanduser("~"), ".aws",
+                                   "credentials")
+DEFAULT_URL = "https://nda.nih.gov/DataManager/dataManager"
+
+# Environment variable to point token makers at another web service, like
+# src/fake_nda_token_service.py
+URL_ENV_VAR = "NDA_TOKEN_URL"
+
+# Make a new token once the cached one has less than this long left
+REFRESH_MARGIN = datetime.timedelta(minutes=15)
+
+# How long to assume that a token lasts if its expiration cannot be parsed
+ASSUMED_LIFETIME = datetime.timedelta(hours=1)
+
+
+def parse_expiration(expiration, made_at):
+    """
+    :param expiration: String, the expiration time of a token from the NDA
+    :param made_at: datetime.datetime when the token was made
+    :return: Timezone-aware datetime.datetime when the token expires, or
+             ASSUMED_LIFETIME after made_at if expiration cannot be parsed
+    """
+    try:
+        expires_at = datetime.datetime.fromisoformat(
+            expiration.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return made_at + ASSUMED_LIFETIME
+    return expires_at if expires_at.tzinfo else expires_at.astimezone()
+
+
+class TokenCache(object):
+    """
+    NDA AWS token for one user, cached in a file until it nearly expires
+    """
+    def __init__(self, username, password, cache_path=DEFAULT_CACHE,
+                 url=None, margin=REFRESH_MARGIN):
+        """
+        :param username: String, NDA username
+        :param password: String, NDA password
+        :param cache_path: Path to the JSON file to cache the token in
+        :param url: String, URL of the NDA web service which makes tokens.
+                    Default: $NDA_TOKEN_URL or DEFAULT_URL
+        :param margin: datetime.timedelta, how long before the token expires
+                       to make a new one
+        """
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.url = url or os.environ.get(URL_ENV_VAR, DEFAULT_URL)
+        self.margin = margin
+
+    def read(self):
+        """
+        :return: Tuple of the cached Token and the datetime when it expires,
+                 or (None, None) if there is no usable cached token for the
+                 user and web service
+        """
+        try:
+            with open(self.cache_path) as infile:
+                cached = json.load(infile)
+            if cached["username"] != self.username or cached["url"] != self.url:
+                return None, None
+            return (Token(cached["access_key"], cached["secret_key"],
+                          cached["session"], cached["expiration"]),
+                    datetime.datetime.fromisoformat(cached["expires_at"]))
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def write(self, token, expires_at):
+        """
+        Save a token to the cache file, readable only by its owner. It is
+        written to a temporary file first and then moved into place, so that
+        readers never see a partly written cache.
+        :param token: Token to save
+        :param expires_at: datetime.datetime when the token expires
+        :return: N/A
+        """
+        temp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as outfile:
+            json.dump({"username": self.username, "url": self.url,
+                       "access_key": token.access_key,
+                       "secret_key": token.secret_key,
+                       "session": token.session,
+                       "expiration": token.expiration,
+                       "expires_at": expires_at.isoformat()}, outfile)
+        os.replace(temp_path, self.cache_path)
+
+    def is_fresh(self, expires_at):
+        """
+        :param expires_at: datetime.datetime when a token expires, or None
+        :return: True if the token can still be used for at least margin
+        """
+        return expires_at is not None and expires_at - self.margin \
+            > datetime.datetime.now(datetime.timezone.utc)
+
+    def get_token(self, force=False):
+        """
+        Get the cached token if it is fresh, or else make a new one and cache
+        it. Only one process or thread at a time can make a new token; the
+        others wait for it, then use the token it made.
+        :param force: True to make a new token even if the cached one is fresh
+        :return: Tuple of the Token and the datetime when it expires
+        """
+        token, expires_at = self.read()
+        if not force and self.is_fresh(expires_at):
+            return token, expires_at
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)),
+                    exist_ok=True)
+        with open(self.cache_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another worker may have made a new token while this waited
+                token, new_expires_at = self.read()
+                if self.is_fresh(new_expires_at) and \
+                        (not force or new_expires_at != expires_at):
+                    return token, new_expires_at
+                made_at = datetime.datetime.now(datetime.timezone.utc)
+                token = NDATokenGenerator(self.url).generate_token(
+                    self.username, self.password)
+                expires_at = parse_expiration(token.expiration, made_at)
+                self.write(token, expires_at)
+                return token, expires_at
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def start_refresher(self, on_refresh=None):
+        """
+        Keep the cached token fresh in a background thread, making a new one
+        whenever the cached one gets within margin of expiring.
+        :param on_refresh: Function to call with each token the thread gets,
+                           e.g. to write it to an AWS credentials file
+        :return: threading.Event to set to stop the thread
+        """
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.is_set():
+                try:
+                    token, expires_at = self.get_token()
+                    if on_refresh:
+                        on_refresh(token)
+                    wait = (expires_at - self.margin - datetime.datetime.now(
+                        datetime.timezone.utc)).total_seconds()
+                except Exception as e:
+                    print("Failed to refresh NDA token: {}".format(e))
+                    wait = 0
+                stop.wait(max(wait, 60))
+
+        threading.Thread(target=refresh, daemon=True).start()
+        return stop
+
+
+def write_aws_credentials(token, credentials_path=DEFAULT_CREDENTIALS,
+                          profile="NDA"):
+    """
+    Save a token in a profile of an AWS credentials file, unless that profile
+    already has it, so that the file is only rewritten when the token changes.
+    :param token: Token to save
+    :param credentials_path: Path to the AWS credentials file
+    :param profile: String naming the profile to save the token in
+    :return: True if the file was rewritten, else False
+    """
+    parser = ConfigParser()
+    parser.read(credentials_path)
+    keys = {"aws_access_key_id": token.access_key,
+            "aws_secret_access_key": token.secret_key,
+            "aws_session_token": token.session}
+    if parser.has_section(profile) and all(
+            parser.get(profile, key, fallback=None) == value
+            for key, value in keys.items()):
+        return False
+    if not parser.has_section(profile):
+        parser.add_section(profile)
+    for key, value in keys.items():
+        parser.set(profile, key, value)
+    os.makedirs(os.path.dirname(os.path.abspath(credentials_path)),
+                exist_ok=True)
+    temp_path = "{}.{}.tmp".format(credentials_path, os.getpid())
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as outfile:
+        parser.write(outfile)
+    os.replace(temp_path, credentials_path)
+    return True
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Get an NDA AWS token, reusing the cached one until it "
+                    "is about to expire, and save it in an AWS credentials "
+                    "file."
+    )
+    parser.add_argument("-u", "--username", help="NDA username. By default, "
+                        "the user is prompted for it.")
+    parser.add_argument("-p", "--password", help="NDA password. By default, "
+                        "the user is prompted for it.")
+    parser.add_argument("--cache", default=DEFAULT_CACHE,
+                        help="Path to the token cache. Default: " +
+                        DEFAULT_CACHE)
+    parser.add_argument("--credentials", default=DEFAULT_CREDENTIALS,
+                        help="Path to the AWS credentials file to save the "
+                        "token in. Default: " + DEFAULT_CREDENTIALS)
+    parser.add_argument("--profile", default="NDA",
+                        help="Profile of the credentials file to save the "
+                        "token in. Default: NDA")
+    parser.add_argument("--url", help="URL of the NDA web service which "
+                        "makes tokens. Default: ${} or {}"
+                        .format(URL_ENV_VAR, DEFAULT_URL))
+    parser.add_argument("--margin", type=float,
+                        default=REFRESH_MARGIN.total_seconds() / 60,
+                        help="Make a new token once the cached one has less "
+                        "than this many minutes left. Default: {:g}"
+                        .format(REFRESH_MARGIN.total_seconds() / 60))
+    parser.add_argument("--force", action="store_true",
+                        help="Make a new token even if the cached one is "
+                        "still fresh.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, and save a new token in the "
+                        "credentials file whenever the cached one is about "
+                        "to expire, until stopped.")
+    return parser
+
+
+def main():
+    args = generate_parser().parse_args()
+    username = args.username or input("Enter your NIMH Data Archives "
+                                      "username: ")
+    password = args.password or getpass.getpass("Enter your NIMH Data "
+                                                "Archives password: ")
+    cache = TokenCache(username, password, args.cache, args.url,
+                       datetime.timedelta(minutes=args.margin))
+    try:
+        token, expires_at = cache.get_token(args.force)
+    except Exception as e:
+        print("Failed to create NDA token: {}".format(e))
+        return 1
+    if write_aws_credentials(token, args.credentials, args.profile):
+        print("Saved NDA token in the {} profile of {}".format(
+            args.profile, args.credentials))
+    print("NDA token expires at {}".format(expires_at.isoformat()))
+
+    if args.watch:
+        def save(new_token):
+            if write_aws_credentials(new_token, args.credentials,
+                                     args.profile):
+                print("Saved new NDA token in the {} profile of {}".format(
+                    args.profile, args.credentials), flush=True)
+        try:
+            cache.start_refresher(save).wait()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
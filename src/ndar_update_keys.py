@@ -34,8 +34,10 @@ import getpass
 from subprocess import call
 try:
     from nda_aws_token_generator import *
+    from nda_token_cache import TokenCache
 except ImportError:
     from src.nda_aws_token_generator import *
+    from src.nda_token_cache import TokenCache
 try:
     import ConfigParser
 except ImportError:
@@ -90,16 +92,22 @@ def create_default_config(config_dir, config_file):
     f.write('[NDAR]\n')
     f.close()
 
-def make_aws_tokens(username, password):
-    web_service_url = 'https://nda.nih.gov/DataManager/dataManager'
-    generator = NDATokenGenerator(web_service_url)
+def make_aws_tokens(username, password, config_dir):
+    # Reuse the token cached in config_dir until it is about to expire
+    cache = TokenCache(username, password, os.path.normpath(config_dir + '/.abcd2bids/nda_token.json'))
     try:
-        token = generator.generate_token(username, password)
+        token, expires_at = cache.get_token()
     except Exception as e:
         print("Failed to create NDAR token.")
         sys.exit(1)
     return token
 
+def has_token(config_dir, config_file, profile, token):
+    config_aws_cli = ConfigParser.ConfigParser()
+    config_aws_cli.read(os.path.normpath(config_dir + config_file))
+    return config_aws_cli.has_section(profile) and \
+        config_aws_cli.get(profile, 'aws_session_token', fallback=None) == token.session
+
 def write_aws_config(config_dir, config_file, profile):
     config_aws_cli = ConfigParser.ConfigParser()
     # If a config file already exists read profiles from there and update
@@ -249,8 +257,8 @@ if __name__ == '__main__':
         except:
             pass
 
-    print ("Generating new keys and updating config files")
-    token = make_aws_tokens(ndar_username, ndar_password)
+    print ("Getting keys")
+    token = make_aws_tokens(ndar_username, ndar_password, config_dir)
 
     myvars={}
     myvars["accessKey"] = token.access_key
@@ -262,6 +270,11 @@ if __name__ == '__main__':
     os.environ["AWS_SESSION_TOKEN"] = myvars["sessionToken"]
 
     #Additional entries may be necessary depending on environment, to write configuration file to config_dir directory
-    write_aws_config( config_dir, '/.aws/credentials', 'NDAR')
-    write_aws_config( config_dir, '/.aws/config', 'profile NDAR')
-    write_s3cmd_config( config_dir, '/.s3cfg-ndar')
+    # Only rewrite them if the token changed since they were last written
+    if has_token( config_dir, '/.aws/credentials', 'NDAR', token) and os.path.isfile(os.path.normpath(config_dir + '/.s3cfg-ndar')):
+        print("Config files already have the current keys")
+    else:
+        print("Updating config files with new keys")
+        write_aws_config( config_dir, '/.aws/credentials', 'NDAR')
+        write_aws_config( config_dir, '/.aws/config', 'profile NDAR')
+        write_s3cmd_config( config_dir, '/.s3cfg-ndar')
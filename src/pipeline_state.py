@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+"""
+Persistent pipeline state for abcd2bids.py
+Records every (subject, session, step) unit of work in a small SQLite
+database, so that reruns can skip units which already finished with the
+same inputs and only retry the ones which failed or whose inputs changed.
+"""
+
+from contextlib import contextmanager
+import datetime
+import hashlib
+import os
+import sqlite3
+
+# Status values stored in the state database
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+
+class PipelineState(object):
+    """
+    Thin wrapper around the SQLite state database. Each call opens its own
+    connection, so one PipelineState can be shared by worker threads and the
+    same database file can be used by several processes at once.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS units ("
+                "subject TEXT NOT NULL, session TEXT NOT NULL, "
+                "step TEXT NOT NULL, status TEXT NOT NULL, "
+                "fingerprint TEXT, started TEXT, finished TEXT, "
+                "exit_code INTEGER, PRIMARY KEY (subject, session, step))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """
+        :return: Context manager giving an SQLite connection which commits
+                 on success, rolls back on error, and is always closed
+        """
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def is_done(self, subject, session, step, fingerprint):
+        """
+        :param subject: String, BIDS subject ID of the unit
+        :param session: String, session of the unit
+        :param step: String naming the step of the unit
+        :param fingerprint: String fingerprinting the unit's current inputs
+        :return: True if the unit last finished successfully with the same
+                 inputs, so it can be skipped; otherwise False
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, fingerprint FROM units WHERE subject=? AND "
+                "session=? AND step=?", (subject, session, step)
+            ).fetchone()
+        return row is not None and row == (COMPLETE, fingerprint)
+
+    def start(self, subject, session, step, fingerprint):
+        """
+        Record that a unit started running with the given inputs.
+        :return: N/A
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, NULL, "
+                "NULL)", (subject, session, step, RUNNING, fingerprint, now())
+            )
+
+    def finish(self, subject, session, step, exit_code):
+        """
+        Record that a unit finished, and whether it succeeded.
+        :param exit_code: Integer exit code of the unit; 0 means success
+        :return: N/A
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE units SET status=?, finished=?, exit_code=? WHERE "
+                "subject=? AND session=? AND step=?",
+                (COMPLETE if exit_code == 0 else FAILED, now(), exit_code,
+                 subject, session, step)
+            )
+
+
+def now():
+    """
+    :return: String with the current date and time in ISO format
+    """
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def fingerprint_strings(strings):
+    """
+    :param strings: Iterable of strings describing a unit's inputs
+    :return: String, a hash of all of the strings in order
+    """
+    hasher = hashlib.sha1()
+    for each_str in strings:
+        hasher.update(each_str.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def fingerprint_files(paths):
+    """
+    Fingerprint files by their names, sizes, and modification times, which
+    is much cheaper than hashing their contents.
+    :param paths: Iterable of paths to files
+    :return: String, a hash of every file's name, size, and modification time
+    """
+    stats = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            stats.append("{} {} {}".format(path, stat.st_size,
+                                           stat.st_mtime_ns))
+        except OSError:
+            stats.append("{} missing".format(path))
+    return fingerprint_strings(stats)
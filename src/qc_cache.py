@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+
+"""
+Columnar cache of abcd_fastqc01_reformatted.csv
+Stores the reformatted QC table once as Parquet, sorted by (pGUID, EventName,
+image_description) in small row groups, so that abcd2bids.py, aws_downloader.py
+and array_job_planner.py can each load only the subjects and sessions they need
+instead of parsing the whole CSV. The cache is rebuilt whenever the hash of the
+CSV it was made from changes. The CSV is only hashed again if its size or
+modification time no longer match the ones saved in the cache.
+"""
+
+import hashlib
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Columns which the cache is sorted, and so indexed, by
+INDEX_COLS = ['pGUID', 'EventName', 'image_description']
+
+# Keys of the cache's Parquet metadata which hold the hash of its source CSV,
+# and that CSV's size and modification time when the cache was written
+SOURCE_HASH_KEY = b'abcd2bids_source_sha1'
+SOURCE_STAT_KEY = b'abcd2bids_source_stat'
+
+# Strings which pandas.read_csv reads as missing or boolean values by default
+NA_STRINGS = ('', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+              '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN',
+              'None', 'n/a', 'nan', 'null')
+BOOL_STRINGS = {'True': True, 'TRUE': True, 'true': True,
+                'False': False, 'FALSE': False, 'false': False}
+
+# Rows per Parquet row group; smaller groups let reads skip more of the file
+ROW_GROUP_SIZE = 10000
+
+
+def get_cache_path(qc_csv):
+    """
+    :param qc_csv: Path to abcd_fastqc01_reformatted.csv
+    :return: Path to the Parquet cache of qc_csv, next to it
+    """
+    return os.path.splitext(qc_csv)[0] + '.parquet'
+
+
+def hash_file(path):
+    """
+    :param path: Path to a file
+    :return: String, the SHA-1 hash of the file's contents
+    """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(2**20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_source_stat(path):
+    """
+    :param path: Path to a file
+    :return: String with the file's size and modification time, which change
+             whenever the file is rewritten
+    """
+    stat = os.stat(path)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def read_qc_csv(qc_csv):
+    """
+    :param qc_csv: Path to abcd_fastqc01_reformatted.csv
+    :return: pandas.DataFrame with every named column of qc_csv
+    """
+    header = pd.read_csv(qc_csv, nrows=0).columns.tolist()
+    return pd.read_csv(qc_csv, usecols=list(range(len(header))))
+
+
+def as_csv_types(qc_df):
+    """
+    :param qc_df: pandas.DataFrame of strings which was written to a CSV
+    :return: pandas.DataFrame with the same column types that read_qc_csv
+             gives it after reading that CSV back: missing values for
+             NA_STRINGS, and numbers or booleans for the columns whose other
+             values are all numbers or booleans
+    """
+    typed = dict()
+    for col in qc_df.columns:
+        values = qc_df[col].where(~qc_df[col].isin(NA_STRINGS))
+        present = values.dropna()
+        if present.isin(list(BOOL_STRINGS)).all() and not present.empty:
+            typed[col] = values.map(BOOL_STRINGS)
+            continue
+        try:
+            typed[col] = pd.to_numeric(values)
+        except (TypeError, ValueError):
+            typed[col] = values.infer_objects()
+    return pd.DataFrame(typed, index=qc_df.index)
+
+
+def write_qc_cache(qc_csv, qc_df=None, source_hash=None):
+    """
+    Save the QC data in qc_csv as a Parquet cache tagged with the CSV's hash,
+    size, and modification time. The cache is written to a temporary file
+    first and then moved into place, so that parallel readers never see a
+    partly written cache.
+    :param qc_csv: Path to abcd_fastqc01_reformatted.csv
+    :param qc_df: pandas.DataFrame of the strings which were just written to
+                  qc_csv, or None to parse qc_csv
+    :param source_hash: String, hash of qc_csv if it is already known
+    :return: pandas.DataFrame with all of the QC data in qc_csv
+    """
+    qc_df = read_qc_csv(qc_csv) if qc_df is None else as_csv_types(qc_df)
+    if pa is None:
+        return qc_df
+    source_stat = get_source_stat(qc_csv)
+    if source_hash is None:
+        source_hash = hash_file(qc_csv)
+
+    cache_path = get_cache_path(qc_csv)
+    temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        table = pa.Table.from_pandas(qc_df.sort_values(INDEX_COLS,
+                                                       kind='stable'),
+                                     preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[SOURCE_HASH_KEY] = source_hash.encode()
+        metadata[SOURCE_STAT_KEY] = source_stat.encode()
+        table = table.replace_schema_metadata(metadata)
+        pq.write_table(table, temp_path, row_group_size=ROW_GROUP_SIZE)
+        os.replace(temp_path, cache_path)
+    except (pa.ArrowException, OSError) as e:
+        print('WARNING: Could not write QC cache {}: {}'.format(cache_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return qc_df
+
+
+def load_qc_data(qc_csv, pguids=None, sessions=None, columns=None):
+    """
+    Load the rows of the QC data for some subjects and sessions, from the
+    Parquet cache if it is up to date, or else from qc_csv, in which case the
+    cache is rebuilt for next time. The cache is up to date if qc_csv has the
+    same size and modification time, or else the same hash, as when the cache
+    was made. Without pyarrow, qc_csv is always used.
+    :param qc_csv: Path to abcd_fastqc01_reformatted.csv
+    :param pguids: List of pGUID strings to load, or None to load them all
+    :param sessions: List of EventName strings to load, or None for all
+    :param columns: List of column names to load, or None for all
+    :return: pandas.DataFrame with the chosen rows and columns, sorted by
+             INDEX_COLS; abcd2bids.py already writes qc_csv in that order
+    """
+    filters = []
+    if pguids is not None:
+        filters.append(('pGUID', 'in', list(pguids)))
+    if sessions is not None:
+        filters.append(('EventName', 'in', list(sessions)))
+
+    if pa is not None:
+        cache_path = get_cache_path(qc_csv)
+        try:
+            metadata = pq.read_schema(cache_path).metadata or {}
+        except (pa.ArrowException, OSError):
+            metadata = {}
+        source_hash = None
+        if metadata.get(SOURCE_STAT_KEY) != get_source_stat(qc_csv).encode():
+            source_hash = hash_file(qc_csv)
+        if source_hash is None or \
+                metadata.get(SOURCE_HASH_KEY) == source_hash.encode():
+            return pq.read_table(cache_path, columns=columns,
+                                 filters=filters or None).to_pandas()
+        print('Caching {} as {}'.format(qc_csv, cache_path))
+        qc_df = write_qc_cache(qc_csv, source_hash=source_hash)
+    else:
+        qc_df = read_qc_csv(qc_csv)
+
+    for col, _, values in filters:
+        qc_df = qc_df[qc_df[col].isin(values)]
+    qc_df = qc_df.sort_values(INDEX_COLS, kind='stable')
+    return (qc_df if columns is None else qc_df[columns]).reset_index(drop=True)
@@ -3,38 +3,39 @@
 import os
 import sys
 import argparse
-from subprocess import Popen, PIPE
 
+try:
+    from session_inventory import (build_inventory, find_series,
+                                   load_inventory, series_path,
+                                   update_series, write_inventory)
+except ImportError:
+    from src.session_inventory import (build_inventory, find_series,
+                                       load_inventory, series_path,
+                                       update_series, write_inventory)
 
 
-def check_for_RawDataStorage(dcm_dir):
-    # Check if the first dicom is raw storage
-    dcm1 = sorted(os.listdir(dcm_dir))[0]
-    dump_cmd = ["dcmdump", "--search", "0002,0002", os.path.join(dcm_dir, dcm1)]
-    p = Popen(dump_cmd, stdout=PIPE, stderr=PIPE)
-    output, err = p.communicate()
-    output = output.decode()
-    if output.split(" ")[2] == '=RawDataStorage':
+
+def check_for_RawDataStorage(dcm_dir, series):
+    # Check if the first dicom is raw storage, using the header fields that
+    # the session inventory read from it
+    dcm1 = series["first_file"]
+    if series["sop_class"] == 'RawDataStorage':
         print("%s contains DICOMs with non-imaging data that need to be removed prior to dcm2niix" % os.path.join(dcm_dir, dcm1))
-        rm_RawData_dcms(dcm_dir, dcm1)
-    elif output.split(" ")[2] == '=MRImageStorage':
+        rm_RawData_dcms(dcm_dir, dcm1, series)
+        return True
+    elif series["sop_class"] == 'MRImageStorage':
         print("%s valid" % os.path.join(dcm_dir, dcm1))
-        return
     else:
-        print("ERROR: dcmdump output not recognized from cmd: %s" % " ".join(dump_cmd))
+        print("ERROR: SOP class %s not recognized in %s" % (series["sop_class"], os.path.join(dcm_dir, dcm1)))
 
-    return
+    return False
 
-def rm_RawData_dcms(dcm_dir, dcm1):
+def rm_RawData_dcms(dcm_dir, dcm1, series):
     # Identify number of temporal positions (0020,0105) and number of slices per time point (should be 60)
-    dump_cmd = ["dcmdump", "--search", "2001,1081", os.path.join(dcm_dir, dcm1)]
-    p = Popen(dump_cmd, stdout=PIPE, stderr=PIPE)
-    output, err = p.communicate()
-    output = output.decode()
-    num_vols = int(output.split(" ")[2].strip("[]"))
+    num_vols = series["temporal_positions"]
     print("Number of Temporal Positions (Field 2001,1081): {}".format(num_vols))
     # Confirm that there are 60 slices per time point
-    assert(num_vols * 60 == len(os.listdir(dcm_dir)))
+    assert(num_vols * 60 == series["num_files"])
 
     # Remove the entire first corrupt volume (every 60th DICOM)
     for i in range(0,60):
@@ -43,7 +44,22 @@ def rm_RawData_dcms(dcm_dir, dcm1):
         os.remove(os.path.join(dcm_dir, dcm_fn))
 
     return
-    
+
+
+def remove_RawData_series(dcm_dir, inventory):
+    # Check every series under dcm_dir in the session inventory, and update
+    # the inventory's record of each series that DICOMs were removed from
+    dcm_dir = os.path.abspath(dcm_dir)
+    changed = False
+    for series in find_series(inventory):
+        func_dcm_dir = series_path(inventory, series)
+        if func_dcm_dir.startswith(dcm_dir + os.sep):
+            if check_for_RawDataStorage(func_dcm_dir, series):
+                update_series(inventory, func_dcm_dir)
+                changed = True
+
+    return changed
+
 
 def get_cli_args():
     parser = argparse.ArgumentParser(
@@ -55,20 +71,26 @@ def get_cli_args():
         type=str,
         help=("DICOM directory")
     )
-    
+
+    parser.add_argument(
+        "--inventory",
+        help=("Session inventory JSON from extract_tgzs.py to find the series "
+              "in, and to update after removing DICOMs. By default, dcm_dir "
+              "is inventoried instead.")
+    )
+
     return(parser.parse_args())
 
 def main():
     cli_args = get_cli_args()
+    if cli_args.inventory:
+        inventory = load_inventory(cli_args.inventory)
+    else:
+        inventory = build_inventory(cli_args.dcm_dir)
 
-    func_dcm_dirs = [x[0] for x in os.walk(cli_args.dcm_dir)][1:]
-
-    for func_dcm_dir in func_dcm_dirs:
-        check_for_RawDataStorage(func_dcm_dir)
+    if remove_RawData_series(cli_args.dcm_dir, inventory) and cli_args.inventory:
+        write_inventory(inventory, cli_args.inventory)
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
-
-
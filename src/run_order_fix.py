@@ -4,8 +4,7 @@ import datetime
 import json
 import os
 import re
-import shutil
-import tempfile
+import sys
 from collections import OrderedDict
 
 taskmatch = re.compile('^.*task-([A-z0-9]+)_run-(\d+).*.nii.gz$')
@@ -22,25 +21,36 @@ def _cli():
     assert args.get_bids_errors or args.generate_map or args.execute_swap, \
         'INPUT: no mode selected!'
 
-    # run stages
+    # run stages, listing each subject session's files only once for all
+    status = 0
+    file_index = None
     if args.get_bids_errors:
         bids_input = args.bids_input
         output_json = args.error_json
         subject_list = args.subject
 
-        get_bids_errors(bids_input, output_json, subject_list)
+        file_index = build_file_index(bids_input, subject_list, args.session)
+        if get_bids_errors(bids_input, output_json, subject_list,
+                           file_index=file_index):
+            status = 1
 
     if args.generate_map:
         bids_input = args.bids_input
         input_json = args.error_json
         output_map = args.file_map
 
-        get_bids_errors_correction_map(input_json, output_map, bids_input)
+        get_bids_errors_correction_map(input_json, output_map, bids_input,
+                                       file_index)
 
     if args.execute_swap:
         input_map = args.file_map
 
-        swap_files(input_map)
+        file_mapper = swap_files(input_map)
+        with open(args.error_json) as fd:
+            errors = json.load(fd)
+        status = 0 if verify_swap(errors, file_mapper) else 1
+
+    return status
 
 
 def generate_parser():
@@ -51,7 +61,9 @@ def generate_parser():
                     '--execute-swap ... inputs',
         epilog='Example call:   ./run_order_fix.py '
                '/mnt/max/shared/projects/ABCD/example_BIDS error.json map.json '
-               '--all --subject [NDARINVXXXXXX|sub-NDARINVXXXXXX]'
+               '--all --subject [NDARINVXXXXXX|sub-NDARINVXXXXXX]   '
+               'Exits with 0 if the runs are in order (after swapping, if '
+               '--execute-swap was used), else 1.'
     )
     modes = parser.add_argument_group(
         title='modes',
@@ -78,6 +90,11 @@ def generate_parser():
         help='optional subject list to narrow down bids inputs. ONLY USED '
              'DURING GET BIDS ERRORS'
     )
+    parser.add_argument(
+        '--session',
+        help='optional session (ses-SESSIONID) to narrow down bids inputs. '
+             'By default, every session of each subject is checked.'
+    )
     parser.add_argument(
         'bids_input', default=None,
         help='path to bids input folder to detect errors.  Will also fix if '
@@ -106,45 +123,50 @@ def generate_parser():
     return parser
 
 
-def get_bids_errors(bids_input, output_json, subject_list=None, detailed=False):
-
-    if subject_list:
-        subject_list = ['sub-%s' % x if not x.startswith('sub-') else x for x
-                        in subject_list]
+def get_bids_errors(bids_input, output_json, subject_list=None, detailed=False,
+                    file_index=None):
 
-    func_folders = get_func_folders(bids_input)
+    if file_index is None:
+        file_index = build_file_index(bids_input, subject_list)
 
-    submatch = re.compile('^.*(sub-[A-z0-9]*).*$')
     structured_output = {}
 
-    for folder in func_folders:
-        subject = submatch.match(folder).group(1)
-        if subject_list and subject not in subject_list:
-            continue
-        print(subject)
-        contents = os.listdir(folder)
-        # sort contents
-        tasks = task_splitter(contents)
-        # filenames
-        new = True
-        for name, task_set in tasks.items():
-            task_set = sorted(task_set)
-            run_nums = [int(taskmatch.match(t).group(2)) for t in task_set]
-            files = [os.path.join(folder, t) for t in task_set]
-            acq_times = [acquisition_time(f) for f in files]
-            order = sorted(range(0, len(acq_times)),
-                           key=acq_times.__getitem__)
-            order = [1 + n for n in order]
-            if run_nums == order:
-                if detailed:
-                    structured_output[subject][name] = 'correct'
+    for subject, sessions in file_index.items():
+        for session_dir, file_paths in sessions.items():
+            folder = os.path.join(session_dir, 'func')
+            contents = [os.path.basename(f) for f in file_paths
+                        if os.path.dirname(f) == folder]
+            if not contents:
                 continue
-            if new:
-                structured_output[subject] = {}
-                new = False
-            structured_output[subject][name] = {}
-            structured_output[subject][name]['current_order'] = run_nums
-            structured_output[subject][name]['actual_order'] = order
+            session = os.path.basename(session_dir)
+            print(subject)
+            # sort contents
+            tasks = task_splitter(contents)
+            # filenames
+            for name, task_set in tasks.items():
+                task_set = sorted(task_set)
+                run_nums = [int(taskmatch.match(t).group(2))
+                            for t in task_set]
+                files = [os.path.join(folder, t) for t in task_set]
+                acq_times = [acquisition_time(f) for f in files]
+                order = sorted(range(0, len(acq_times)),
+                               key=acq_times.__getitem__)
+                order = [1 + n for n in order]
+                if run_nums == order:
+                    if detailed:
+                        structured_output.setdefault(subject, {}).setdefault(
+                            session, {})[name] = 'correct'
+                    continue
+                structured_output.setdefault(subject, {}).setdefault(
+                    session, {})[name] = {
+                        'current_order': run_nums,
+                        'actual_order': order,
+                        'files': files,
+                        'acquisition_times': [
+                            t.isoformat(timespec='microseconds')
+                            for t in acq_times
+                        ]
+                    }
 
     if output_json:
         if os.path.exists(output_json):
@@ -152,91 +174,223 @@ def get_bids_errors(bids_input, output_json, subject_list=None, detailed=False):
         with open(output_json, 'w') as fd:
             json.dump(structured_output, fd)
 
+    return structured_output
+
 
-def get_bids_errors_correction_map(input_json,  output_map, bids_input=None):
+def get_bids_errors_correction_map(input_json,  output_map, bids_input=None,
+                                   file_index=None):
     with open(input_json) as fd:
         jso = json.load(fd)
 
+    if file_index is None:
+        file_index = build_file_index(bids_input, list(jso))
     mapping = OrderedDict()
 
-    for subject, tasks in jso.items():
-        subject_folder = bids_input + '/{subject}/{session}'.format(
-            subject=subject, session='ses-baselineYear1Arm1')
-        for name, map_data in tasks.items():
-            if map_data == 'correct':
-                continue
-            else:
+    for subject, sessions in jso.items():
+        session_files = {os.path.basename(session_dir): file_paths
+                         for session_dir, file_paths
+                         in file_index.get(subject, {}).items()}
+        for session, tasks in sessions.items():
+            file_paths = session_files.get(session, [])
+            for name, map_data in tasks.items():
+                if map_data == 'correct':
+                    continue
                 if name != 'rest':
-                    print('subject %s on %s has bad task data!' % (subject,
-                                                                   name))
+                    print('subject %s %s on %s has bad task data!'
+                          % (subject, session, name))
 
-                current_order = map_data['current_order']
-                actual_order = map_data['actual_order']
+                renames = run_renames(map_data['current_order'],
+                                      map_data['actual_order'])
                 if bids_input:
-                    current_names = ['task-%s_run-0%s' % (name, i) for i in
-                                     current_order]
-                    actual_names = ['task-%s_run-0%s' % (name, i) for i in
-                                    actual_order]
+                    run_name = 'task-%s_run-%02d'
                 else:
-                    current_names = ['task-%s0%s' % (name, i) for i in
-                                     current_order]
-                    actual_names = ['task-%s0%s' % (name, i) for i in
-                                    actual_order]
-                for (current, end) in zip(current_names, actual_names):
-                    mapping.update(
-                        generate_file_map(subject_folder, current, end))
+                    run_name = 'task-%s%02d'
+                for (current, end) in renames:
+                    mapping.update(generate_file_map(
+                        file_paths, run_name % (name, current),
+                        run_name % (name, end)))
 
     if os.path.exists(output_map):
         os.remove(output_map)
     with open(output_map, 'w') as fd:
         json.dump(mapping, fd, indent=4)
 
+    return mapping
+
 
 def swap_files(json_file):
 
     with open(json_file) as fd:
         file_mapper = json.load(fd)
-        file_mapper = OrderedDict(sorted(file_mapper.items()))
-    swapped = []
-    _, tmp = tempfile.mkstemp()
-    for before, after in file_mapper.items():
-        if before in swapped:
-            continue
+    rename_files(file_mapper)
+    return file_mapper
+
+
+def rename_files(file_mapper):
+    """
+    Rename every file in a map to its new name. The map is split into chains
+    (ending at a name which no file has yet) and cycles, which are renamed
+    from their ends, so each file is renamed once. The first file of a cycle
+    is renamed to a temporary name in its own folder first, so it is renamed
+    twice. Every rename is an os.rename on the same filesystem, so no data is
+    copied. If a rename fails, the renames already done are undone.
+    :param file_mapper: Dictionary mapping each file's path to its new path
+    :return: N/A
+    """
+    inverse = {after: before for before, after in file_mapper.items()}
+    if len(inverse) != len(file_mapper):
+        raise ValueError('file map renames two files to the same name')
+    renamed = []
+
+    def rename(before, after):
         try:
-            shutil.move(before, tmp)
-        except:
+            os.rename(before, after)
+        except OSError:
             print('failed to move %s' % before)
+            for undo_after, undo_before in reversed(renamed):
+                os.rename(undo_before, undo_after)
             raise
-        try:
-            shutil.move(after, before)
-        except:
-            print('failed to move %s' % after)
-            shutil.move(tmp, before)
-            raise
-        shutil.move(tmp, after)
-        swapped.append(after)
-
-
-def generate_file_map(subject_directory, current_task, end_task,
-                      tempspace=None):
+        renamed.append((before, after))
+
+    # Chains: rename from the end, whose new name is not taken by any file
+    for end in sorted(set(inverse) - set(file_mapper)):
+        if os.path.exists(end):
+            raise FileExistsError('%s would be overwritten' % end)
+        after = end
+        while after in inverse:
+            rename(inverse[after], after)
+            after = inverse[after]
+
+    # Cycles: move the first file aside, then rename the rest into place
+    done = {before for before, _ in renamed}
+    for start in sorted(file_mapper):
+        if start in done:
+            continue
+        folder, name = os.path.split(start)
+        tmp = os.path.join(folder, '.%s.%d.swap' % (name, os.getpid()))
+        rename(start, tmp)
+        after = start
+        while inverse[after] != start:
+            rename(inverse[after], after)
+            after = inverse[after]
+        rename(tmp, after)
+        done.update(before for before, _ in renamed)
+
+
+def run_renames(current_order, actual_order):
+    """
+    :param current_order: List of a task's run numbers, in file name order
+    :param actual_order: List of the 1-based positions in current_order of
+                         the task's runs, in order of acquisition time
+    :return: List of (current run number, new run number) tuples which give
+             the runs their numbers in order of acquisition time, as one
+             permutation, so that they are all in order after one swap
+    """
+    run_nums = sorted(current_order)
+    return [(current_order[position - 1], run_num) for position, run_num
+            in zip(actual_order, run_nums)
+            if current_order[position - 1] != run_num]
+
+
+def verify_swap(errors, file_mapper):
+    """
+    Check that the runs are in order after swapping, without reading any
+    sidecar JSONs again. Each out-of-order run's file is found at its new
+    name from the file map, and the runs' new numbers must put the
+    acquisition times already read in order.
+    :param errors: Dictionary of errors from get_bids_errors
+    :param file_mapper: Dictionary mapping each file's path to its new path
+    :return: True if the runs are in order, else False
+    """
+    for subject, sessions in errors.items():
+        for session, tasks in sessions.items():
+            for name, map_data in tasks.items():
+                if map_data == 'correct':
+                    continue
+                runs = []
+                for path, acq_time in zip(map_data['files'],
+                                          map_data['acquisition_times']):
+                    new_path = file_mapper.get(path, path)
+                    sidecar = path[:-7] + '.json'
+                    if not os.path.exists(new_path) or \
+                            file_mapper.get(sidecar, sidecar) != \
+                            new_path[:-7] + '.json':
+                        print('%s was not renamed with its sidecar' % path)
+                        return False
+                    run_num = int(taskmatch.match(new_path).group(2))
+                    runs.append((run_num, acq_time))
+                by_run = [acq_time for _, acq_time in sorted(runs)]
+                if len({run_num for run_num, _ in runs}) != len(runs) or \
+                        by_run != sorted(by_run):
+                    print('subject %s %s on %s is still out of order'
+                          % (subject, session, name))
+                    return False
+    return True
+
+
+def generate_file_map(file_paths, current_task, end_task):
     file_map = {}
-    task_directory = subject_directory
 
-    for pathspec in os.walk(task_directory):
-        for filepath in (os.path.join(pathspec[0], f) for f in pathspec[2]):
-            end_filepath = filepath.replace(current_task, end_task)
-            if filepath != end_filepath:
-                file_map[filepath] = end_filepath
+    for filepath in file_paths:
+        end_filepath = filepath.replace(current_task, end_task)
+        if filepath != end_filepath:
+            file_map[filepath] = end_filepath
 
     return file_map
 
 
-def get_func_folders(bids_input):
-    full_paths = os.walk(bids_input)
-    func_paths = filter(lambda x: os.path.basename(x[0]) == 'func', full_paths)
-    func_paths = (i[0] for i in func_paths)
-    # func_paths = itertools.islice(func_paths, 10)
-    return func_paths
+def build_file_index(bids_input, subject_list=None, session=None):
+    """
+    List the files of each subject session to check once, by scanning only
+    those subjects' folders instead of walking the whole BIDS tree. Error
+    detection and map generation both look up files in this index.
+    :param bids_input: Path to the BIDS folder
+    :param subject_list: List of subject IDs to index, with or without the
+                         "sub-" prefix, or None to index every subject
+    :param session: String, the only session folder (ses-SESSIONID) to index,
+                    or None to index every session of each subject
+    :return: Dictionary mapping each subject to a dictionary mapping each of
+             its session folders to a sorted list of the paths of every file
+             in that session folder
+    """
+    if subject_list:
+        subjects = ['sub-%s' % x if not x.startswith('sub-') else x for x
+                    in subject_list]
+    else:
+        subjects = sorted(entry.name for entry in os.scandir(bids_input)
+                          if entry.is_dir() and entry.name.startswith('sub-'))
+
+    file_index = OrderedDict()
+    for subject in subjects:
+        subject_dir = os.path.join(bids_input, subject)
+        if not os.path.isdir(subject_dir):
+            continue
+        if session:
+            session_dirs = [os.path.join(subject_dir, session)]
+        else:
+            session_dirs = sorted(
+                entry.path for entry in os.scandir(subject_dir)
+                if entry.is_dir() and entry.name.startswith('ses-')
+            ) or [subject_dir]
+        file_index[subject] = OrderedDict(
+            (session_dir, sorted(list_files(session_dir)))
+            for session_dir in session_dirs if os.path.isdir(session_dir)
+        )
+    return file_index
+
+
+def list_files(folder):
+    """
+    :param folder: Path to a folder
+    :return: List of the paths of every file in the folder or its subfolders
+    """
+    file_paths = []
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            file_paths += list_files(entry.path)
+        else:
+            file_paths.append(entry.path)
+    return file_paths
 
 
 def task_splitter(filenames):
@@ -262,4 +416,4 @@ def acquisition_time(filename):
 
 
 if __name__ == '__main__':
-    _cli()
+    sys.exit(_cli())
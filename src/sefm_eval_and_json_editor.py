@@ -4,6 +4,11 @@ import os, sys, glob, argparse, subprocess, socket, operator, shutil, json
 from bids import BIDSLayout
 from itertools import product
 
+try:
+    from session_inventory import load_inventory, scanner_name
+except ImportError:
+    from src.session_inventory import load_inventory, scanner_name
+
 os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
 
 # Last modified
@@ -214,7 +219,35 @@ def seperate_concatenated_fm(bids_layout, subject, session, fsl_dir, debug=False
    
     return
 
-def edit_dwi_jsons(layout, subject, sessions):
+def read_sidecar(nii_path):
+    """
+    :param nii_path: path to a NIfTI
+    :return: dictionary of the NIfTI's sidecar json
+    """
+    with open(nii_path.replace('.nii.gz', '.json')) as f:
+        return json.load(f)
+
+def get_scanner(sidecar, inventory=None):
+    """
+    :param sidecar: dictionary of the sidecar json of a NIfTI converted from
+    the session's DICOMs
+    :param inventory: session inventory from session_inventory.py, or None to
+    only use the sidecar
+    :return: tuple of the manufacturer of the scanner which the NIfTI's series
+    was acquired on, named as in sidecar jsons, and its software versions. They
+    come from the inventory's record of the series with the sidecar's
+    SeriesDescription, or from the sidecar if no such series has a
+    manufacturer.
+    """
+    if inventory:
+        for series in inventory['series']:
+            if series['manufacturer'] and \
+                    series['series_description'] == sidecar.get('SeriesDescription'):
+                return (scanner_name(series['manufacturer']),
+                        series['software_versions'] or '')
+    return sidecar.get('Manufacturer', ''), sidecar.get('SoftwareVersions', '')
+
+def edit_dwi_jsons(layout, subject, sessions, inventory=None):
     print('Editing DWI sidecar jsons')
     all_json_paths = []
     # Get rel path of all dwi images
@@ -250,19 +283,19 @@ def edit_dwi_jsons(layout, subject, sessions):
     
     for json_path in all_json_paths:
         nii_path = json_path.replace('.json', '.nii.gz')
-        dwi_metadata = layout.get_metadata(nii_path)
-        if 'GE' in dwi_metadata['Manufacturer']:
-            if 'DV26' in dwi_metadata['SoftwareVersions']:
+        manufacturer, software_versions = get_scanner(read_sidecar(nii_path), inventory)
+        if 'GE' in manufacturer:
+            if 'DV26' in software_versions:
                 insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000768)
                 insert_edit_json(json_path, 'TotalReadoutTime', 0.106752)
-            if 'DV25' in dwi_metadata['SoftwareVersions']:
+            if 'DV25' in software_versions:
                 insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000752)
                 insert_edit_json(json_path, 'TotalReadoutTime', 0.104528)
-        elif 'Philips' in dwi_metadata['Manufacturer']:
+        elif 'Philips' in manufacturer:
             insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.00062771)
             insert_edit_json(json_path, 'TotalReadoutTime', 0.08976)
             insert_edit_json(json_path, 'PhaseEncodingDirection', 'j')
-        elif 'Siemens' in dwi_metadata['Manufacturer']:
+        elif 'Siemens' in manufacturer:
             insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000689998)
             insert_edit_json(json_path, 'TotalReadoutTime', 0.0959097)
         else:
@@ -336,6 +369,13 @@ def generate_parser(parser=None):
         help=('Directory where necessary .json files live, including '
               'dataset_description.json')
     )
+    parser.add_argument(
+        '--inventory',
+        help=('Session inventory json from session_inventory.py to get the '
+              'scanner manufacturer and software versions of each NIfTI\'s '
+              'series from. Sidecar jsons are still used for series which '
+              'are not in it or have no manufacturer.')
+    )
     
     return parser
 
@@ -353,6 +393,7 @@ def main(argv=sys.argv):
     # Load the bids layout
     layout = BIDSLayout(args.bids_dir)
     subsess = read_bids_layout(layout, subject_list=args.subject_list, collect_on_subject=args.collect)
+    inventory = load_inventory(args.inventory) if args.inventory else None
 
     for subject,sessions in subsess:
  
@@ -373,19 +414,19 @@ def main(argv=sys.argv):
                                             args.debug)
             for sefm in [os.path.join(x.dirname, x.filename) for x in fmap]:
                 sefm_json = sefm.replace('.nii.gz', '.json')
-                sefm_metadata = layout.get_metadata(sefm)
+                manufacturer, _ = get_scanner(read_sidecar(sefm), inventory)
 
-                if 'Philips' in sefm_metadata['Manufacturer']:
+                if 'Philips' in manufacturer:
                     insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.00062771)
-                if 'GE' in sefm_metadata['Manufacturer']:
+                if 'GE' in manufacturer:
                     insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.000536)
-                if 'Siemens' in sefm_metadata['Manufacturer']:
+                if 'Siemens' in manufacturer:
                     insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.000510012)
 
         # Check if there are dwi fieldmaps and insert IntendedFor field accordingly
         if layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz', acquisition='dwi'):
             print("Editing DWI jsons")
-            edit_dwi_jsons(layout, subject, sessions)
+            edit_dwi_jsons(layout, subject, sessions, inventory)
                     
 
 
@@ -394,14 +435,14 @@ def main(argv=sys.argv):
         if anat:
             for TX in [os.path.join(x.dirname, x.filename) for x in anat]:
                 TX_json = TX.replace('.nii.gz', '.json') 
-                TX_metadata = layout.get_metadata(TX)
+                manufacturer, _ = get_scanner(read_sidecar(TX), inventory)
                     #if 'T1' in TX_metadata['SeriesDescription']:
 
-                if 'Philips' in TX_metadata['Manufacturer']:
+                if 'Philips' in manufacturer:
                     insert_edit_json(TX_json, 'DwellTime', 0.00062771)
-                if 'GE' in TX_metadata['Manufacturer']:
+                if 'GE' in manufacturer:
                     insert_edit_json(TX_json, 'DwellTime', 0.000536)
-                if 'Siemens' in TX_metadata['Manufacturer']:
+                if 'Siemens' in manufacturer:
                     insert_edit_json(TX_json, 'DwellTime', 0.000510012)
         
         # add EffectiveEchoSpacing if it doesn't already exist
@@ -411,13 +452,14 @@ def main(argv=sys.argv):
         if func:
             for task in [os.path.join(x.dirname, x.filename) for x in func]:
                 task_json = task.replace('.nii.gz', '.json')
-                task_metadata = layout.get_metadata(task)
-                if 'Philips' in task_metadata['Manufacturer']:
+                task_metadata = read_sidecar(task)
+                manufacturer, software_versions = get_scanner(task_metadata, inventory)
+                if 'Philips' in manufacturer:
                     insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.00062771)
-                if 'GE' in task_metadata['Manufacturer']:
-                    if 'DV26' in task_metadata['SoftwareVersions']:
+                if 'GE' in manufacturer:
+                    if 'DV26' in software_versions:
                         insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.000556)
-                if 'Siemens' in task_metadata['Manufacturer']:
+                if 'Siemens' in manufacturer:
                     insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.000510012)                
                 if "PhaseEncodingAxis" in task_metadata:
                     insert_edit_json(task_json, 'PhaseEncodingDirection', task_metadata['PhaseEncodingAxis'])
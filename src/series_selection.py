@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+"""
+Rules for which series aws_downloader.py downloads, and the engine which
+applies them to every subject session of the QC data at once
+Each rule picks one kind of series per subject session from the series which
+passed QC. A rule's alternatives are tried in order and the first one that
+the session has is used, which is how NORM series are preferred over raw ones
+and single fieldmaps over AP/PA pairs. A rule can also require other rules,
+e.g. DTI is only downloaded along with a diffusion fieldmap.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Columns of the QC data which identify a subject session
+SESSION_COLS = ['pGUID', 'EventName']
+
+# Ways that an alternative takes the series of its image descriptions:
+#   ALL:   Every series. The session has it if it has any of them.
+#   PAIRS: Every series, in pairs of one of each description (AP, PA, AP,
+#          PA, ...). The session only has it if it has the same nonzero
+#          number of each description, so both of every pair passed QC.
+#   LAST:  The last series of each description. The session has it if it
+#          has the first description.
+ALL = 'all'
+PAIRS = 'pairs'
+LAST = 'last'
+
+# Rules in the order their files are downloaded in. Each rule has:
+#   name:         Name of the rule, and of its count in the download log
+#                 (has_<name>) if it is logged
+#   modality:     --modalities option which the rule belongs to
+#   alternatives: List of (how, image descriptions) to try in order
+#   requires:     Names of other rules which must have picked series for this
+#                 rule to download anything in a session
+#   logged:       Whether the rule's series count is in the download log
+SELECTION_RULES = [
+    {'name': 't1', 'modality': 'anat',
+     'alternatives': [(ALL, ['ABCD-T1-NORM']), (ALL, ['ABCD-T1'])]},
+    {'name': 't2', 'modality': 'anat',
+     'alternatives': [(ALL, ['ABCD-T2-NORM']), (ALL, ['ABCD-T2'])]},
+    {'name': 'sefm', 'modality': 'func',
+     'alternatives': [(ALL, ['ABCD-fMRI-FM']),
+                      (PAIRS, ['ABCD-fMRI-FM-AP', 'ABCD-fMRI-FM-PA'])]},
+    {'name': 'rsfmri', 'modality': 'func',
+     'alternatives': [(ALL, ['ABCD-rsfMRI'])]},
+    {'name': 'mid', 'modality': 'func',
+     'alternatives': [(ALL, ['ABCD-MID-fMRI'])]},
+    {'name': 'sst', 'modality': 'func',
+     'alternatives': [(ALL, ['ABCD-SST-fMRI'])]},
+    {'name': 'nback', 'modality': 'func',
+     'alternatives': [(ALL, ['ABCD-nBack-fMRI'])]},
+    {'name': 'dti', 'modality': 'dwi', 'requires': ['dti_fm'],
+     'alternatives': [(ALL, ['ABCD-DTI'])]},
+    {'name': 'dti_fm', 'modality': 'dwi', 'requires': ['dti'],
+     'logged': False,
+     'alternatives': [(ALL, ['ABCD-Diffusion-FM']),
+                      (LAST, ['ABCD-Diffusion-FM-AP',
+                              'ABCD-Diffusion-FM-PA'])]}
+]
+
+# Names of the series counts in the download log, in order
+COUNT_NAMES = [rule['name'] for rule in SELECTION_RULES
+               if rule.get('logged', True)]
+
+
+def select_series(passed_QC_df, modalities, rules=SELECTION_RULES):
+    """
+    Apply the selection rules to every subject session at once.
+    :param passed_QC_df: pandas.DataFrame of the series which passed QC, with
+                         SESSION_COLS, image_description, and image_file
+                         columns, in the order to download each kind of
+                         series in
+    :param modalities: List of the modalities to download
+    :param rules: List of selection rules like SELECTION_RULES
+    :return: Tuple of a dictionary mapping each (pGUID, EventName) session
+             which has any series to download to its list of s3 links, and a
+             dictionary mapping each session in passed_QC_df to a tuple of its
+             series count for each logged rule (COUNT_NAMES by default)
+    """
+    count_names = [rule['name'] for rule in rules if rule.get('logged', True)]
+    series = passed_QC_df[SESSION_COLS + ['image_description', 'image_file']]
+    series = series.reset_index(drop=True)
+    if series.empty:
+        return dict(), dict()
+    if not any(rule['modality'] in modalities for rule in rules):
+        return dict(), {key: (0,) * len(count_names) for key in
+                        series.groupby(SESSION_COLS, sort=False).groups}
+
+    # Count each image description's series in each session in one pass,
+    # and number the series of each description within its session
+    per_desc = series.groupby(SESSION_COLS + ['image_description'],
+                              sort=False)
+    counts = per_desc.size().unstack(fill_value=0)
+    desc_ix = per_desc.cumcount().to_numpy()
+    is_last = desc_ix == per_desc['image_file'].transform('size').to_numpy() - 1
+    session_ix = counts.index.get_indexer(
+        pd.MultiIndex.from_frame(series[SESSION_COLS]))
+    descriptions = series['image_description']
+    no_series = np.zeros(len(counts), dtype=int)
+
+    # Pick each rule's series from the first alternative each session has
+    picked = dict()
+    for rule_ix, rule in enumerate(rules):
+        if rule['modality'] not in modalities:
+            continue
+        chosen = np.full(len(counts), -1)
+        for alt_ix, (how, descs) in enumerate(rule['alternatives']):
+            desc_counts = [counts[desc].to_numpy() if desc in counts
+                           else no_series for desc in descs]
+            has_alt = sum(desc_counts) > 0
+            if how == PAIRS:
+                has_alt = desc_counts[0] > 0
+                for desc_count in desc_counts[1:]:
+                    has_alt &= desc_count == desc_counts[0]
+            elif how == LAST:
+                has_alt = desc_counts[0] > 0
+            chosen[(chosen == -1) & has_alt] = alt_ix
+
+        row_alt = chosen[session_ix]
+        rows = []
+        for alt_ix, (how, descs) in enumerate(rule['alternatives']):
+            take = (row_alt == alt_ix) & descriptions.isin(descs).to_numpy()
+            if how == LAST:
+                take &= is_last
+            rows.append(pd.DataFrame({
+                'session_ix': session_ix[take],
+                'rule_ix': rule_ix,
+                'pair_ix': desc_ix[take] if how == PAIRS else 0,
+                'alt_desc_ix': descriptions[take].map(
+                    {desc: ix for ix, desc in enumerate(descs)}).to_numpy(),
+                'row_ix': np.flatnonzero(take),
+            }))
+        picked[rule['name']] = pd.concat(rows, ignore_index=True)
+
+    # Drop each rule's series from the sessions missing a series it requires
+    has_rule = {name: np.bincount(rows['session_ix'], minlength=len(counts)) > 0
+                for name, rows in picked.items()}
+    for rule in rules:
+        rows = picked.get(rule['name'])
+        if rows is None or not rule.get('requires'):
+            continue
+        keep = has_rule[rule['name']].copy()
+        for required in rule['requires']:
+            keep &= has_rule.get(required, np.zeros(len(counts), dtype=bool))
+        picked[rule['name']] = rows[keep[rows['session_ix'].to_numpy()]]
+
+    # Count each session's series for each logged rule
+    num_series = np.stack([
+        np.bincount(picked[name]['session_ix'], minlength=len(counts))
+        if name in picked else no_series for name in count_names
+    ], axis=1)
+    session_counts = dict(zip(counts.index, map(tuple, num_series.tolist())))
+
+    # List each session's s3 links in rule order, then pair, then description
+    # order, then the order they are in passed_QC_df
+    all_picked = pd.concat(picked.values(), ignore_index=True).sort_values(
+        ['session_ix', 'rule_ix', 'pair_ix', 'alt_desc_ix', 'row_ix'])
+    all_picked['image_file'] = series['image_file'].to_numpy()[
+        all_picked['row_ix'].to_numpy()]
+    file_paths = {counts.index[ix]: files for ix, files in
+                  all_picked.groupby('session_ix', sort=False)['image_file']
+                  .agg(list).items()}
+    return file_paths, session_counts
@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+
+"""
+Inventory of the DICOM series in one subject session's unpacked .tgz files
+Built once by extract_tgzs.py right after the archives are unpacked, in one
+walk of the DCMs folder which reads each series' header once. The later
+stages of unpack_stages.py read the inventory instead of listing folders
+and probing files again. For each series folder, it records the file count,
+SOP class, manufacturer, software versions, series description, and number
+of temporal positions. It also lists the files which are not in a series
+folder, like EventRelatedInformation files, e.g.:
+    python3 src/session_inventory.py series inventory.json --modality dwi \\
+        --fields manufacturer software_versions
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+
+try:
+    from dicom_header import (DicomHeaderError, MANUFACTURER,
+                              MEDIA_STORAGE_SOP_CLASS, read_header,
+                              SERIES_DESCRIPTION, sop_class_name,
+                              SOFTWARE_VERSIONS, TEMPORAL_POSITIONS)
+except ImportError:
+    from src.dicom_header import (DicomHeaderError, MANUFACTURER,
+                                  MEDIA_STORAGE_SOP_CLASS, read_header,
+                                  SERIES_DESCRIPTION, sop_class_name,
+                                  SOFTWARE_VERSIONS, TEMPORAL_POSITIONS)
+
+# Name of the inventory file in a session's temporary folder
+INVENTORY_NAME = "session_inventory.json"
+
+# Fields of each series record which come from its first file's header
+HEADER_FIELDS = {"sop_class": MEDIA_STORAGE_SOP_CLASS,
+                 "manufacturer": MANUFACTURER,
+                 "software_versions": SOFTWARE_VERSIONS,
+                 "series_description": SERIES_DESCRIPTION,
+                 "temporal_positions": TEMPORAL_POSITIONS}
+
+# Manufacturer names as dcm2niix writes them in BIDS sidecar JSONs
+SCANNER_NAMES = (("GE", "GE"), ("SIEMENS", "Siemens"), ("PHILIPS", "Philips"))
+
+
+def modality_of(rel_path):
+    """
+    :param rel_path: Path relative to the DCMs folder, like
+                     sub-X/ses-Y/func/ABCD-rsfMRI_run-1
+    :return: String, the folder under the session folder (anat, func, dwi,
+             ...), or None if the path is not under a session folder
+    """
+    parts = rel_path.split(os.sep)
+    for ix, part in enumerate(parts[:-1]):
+        if part.startswith("ses-"):
+            return parts[ix + 1]
+    return None
+
+
+def series_record(dcm_dir, series_dir, file_names):
+    """
+    :param dcm_dir: Path to the DCMs folder
+    :param series_dir: Path to a folder in it
+    :param file_names: List of the names of the files in series_dir
+    :return: Dictionary describing the folder's series, or None if its first
+             file in sorted order is not a DICOM file
+    """
+    try:
+        header = read_header(os.path.join(series_dir, min(file_names)),
+                             HEADER_FIELDS.values())
+    except (OSError, DicomHeaderError):
+        return None
+    rel_path = os.path.relpath(series_dir, dcm_dir)
+    record = {"path": rel_path, "modality": modality_of(rel_path),
+              "num_files": len(file_names), "first_file": min(file_names)}
+    for field, tag in HEADER_FIELDS.items():
+        record[field] = header.get(tag)
+    record["sop_class"] = sop_class_name(record["sop_class"] or "")
+    try:
+        record["temporal_positions"] = int(record["temporal_positions"])
+    except (TypeError, ValueError):
+        record["temporal_positions"] = None
+    return record
+
+
+def build_inventory(dcm_dir):
+    """
+    Walk the DCMs folder once, reading the header of the first file of each
+    folder with files in it.
+    :param dcm_dir: Path to the folder that a session's .tgz files were
+                    unpacked into
+    :return: Dictionary with the absolute dcm_dir, a list of series records
+             sorted by path, and a sorted list of the paths (relative to
+             dcm_dir) of the files which are not in a series folder
+    """
+    dcm_dir = os.path.abspath(dcm_dir)
+    inventory = {"dcm_dir": dcm_dir, "series": [], "files": []}
+    for folder, _, file_names in os.walk(dcm_dir):
+        if not file_names:
+            continue
+        record = series_record(dcm_dir, folder, file_names)
+        if record is None:
+            inventory["files"] += [os.path.relpath(os.path.join(folder, name),
+                                                   dcm_dir)
+                                   for name in file_names]
+        else:
+            inventory["series"].append(record)
+    inventory["series"].sort(key=lambda record: record["path"])
+    inventory["files"].sort()
+    return inventory
+
+
+def update_series(inventory, series_dir):
+    """
+    Re-inventory one series folder after a stage changed its files.
+    :param inventory: Dictionary from build_inventory, changed in place
+    :param series_dir: Path to the series folder
+    :return: The series' new record, or None if it no longer has any DICOMs
+    """
+    rel_path = os.path.relpath(os.path.abspath(series_dir),
+                               inventory["dcm_dir"])
+    file_names = [entry.name for entry in os.scandir(series_dir)
+                  if entry.is_file()] if os.path.isdir(series_dir) else []
+    record = series_record(inventory["dcm_dir"], series_dir,
+                           file_names) if file_names else None
+    inventory["series"] = [other for other in inventory["series"]
+                           if other["path"] != rel_path]
+    if record is not None:
+        inventory["series"].append(record)
+        inventory["series"].sort(key=lambda record: record["path"])
+    return record
+
+
+def write_inventory(inventory, inventory_path):
+    """
+    Save an inventory to a JSON file, through a temporary file so that
+    readers never see a partly written inventory.
+    :param inventory: Dictionary from build_inventory
+    :param inventory_path: Path to the JSON file to save it in
+    :return: N/A
+    """
+    temp_path = "{}.{}.tmp".format(inventory_path, os.getpid())
+    with open(temp_path, "w") as outfile:
+        json.dump(inventory, outfile, indent=2)
+    os.replace(temp_path, inventory_path)
+
+
+def load_inventory(inventory_path):
+    """
+    :param inventory_path: Path to a JSON file from write_inventory
+    :return: Dictionary, the inventory
+    """
+    with open(inventory_path) as infile:
+        return json.load(infile)
+
+
+def find_series(inventory, modality=None):
+    """
+    :param inventory: Dictionary from build_inventory
+    :param modality: String, e.g. "func", to only find series of it
+    :return: List of the series records, in path order
+    """
+    return [record for record in inventory["series"]
+            if modality is None or record["modality"] == modality]
+
+
+def find_files(inventory, pattern):
+    """
+    :param inventory: Dictionary from build_inventory
+    :param pattern: Shell-style pattern to match paths relative to the DCMs
+                    folder against, e.g. "*/func/*EventRelatedInformation.*"
+    :return: Sorted list of the absolute paths of the matching files which
+             are not in a series folder
+    """
+    return [os.path.join(inventory["dcm_dir"], path)
+            for path in inventory["files"] if fnmatch.fnmatch(path, pattern)]
+
+
+def series_path(inventory, record):
+    """
+    :param inventory: Dictionary from build_inventory
+    :param record: One of its series records
+    :return: Absolute path to the series folder
+    """
+    return os.path.join(inventory["dcm_dir"], record["path"])
+
+
+def scanner_name(manufacturer):
+    """
+    :param manufacturer: String, a DICOM header's manufacturer, like
+                         "GE MEDICAL SYSTEMS", or None
+    :return: String, the manufacturer as dcm2niix names it in sidecar JSONs
+             ("GE", "Siemens", or "Philips"), else manufacturer unchanged
+    """
+    for header_name, name in SCANNER_NAMES:
+        if header_name in (manufacturer or "").upper():
+            return name
+    return manufacturer
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Build an inventory of a session's unpacked DICOM series, "
+                    "or look things up in one."
+    )
+    modes = parser.add_subparsers(dest="mode")
+    modes.required = True
+
+    build = modes.add_parser(
+        "build", help="Inventory a DCMs folder and save it to a JSON file"
+    )
+    build.add_argument("dcm_dir", help="Folder the .tgz files were unpacked "
+                       "into")
+    build.add_argument("inventory", help="Path to the JSON file to save")
+
+    series = modes.add_parser(
+        "series", help="Print fields of the first series of a modality, one "
+                       "per line, or a series folder per line if no fields "
+                       "are given"
+    )
+    series.add_argument("inventory", help="Path to the inventory JSON file")
+    series.add_argument("--modality", help="Only look at series of this "
+                        "modality, e.g. dwi")
+    series.add_argument("--fields", nargs="+", default=[],
+                        help="Fields of the series to print, e.g. "
+                             "manufacturer software_versions")
+
+    files = modes.add_parser(
+        "files", help="Print the paths of the files outside series folders "
+                      "which match a pattern, one per line"
+    )
+    files.add_argument("inventory", help="Path to the inventory JSON file")
+    files.add_argument("pattern", help="Shell-style pattern to match paths "
+                       "relative to the DCMs folder against")
+    return parser
+
+
+def main():
+    args = generate_parser().parse_args()
+    if args.mode == "build":
+        write_inventory(build_inventory(args.dcm_dir), args.inventory)
+        return 0
+
+    inventory = load_inventory(args.inventory)
+    if args.mode == "files":
+        matches = find_files(inventory, args.pattern)
+        for path in matches:
+            print(path)
+        return 0 if matches else 1
+
+    matches = find_series(inventory, args.modality)
+    if not matches:
+        return 1
+    if not args.fields:
+        for record in matches:
+            print(series_path(inventory, record))
+    for field in args.fields:
+        value = matches[0].get(field)
+        print("" if value is None else value)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+
+"""
+Structured timing and resource metrics for abcd2bids.py
+Appends one JSON record per line to a metrics file for every step of the
+wrapper and every stage of unpack_stages.py, with wall time, CPU time,
+peak RSS, bytes read and written, and exit code, keyed by subject/session.
+"""
+
+import argparse
+from contextlib import contextmanager
+import datetime
+import fcntl
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# Environment variable which tells unpack_stages.py where to log metrics
+METRICS_ENV_VAR = "ABCD2BIDS_METRICS"
+
+
+def read_proc_io(pid="self"):
+    """
+    :param pid: Process ID to read I/O counts of, or "self"
+    :return: Tuple of (bytes read, bytes written) by that process and all of
+             its finished children, or (None, None) if /proc is unavailable
+    """
+    try:
+        with open("/proc/{}/io".format(pid)) as infile:
+            io = dict(line.split(": ") for line in infile.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def make_record(stage, subject, session, started, wall_time, cpu_time,
+                peak_rss_kb, bytes_read, bytes_written, exit_code):
+    """
+    :return: Dictionary with one metrics record, ready to be logged
+    """
+    return {"stage": stage, "subject": subject, "session": session,
+            "started": started.isoformat(timespec="seconds"),
+            "wall_time": round(wall_time, 3), "cpu_time": round(cpu_time, 3),
+            "peak_rss_kb": peak_rss_kb, "bytes_read": bytes_read,
+            "bytes_written": bytes_written, "exit_code": exit_code}
+
+
+def run_and_measure(cmd, stage, subject="", session="", **popen_kwargs):
+    """
+    Run a command and measure the resources used by it and its children.
+    :param cmd: List of strings, the command to run
+    :param stage: String naming the step or stage which the command runs
+    :param subject: String, BIDS subject ID which the command is run on
+    :param session: String, session which the command is run on
+    :param popen_kwargs: Any other keyword arguments for subprocess.Popen
+    :return: Tuple of the command's exit code and its metrics record
+    """
+    started = datetime.datetime.now()
+    start = time.monotonic()
+    process = subprocess.Popen(cmd, **popen_kwargs)
+
+    # Wait for the process to exit without reaping it, so that its /proc
+    # entry, which counts I/O by it and all of its children, is still there
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    bytes_read, bytes_written = read_proc_io(process.pid)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return process.returncode, make_record(
+        stage, subject, session, started, time.monotonic() - start,
+        usage.ru_utime + usage.ru_stime, usage.ru_maxrss, bytes_read,
+        bytes_written, process.returncode
+    )
+
+
+@contextmanager
+def measure(metrics_log, stage, subject="", session=""):
+    """
+    Measure the resources used by this process, and every child process which
+    finishes, while running the body of a with-statement, then log them.
+    :param metrics_log: Path to the JSONL file to append the record to, or
+                        None to not measure anything
+    :param stage: String naming the step or stage being measured
+    :param subject: String, BIDS subject ID being processed
+    :param session: String, session being processed
+    :return: N/A
+    """
+    if not metrics_log:
+        yield
+        return
+    started = datetime.datetime.now()
+    start = time.monotonic()
+    before = [resource.getrusage(who) for who in
+              (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    read_before, written_before = read_proc_io()
+    exit_code = 1
+    try:
+        yield
+        exit_code = 0
+    finally:
+        after = [resource.getrusage(who) for who in
+                 (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        read_after, written_after = read_proc_io()
+        write_record(metrics_log, make_record(
+            stage, subject, session, started, time.monotonic() - start,
+            sum(use.ru_utime + use.ru_stime for use in after)
+            - sum(use.ru_utime + use.ru_stime for use in before),
+            max(use.ru_maxrss for use in after),
+            None if read_before is None else read_after - read_before,
+            None if written_before is None
+            else written_after - written_before, exit_code
+        ))
+
+
+def write_record(metrics_log, record):
+    """
+    Append one record to a JSONL metrics file. The file is locked while
+    writing, so that parallel workers never interleave their records.
+    :param metrics_log: Path to the JSONL file to append the record to
+    :param record: Dictionary to write as one line of JSON
+    :return: N/A
+    """
+    with open(metrics_log, "a") as outfile:
+        fcntl.flock(outfile, fcntl.LOCK_EX)
+        outfile.write(json.dumps(record) + "\n")
+        fcntl.flock(outfile, fcntl.LOCK_UN)
+
+
+def summarize(metrics_log):
+    """
+    Print the number of records, total and mean wall time, total CPU time,
+    highest peak RSS, and total bytes read and written for each stage.
+    :param metrics_log: Path to a JSONL metrics file
+    :return: Dictionary mapping each stage name to its summary
+    """
+    summary = {}
+    with open(metrics_log) as infile:
+        for line in infile:
+            record = json.loads(line)
+            stage = summary.setdefault(record["stage"], {
+                "count": 0, "failed": 0, "wall_time": 0, "cpu_time": 0,
+                "peak_rss_kb": 0, "bytes_read": 0, "bytes_written": 0
+            })
+            stage["count"] += 1
+            stage["failed"] += record["exit_code"] != 0
+            stage["peak_rss_kb"] = max(stage["peak_rss_kb"],
+                                       record["peak_rss_kb"])
+            for key in ("wall_time", "cpu_time", "bytes_read",
+                        "bytes_written"):
+                stage[key] += record[key] or 0
+
+    print("{:<28} {:>6} {:>6} {:>11} {:>11} {:>11} {:>10} {:>10} {:>10}"
+          .format("stage", "count", "failed", "wall (s)", "mean (s)",
+                  "cpu (s)", "rss (MB)", "read (MB)", "write (MB)"))
+    for name, stage in summary.items():
+        print("{:<28} {:>6} {:>6} {:>11.1f} {:>11.1f} {:>11.1f} {:>10.1f} "
+              "{:>10.1f} {:>10.1f}".format(
+                  name, stage["count"], stage["failed"], stage["wall_time"],
+                  stage["wall_time"] / stage["count"], stage["cpu_time"],
+                  stage["peak_rss_kb"] / 1024, stage["bytes_read"] / 2**20,
+                  stage["bytes_written"] / 2**20))
+    return summary
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Run a command and log its timing and resource use, or "
+                    "summarize a metrics log."
+    )
+    modes = parser.add_subparsers(dest="mode")
+    modes.required = True
+
+    run = modes.add_parser(
+        "run", help="Run a command and append its metrics to a JSONL file"
+    )
+    run.add_argument("metrics_log", help="Path to the JSONL metrics file")
+    run.add_argument("stage", help="Name of the stage the command runs")
+    run.add_argument("subject", help="BIDS subject ID")
+    run.add_argument("session", help="BIDS session ID")
+    run.add_argument("cmd", nargs=argparse.REMAINDER,
+                     help='Command to run, after "--"')
+
+    summary = modes.add_parser(
+        "summary", help="Print totals for each stage in a metrics file"
+    )
+    summary.add_argument("metrics_log", help="Path to the JSONL metrics file")
+
+    return parser
+
+
+def main():
+    args = generate_parser().parse_args()
+    if args.mode == "summary":
+        summarize(args.metrics_log)
+        return 0
+
+    cmd = args.cmd[1:] if args.cmd and args.cmd[0] == "--" else args.cmd
+    exit_code, record = run_and_measure(cmd, args.stage, args.subject,
+                                        args.session)
+    write_record(args.metrics_log, record)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+
+"""
+Choose how unpack_stages.py stages a session's .tgz files
+By default, the archives are unpacked straight from the download folder, so
+each byte is read once. Copying them to scratch first reads every byte twice
+and writes it once, which only pays off when the download folder's filesystem
+is slow at the small reads that tar and gzip make but fast at the large reads
+that cp makes, as on some network filesystems. This script measures both read
+speeds and gzip's decompression speed on a sample of the largest archive, and
+prints "copy" if the source filesystem is the bottleneck or else "stream".
+"""
+
+import argparse
+import os
+import sys
+import time
+import zlib
+
+# Environment variable which tells unpack_stages.py how to stage .tgz files
+STAGING_ENV_VAR = "ABCD2BIDS_STAGING"
+STAGING_MODES = ("auto", "stream", "copy")
+
+# Bytes of each sample to read, block size that tar and gzip read with, and
+# block size that cp reads with
+SAMPLE_BYTES = 16 * 2**20
+SMALL_BLOCK = 64 * 2**10
+LARGE_BLOCK = 8 * 2**20
+
+# Copy only if large reads are at least this many times faster than small ones
+COPY_SPEEDUP = 2.0
+
+
+def measure_read_rate(path, offset, num_bytes, block_size):
+    """
+    :param path: Path to the file to read
+    :param offset: Integer, byte to start reading at
+    :param num_bytes: Integer, number of bytes to read
+    :param block_size: Integer, number of bytes to read at a time
+    :return: Tuple of the bytes read and the read speed in MB/s
+    """
+    data = []
+    start = time.monotonic()
+    with open(path, "rb", buffering=0) as infile:
+        infile.seek(offset)
+        while num_bytes > 0:
+            block = infile.read(min(block_size, num_bytes))
+            if not block:
+                break
+            data.append(block)
+            num_bytes -= len(block)
+    data = b"".join(data)
+    return data, len(data) / 2**20 / max(time.monotonic() - start, 1e-6)
+
+
+def measure_decompress_rate(gzip_data):
+    """
+    :param gzip_data: Bytes from the start of a gzip file
+    :return: Float, MB/s of gzip_data that zlib decompresses
+    """
+    start = time.monotonic()
+    try:
+        zlib.decompressobj(31).decompress(gzip_data)
+    except zlib.error:
+        pass
+    return len(gzip_data) / 2**20 / max(time.monotonic() - start, 1e-6)
+
+
+def choose_staging(tgz_dir):
+    """
+    :param tgz_dir: Path to the folder with a session's .tgz files
+    :return: String, "copy" if the .tgz files should be copied to scratch
+             before they are unpacked, or "stream" to unpack them in place
+    """
+    tgzs = [entry for entry in os.scandir(tgz_dir)
+            if entry.name.endswith(".tgz") and entry.is_file()]
+    if not tgzs:
+        return "stream"
+    largest = max(tgzs, key=lambda entry: entry.stat().st_size)
+    size = largest.stat().st_size
+    if size < 2 * SAMPLE_BYTES:
+        print("Stream: {} is too small to measure".format(largest.path),
+              file=sys.stderr)
+        return "stream"
+
+    # Read different parts of the file each way, so that neither read is
+    # sped up by the other having cached it
+    sample, small_rate = measure_read_rate(largest.path, 0, SAMPLE_BYTES,
+                                           SMALL_BLOCK)
+    _, large_rate = measure_read_rate(largest.path, size - SAMPLE_BYTES,
+                                      SAMPLE_BYTES, LARGE_BLOCK)
+    decompress_rate = measure_decompress_rate(sample)
+    staging = "copy" if small_rate < decompress_rate and \
+        large_rate >= COPY_SPEEDUP * small_rate else "stream"
+    print("{}: reading {} at {:.0f} MB/s in small blocks and {:.0f} MB/s in "
+          "large blocks; decompressing it at {:.0f} MB/s".format(
+              staging.capitalize(), largest.path, small_rate, large_rate,
+              decompress_rate), file=sys.stderr)
+    return staging
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Print whether to copy a session's .tgz files to scratch "
+                    "before unpacking them (copy) or to unpack them where "
+                    "they are (stream)."
+    )
+    parser.add_argument("tgz_dir", help="Folder with the session's .tgz files")
+    parser.add_argument(
+        "--mode",
+        choices=STAGING_MODES,
+        default=os.environ.get(STAGING_ENV_VAR) or "auto",
+        help="auto to measure which is faster, or stream or copy to skip "
+             "measuring. Default: ${} or auto".format(STAGING_ENV_VAR)
+    )
+    return parser
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    if args.mode not in STAGING_MODES:
+        parser.error("${} must be one of {}".format(STAGING_ENV_VAR,
+                                                    ", ".join(STAGING_MODES)))
+    print(choose_staging(args.tgz_dir) if args.mode == "auto" else args.mode)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
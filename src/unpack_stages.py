@@ -0,0 +1,628 @@
+#! /usr/bin/env python3
+
+"""
+Stage engine which unpacks and sets up one subject session's .tgz files
+Runs the same stages that unpack_and_setup.sh used to run, which is now just
+a thin entry point to this script. Each stage is a function of the session,
+with the session paths it needs (inputs) and makes (outputs) declared, so
+that the engine can check them. Every stage is timed and logged to the
+metrics file. With a state database, each stage which finished is recorded
+and leaves a done marker in the session's scratch folder, and a rerun with
+the same inputs skips the stages that are still done. The session's scratch
+folder is <scratch>/<subject>_<session>, so that a rerun finds the outputs
+of the stages before the one that failed.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    from extract_tgzs import (extract_tgzs, JOBS_ENV_VAR, MemberFilter,
+                              MODALITIES_ENV_VAR, PIGZ_ENV_VAR)
+    from pipeline_state import fingerprint_strings, PipelineState
+    from remove_RawDataStorage_dcms import remove_RawData_series
+    from session_inventory import (build_inventory, find_files, find_series,
+                                   load_inventory, write_inventory)
+    from stage_metrics import measure, METRICS_ENV_VAR
+    from stage_tgzs import choose_staging, STAGING_ENV_VAR, STAGING_MODES
+except ImportError:
+    from src.extract_tgzs import (extract_tgzs, JOBS_ENV_VAR, MemberFilter,
+                                  MODALITIES_ENV_VAR, PIGZ_ENV_VAR)
+    from src.pipeline_state import fingerprint_strings, PipelineState
+    from src.remove_RawDataStorage_dcms import remove_RawData_series
+    from src.session_inventory import (build_inventory, find_files,
+                                       find_series, load_inventory,
+                                       write_inventory)
+    from src.stage_metrics import measure, METRICS_ENV_VAR
+    from src.stage_tgzs import choose_staging, STAGING_ENV_VAR, STAGING_MODES
+
+# Paths to the scripts and files in this repository which the stages use
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+ABCD2BIDS_DIR = os.path.dirname(SRC_DIR)
+DCM2BIDS_CONFIG = os.path.join(ABCD2BIDS_DIR, "abcd_dcm2bids.conf")
+DATASET_DESCRIPTION = os.path.join(ABCD2BIDS_DIR, "dataset_description.json")
+DIFFUSION_TABLES = os.path.join(SRC_DIR, "ABCD_Release_2.0_Diffusion_Tables")
+RUN_ORDER_FIX = os.path.join(SRC_DIR, "run_order_fix.py")
+SEFM_EVAL = os.path.join(SRC_DIR, "sefm_eval_and_json_editor.py")
+
+# Prefix of each stage's step name in the state database
+STATE_STEP_PREFIX = "unpack_and_setup:"
+
+# GE software versions which need the DV26 bvals and bvecs. Don Hagler at
+# UCSD said GE software versions between DV (and RX) 26 and 28 needed to be
+# replaced by the DV26 BVAL/BVEC files
+GE_DV26_VERSIONS = ("DV26", "RX26", "DV27", "RX27", "DV28", "RX28")
+
+# Tasks whose EventRelatedInformation files are copied into sourcedata
+EVENT_TASKS = ("MID", "SST", "nBack")
+
+
+class StageError(Exception):
+    """
+    Raised when a stage cannot finish
+    """
+
+
+class Session(object):
+    """
+    Paths and settings of one subject session being unpacked and set up
+    """
+    def __init__(self, subject, visit, tgz_dir, output_dir, scratch_dir,
+                 fsl_dir=None, mre_dir=None, staging="auto", untar_jobs=1,
+                 pigz_min_mb=None, modalities=None):
+        """
+        :param subject: String, full BIDS subject ID (sub-SUBJECTID)
+        :param visit: String, full BIDS session ID (ses-SESSIONID)
+        :param tgz_dir: Path to the downloaded session folder, with the .tgz
+                        files in its image03 subfolder
+        :param output_dir: Path to the BIDS folder to copy the results into
+        :param scratch_dir: Path to the folder to make the session's
+                            temporary folder in
+        :param fsl_dir: Path to the FSL folder, or None to use $FSL_DIR
+        :param mre_dir: Path to the MATLAB Runtime Environment folder, or
+                        None to use $MRE_DIR
+        :param staging: String, one of STAGING_MODES
+        :param untar_jobs: Integer, number of .tgz files to unpack at once
+        :param pigz_min_mb: Float, size in MB above which .tgz files are
+                            decompressed with pigz, or None to never use it
+        :param modalities: List of the modalities to unpack, or None for all
+        """
+        self.subject = subject
+        self.visit = visit
+        self.participant = subject.replace("sub-", "", 1)
+        self.session = visit.replace("ses-", "", 1)
+        self.tgz_dir = os.path.abspath(tgz_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.fsl_dir = fsl_dir or os.environ.get("FSL_DIR")
+        self.mre_dir = mre_dir or os.environ.get("MRE_DIR")
+        self.staging_mode = staging
+        self.untar_jobs = untar_jobs
+        self.pigz_min_mb = pigz_min_mb
+        self.modalities = modalities
+        self._staging = None
+
+        # Paths which the stages read and write
+        self.temp_dir = os.path.abspath(os.path.join(
+            scratch_dir, "_".join((subject, visit))))
+        self.download_tgz_dir = os.path.join(self.tgz_dir, "image03")
+        self.copied_tgz_dir = os.path.join(self.temp_dir, "image03")
+        self.dcm_dir = os.path.join(self.temp_dir, "DCMs")
+        self.inventory_path = os.path.join(self.temp_dir,
+                                           "session_inventory.json")
+        self.bids_dir = os.path.join(self.temp_dir, "BIDS_unprocessed")
+        self.bids_session_dir = os.path.join(self.bids_dir, subject, visit)
+        self.sourcedata_dir = os.path.join(self.bids_dir, "sourcedata",
+                                           subject)
+        self.stages_done_dir = os.path.join(self.temp_dir, "stages_done")
+        self.output_session_dir = os.path.join(self.output_dir, subject,
+                                               visit)
+
+    @property
+    def staging(self):
+        """
+        :return: String, "copy" to copy the .tgz files to scratch before
+                 unpacking them, or "stream" to unpack them where they are.
+                 In auto mode, this is measured once per run.
+        """
+        if self._staging is None:
+            self._staging = choose_staging(self.download_tgz_dir) \
+                if self.staging_mode == "auto" else self.staging_mode
+        return self._staging
+
+    @property
+    def tgz_source(self):
+        """
+        :return: Path to the folder to unpack the .tgz files from
+        """
+        return self.copied_tgz_dir if self.staging == "copy" \
+            else self.download_tgz_dir
+
+    def inventory(self):
+        """
+        :return: Dictionary, the session inventory saved by the untar stage
+        """
+        return load_inventory(self.inventory_path)
+
+    def has_series(self, modality):
+        """
+        :param modality: String, e.g. "func"
+        :return: True if the session inventory has a series of modality, or
+                 False if there is no inventory because untar failed
+        """
+        return os.path.exists(self.inventory_path) and \
+            bool(find_series(self.inventory(), modality))
+
+
+class Stage(object):
+    """
+    One step of unpacking and setting up a session
+    """
+    def __init__(self, name, run, inputs=(), outputs=(), when=None,
+                 fatal=False):
+        """
+        :param name: String naming the stage in logs, metrics, and the state
+                     database
+        :param run: Function which takes a Session and runs the stage,
+                    raising an exception if it fails
+        :param inputs: Names of the Session paths which must exist before the
+                       stage runs
+        :param outputs: Names of the Session paths which the stage makes, and
+                        which must still exist for the stage to be skipped
+        :param when: Function which takes a Session and returns whether to
+                     run the stage, or None to always run it
+        :param fatal: True to stop the session if the stage fails, or False
+                      to go on to the next stage
+        """
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.when = when
+        self.fatal = fatal
+
+    def paths(self, session, names):
+        return [getattr(session, name) for name in names]
+
+    def done_marker(self, session):
+        """
+        :param session: Session which the stage runs on
+        :return: String, path to the file which the stage leaves in the
+                 session's scratch folder when it finishes. Most stages
+                 change bids_dir in place, so this is how a rerun can tell
+                 that their changes are still there.
+        """
+        return os.path.join(session.stages_done_dir, self.name)
+
+    def is_still_done(self, session):
+        """
+        :param session: Session which the stage runs on
+        :return: True if the stage's done marker and outputs all exist
+        """
+        return all(os.path.exists(path) for path in
+                   [self.done_marker(session)] +
+                   self.paths(session, self.outputs))
+
+
+def copy_tgzs(session):
+    print("{} :COPYING TGZs TO SCRATCH: {}".format(now(),
+                                                   session.copied_tgz_dir))
+    if os.path.isdir(session.copied_tgz_dir):
+        shutil.rmtree(session.copied_tgz_dir)
+    shutil.copytree(session.download_tgz_dir, session.copied_tgz_dir)
+
+
+def untar_tgzs(session):
+    """
+    Unpack the .tgz files, skipping RawDataStorage DICOMs and the series of
+    modalities which were not selected, then save the session inventory.
+    """
+    if os.path.isdir(session.dcm_dir):
+        shutil.rmtree(session.dcm_dir)
+    os.makedirs(session.dcm_dir)
+    print("{} :UNPACKING DCMs FROM {}: {}".format(now(), session.tgz_source,
+                                                  session.dcm_dir))
+    failed = extract_tgzs(session.tgz_source, session.dcm_dir,
+                          session.untar_jobs, session.pigz_min_mb,
+                          MemberFilter(modalities=session.modalities))
+    write_inventory(build_inventory(session.dcm_dir), session.inventory_path)
+    if failed:
+        raise StageError("Failed to extract {} .tgz files".format(len(failed)))
+
+
+def remove_raw_data_storage(session):
+    inventory = session.inventory()
+    if remove_RawData_series(os.path.join(session.dcm_dir, session.subject,
+                                          session.visit, "func"), inventory):
+        write_inventory(inventory, session.inventory_path)
+
+
+def run_dcm2bids(session):
+    os.makedirs(session.bids_dir, exist_ok=True)
+    shutil.copy(DATASET_DESCRIPTION, session.bids_dir)
+    print(session.participant)
+    print("{} :RUNNING dcm2bids".format(now()))
+    subprocess.check_call((
+        "dcm2bids", "-d", os.path.join(session.dcm_dir, session.subject),
+        "-p", session.participant, "-s", session.session,
+        "-c", DCM2BIDS_CONFIG, "-o", session.bids_dir, "--forceDcm2niix",
+        "--clobber"
+    ))
+
+
+def replace_bvals_and_bvecs(session):
+    """
+    Replace the bvals and bvecs from dcm2niix with files supplied by the NDA,
+    for GE scanners whose software versions need them.
+    """
+    series = find_series(session.inventory(), "dwi")[0]
+    manufacturer = series["manufacturer"] or ""
+    software_versions = series["software_versions"] or ""
+    print("Replacing bvals and bvecs with files supplied by the NDA")
+    for dwi in sorted(glob.glob(os.path.join(
+            session.bids_session_dir, "dwi", "{}_{}*.nii.gz".format(
+                session.subject, session.visit)))):
+        orig_bval = dwi.replace(".nii.gz", ".bval")
+        orig_bvec = dwi.replace(".nii.gz", ".bvec")
+        if "GE" in manufacturer:
+            if "DV25" in software_versions:
+                print("Replacing GE DV25 bvals and bvecs")
+                table_version = "DV25"
+            elif any(version in software_versions
+                     for version in GE_DV26_VERSIONS):
+                print("Replacing GE bvals and bvecs for software version "
+                      "after DV25 and before DV29")
+                table_version = "DV26"
+            else:
+                continue
+            for table, orig in (("bvals", orig_bval), ("bvecs", orig_bvec)):
+                table_path = os.path.join(DIFFUSION_TABLES, "GE_{}_{}.txt"
+                                          .format(table, table_version))
+                print("cp {} {}".format(table_path, orig))
+                shutil.copyfile(table_path, orig)
+        elif "SIEMENS" in manufacturer:
+            # Siemens BVAL and BVEC files should be good directly from dcm2niix
+            print("Found Siemens data, not replacing BVAL or BVEC files")
+        elif "Philips" in manufacturer:
+            # Philips BVAL and BVEC files should be good directly from dcm2niix
+            print("Found Philips data, not replacing BVAL or BVEC files")
+        else:
+            raise StageError("ERROR setting up DWI: Manufacturer not "
+                             "recognized")
+
+
+def fix_run_order(session):
+    """
+    Put the functional runs in order of acquisition time. run_order_fix.py
+    swaps them all in one pass, then checks the order and exits with 0 only
+    if every run is in order.
+    """
+    print("{} :CHECKING BIDS ORDERING OF EPIs".format(now()))
+    if subprocess.call((
+            RUN_ORDER_FIX, session.bids_dir,
+            os.path.join(session.temp_dir, "bids_order_error.json"),
+            os.path.join(session.temp_dir, "bids_order_map.json"),
+            "--all", "--subject", session.subject, "--session", session.visit
+    )) != 0:
+        raise StageError("{} :  ERROR: BIDS incorrectly ordered even after "
+                         "running run_order_fix.py".format(now()))
+    print("{} : BIDS functional scans correctly ordered".format(now()))
+
+
+def select_sefm(session):
+    if not (session.fsl_dir and session.mre_dir):
+        raise StageError("SEFM selection needs the FSL and MRE folders")
+    print("{} :RUNNING SEFM SELECTION AND EDITING SIDECAR JSONS"
+          .format(now()))
+    subprocess.check_call((
+        SEFM_EVAL, session.bids_dir, session.fsl_dir, session.mre_dir,
+        "--participant-label=" + session.participant,
+        "--output_dir", session.output_dir,
+        "--inventory", session.inventory_path
+    ))
+
+
+def fix_jsons(session):
+    """
+    Fix all json extra data errors by rewriting each sidecar json with only
+    its first (valid) JSON value, formatted as jq '.' would format it.
+    """
+    for json_path in sorted(glob.glob(os.path.join(session.bids_session_dir,
+                                                   "*", "*.json"))):
+        with open(json_path) as infile:
+            contents = infile.read()
+        data, _ = json.JSONDecoder().raw_decode(contents.lstrip())
+        temp_path = json_path + ".temp"
+        with open(temp_path, "w") as outfile:
+            json.dump(data, outfile, indent=2, ensure_ascii=False)
+            outfile.write("\n")
+        os.replace(temp_path, json_path)
+
+
+def remove_concatenated_fmaps(session):
+    for fmap in glob.glob(os.path.join(session.bids_session_dir, "fmap",
+                                       "*dir-both*")):
+        os.remove(fmap)
+
+
+def copy_event_files(session):
+    """
+    Copy the EventRelatedInformation files into sourcedata with BIDS names.
+    """
+    inventory = session.inventory()
+    func_pattern = os.path.join(session.subject, session.visit, "func", "*{}"
+                                "*EventRelatedInformation.*")
+    if not find_files(inventory, func_pattern.format("")):
+        return
+    print("{} :COPY AND RENAME SOURCE DATA".format(now()))
+    srcdata_dir = os.path.join(session.sourcedata_dir, session.visit, "func")
+    os.makedirs(srcdata_dir, exist_ok=True)
+    for task in EVENT_TASKS:
+        event_files = find_files(inventory, func_pattern.format(task))
+        print("Task ERI files found: " + " ".join(event_files))
+        for run, event_file in enumerate(event_files, start=1):
+            shutil.copy(event_file, os.path.join(
+                srcdata_dir, "{}_{}_task-{}_run-0{}_bold_"
+                "EventRelatedInformation.{}".format(
+                    session.subject, session.visit,
+                    "nback" if "nBack" in event_file else task, run,
+                    event_file.rsplit(".", 1)[-1])))
+
+
+def make_group_writable(folder):
+    """
+    Give a folder's group read and write permission to it and everything in
+    it, ignoring files whose permissions cannot be changed.
+    :param folder: Path to the folder
+    :return: N/A
+    """
+    for parent, _, file_names in os.walk(folder):
+        for path in [parent] + [os.path.join(parent, name)
+                                for name in file_names]:
+            try:
+                os.chmod(path, os.stat(path).st_mode | 0o060)
+            except OSError:
+                pass
+
+
+def copy_back(session):
+    print("{} :COPYING BIDS DATA BACK: {}".format(now(), session.output_dir))
+    subject_dir = os.path.join(session.bids_dir, session.subject)
+    if os.path.isdir(subject_dir):
+        print("{} :CHMOD BIDS INPUT".format(now()))
+        make_group_writable(subject_dir)
+
+        # Delete unneccsary .bval and .bvec files from fmap
+        print("{} :DELETING .bval and .bvec FILES".format(now()))
+        for ext in ("bval", "bvec"):
+            for fmap_file in glob.glob(os.path.join(
+                    session.bids_session_dir, "fmap", "*." + ext)):
+                os.remove(fmap_file)
+        print("{} :COPY BIDS INPUT".format(now()))
+        shutil.copytree(subject_dir, os.path.join(session.output_dir,
+                                                  session.subject),
+                        dirs_exist_ok=True)
+
+    if os.path.isdir(session.sourcedata_dir):
+        print("{} :CHMOD SOURCEDATA".format(now()))
+        make_group_writable(session.sourcedata_dir)
+        print("{} :COPY SOURCEDATA".format(now()))
+        shutil.copytree(session.sourcedata_dir, os.path.join(
+            session.output_dir, "sourcedata", session.subject),
+            dirs_exist_ok=True)
+
+
+# Stages in the order they run. Only replace_bvals_and_bvecs and
+# run_order_fix stop the session if they fail, as in unpack_and_setup.sh.
+STAGES = [
+    Stage("copy", copy_tgzs, inputs=["download_tgz_dir"],
+          outputs=["copied_tgz_dir"],
+          when=lambda session: session.staging == "copy"),
+    Stage("untar", untar_tgzs, inputs=["tgz_source"],
+          outputs=["dcm_dir", "inventory_path"]),
+    Stage("remove_raw_data_storage", remove_raw_data_storage,
+          inputs=["dcm_dir", "inventory_path"],
+          when=lambda session: session.has_series("func")),
+    Stage("dcm2bids", run_dcm2bids, inputs=["dcm_dir"],
+          outputs=["bids_dir"]),
+    Stage("replace_bvals_and_bvecs", replace_bvals_and_bvecs,
+          inputs=["bids_dir", "inventory_path"], fatal=True,
+          when=lambda session: session.has_series("dwi")),
+    Stage("run_order_fix", fix_run_order, inputs=["bids_dir"], fatal=True,
+          when=lambda session: os.path.exists(os.path.join(
+              session.bids_session_dir, "func"))),
+    Stage("sefm_selection", select_sefm, inputs=["bids_dir"],
+          when=lambda session: os.path.isdir(os.path.join(
+              session.bids_session_dir, "fmap"))),
+    Stage("jq_fixup", fix_jsons, inputs=["bids_dir"]),
+    Stage("remove_concatenated_fmaps", remove_concatenated_fmaps,
+          inputs=["bids_dir"]),
+    Stage("copy_event_files", copy_event_files,
+          inputs=["bids_dir", "inventory_path"]),
+    Stage("copy_back", copy_back, inputs=["bids_dir"],
+          outputs=["output_session_dir"]),
+]
+
+
+def now():
+    """
+    :return: String with the current date and time, like `date` prints it
+    """
+    return datetime.datetime.now().strftime("%a %b %d %H:%M:%S %Y")
+
+
+def run_stages(session, stages=STAGES, state=None, fingerprint="",
+               metrics_log=None):
+    """
+    Run each stage of unpacking and setting up a session in order. A stage
+    is skipped if the state database says it already finished with the same
+    session fingerprint, its done marker and outputs still exist, and no
+    stage before it ran.
+    :param session: Session to unpack and set up
+    :param stages: List of Stages to run in order
+    :param state: PipelineState to record each stage in, or None to run
+                  every stage
+    :param fingerprint: String fingerprinting the session's inputs
+    :param metrics_log: Path to the JSONL file to log each stage's metrics
+                        to, or None
+    :return: Integer, 0 if no fatal stage failed, else 1
+    """
+    os.makedirs(session.stages_done_dir, exist_ok=True)
+    resuming = state is not None
+    for stage in stages:
+        step = STATE_STEP_PREFIX + stage.name
+        stage_fingerprint = fingerprint_strings((fingerprint, stage.name))
+        # A stage whose condition cannot be checked fails like any other
+        when_error = None
+        try:
+            if stage.when is not None and not stage.when(session):
+                continue
+        except Exception as e:
+            when_error = e
+        if when_error is None and resuming and \
+                state.is_done(session.subject, session.session, step,
+                              stage_fingerprint) and \
+                stage.is_still_done(session):
+            print("{} :{} was already done; skipping".format(now(),
+                                                            stage.name))
+            continue
+        resuming = False  # Rerun every stage after one which has to run
+
+        if state is not None:
+            state.start(session.subject, session.session, step,
+                        stage_fingerprint)
+        if os.path.exists(stage.done_marker(session)):
+            os.remove(stage.done_marker(session))
+        start = time.monotonic()
+        exit_code = 1
+        try:
+            if when_error is not None:
+                raise when_error
+            missing = [path for path in stage.paths(session, stage.inputs)
+                       if not os.path.exists(path)]
+            if missing:
+                raise StageError("Missing input: " + ", ".join(missing))
+            with measure(metrics_log, stage.name, session.subject,
+                         session.visit):
+                stage.run(session)
+            open(stage.done_marker(session), "w").close()
+            exit_code = 0
+        except Exception as e:
+            print("{} :{} failed: {}".format(now(), stage.name, e))
+        finally:
+            if state is not None:
+                state.finish(session.subject, session.session, step,
+                             exit_code)
+        print("{} :{} {} in {:.1f} seconds".format(
+            now(), stage.name, "failed" if exit_code else "finished",
+            time.monotonic() - start), flush=True)
+        if exit_code and stage.fatal:
+            return 1
+    print("{} :UNPACKING AND SETUP COMPLETE: {}/{}".format(
+        now(), session.subject, session.visit))
+    return 0
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description="Unpack one subject session's .tgz files, convert them "
+                    "to BIDS, select the best SEFM, and copy the results to "
+                    "the output folder."
+    )
+    parser.add_argument("subject", help="Full BIDS subject ID (sub-SUBJECTID)")
+    parser.add_argument("visit", help="Full BIDS session ID (ses-SESSIONID)")
+    parser.add_argument("tgz_dir", help="Path to the session's download "
+                        "folder, which has the .tgz files in image03")
+    parser.add_argument("output_dir", nargs="?", default="./data",
+                        help="Path to the BIDS output folder. Default: "
+                             "./data")
+    parser.add_argument("scratch_dir", nargs="?", default="./temp",
+                        help="Path to the folder to make the session's "
+                             "temporary folder in. Default: ./temp")
+    parser.add_argument("fsl_dir", nargs="?", help="Path to FSL directory")
+    parser.add_argument("mre_dir", nargs="?", help="Path to MATLAB Runtime "
+                        "Environment (MRE) directory")
+    parser.add_argument(
+        "--staging",
+        default=os.environ.get(STAGING_ENV_VAR) or "auto",
+        help="One of {}. Default: ${} or auto".format(
+            ", ".join(STAGING_MODES), STAGING_ENV_VAR)
+    )
+    parser.add_argument(
+        "--untar-jobs",
+        type=int,
+        dest="untar_jobs",
+        default=int(os.environ.get(JOBS_ENV_VAR) or 1),
+        help="Number of .tgz files to unpack at once. Default: ${} or 1"
+             .format(JOBS_ENV_VAR)
+    )
+    parser.add_argument(
+        "--pigz-min-mb",
+        type=float,
+        dest="pigz_min_mb",
+        default=float(os.environ[PIGZ_ENV_VAR]) if os.environ.get(PIGZ_ENV_VAR)
+        else None,
+        help="Decompress .tgz files bigger than this many MB with pigz. "
+             "Default: ${}, or never".format(PIGZ_ENV_VAR)
+    )
+    parser.add_argument(
+        "--modalities",
+        nargs="+",
+        default=os.environ[MODALITIES_ENV_VAR].split(",")
+        if os.environ.get(MODALITIES_ENV_VAR) else None,
+        help="Only unpack series of these modalities. Default: ${}, a "
+             "comma-separated list, or all modalities"
+             .format(MODALITIES_ENV_VAR)
+    )
+    parser.add_argument(
+        "--metrics",
+        default=os.environ.get(METRICS_ENV_VAR),
+        help="Path to a JSONL file to log each stage's metrics to. Default: "
+             "${}, or no metrics".format(METRICS_ENV_VAR)
+    )
+    parser.add_argument(
+        "--state-db",
+        dest="state_db",
+        help="Path to the SQLite state database to record each stage in, so "
+             "that a rerun skips the stages which are still done. By "
+             "default, every stage runs."
+    )
+    parser.add_argument(
+        "--fingerprint",
+        default="",
+        help="String fingerprinting the session's inputs. A stage is only "
+             "skipped if it last finished with the same fingerprint."
+    )
+    return parser
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    if args.staging not in STAGING_MODES:
+        parser.error("--staging must be one of " + ", ".join(STAGING_MODES))
+    if args.untar_jobs < 1:
+        parser.error("--untar-jobs must be a positive integer.")
+    session = Session(args.subject, args.visit, args.tgz_dir,
+                      args.output_dir or "./data",
+                      args.scratch_dir or "./temp", args.fsl_dir,
+                      args.mre_dir, args.staging, args.untar_jobs,
+                      args.pigz_min_mb, args.modalities)
+    state = PipelineState(os.path.abspath(args.state_db)) \
+        if args.state_db else None
+    print(now())
+    print(socket.gethostname())
+    print(os.environ.get("SLURM_JOB_ID", ""))
+    print("Running under group: {}".format(os.getgid()))
+    return run_stages(session, STAGES, state, args.fingerprint, args.metrics)
+
+
+if __name__ == "__main__":
+    sys.exit(main())